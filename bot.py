@@ -1,9 +1,16 @@
 # bot.py (УПРОЩЕННАЯ ВЕРСИЯ БЕЗ КНОПКИ "НАЗАД")
 import os
-import requests
+import io
+import httpx
+import time
 import asyncio
+from contextlib import asynccontextmanager
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, Updater as _PTB_Updater
+from telegram.constants import ChatAction
+from telegram.error import TelegramError
+from telegram.ext import (
+    Application, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes, Updater as _PTB_Updater,
+)
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,8 +19,153 @@ if hasattr(_PTB_Updater, "__slots__") and "_Updater__polling_cleanup_cb" not in
     _PTB_Updater.__slots__ = _PTB_Updater.__slots__ + ("_Updater__polling_cleanup_cb",)
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-ORCHESTRATOR_URL = "http://127.0.0.1:8000/process"
-FEEDBACK_URL = "http://127.0.0.1:8000/feedback"
+# Бот и API могут работать на разных хостах: документы скачиваются по HTTP, общий диск не нужен
+API_BASE_URL = os.getenv("API_BASE_URL", "http://127.0.0.1:8000").rstrip("/")
+ORCHESTRATOR_URL = os.getenv("ORCHESTRATOR_URL", f"{API_BASE_URL}/process")
+FEEDBACK_URL = os.getenv("FEEDBACK_URL", f"{API_BASE_URL}/feedback")
+JOBS_URL = os.getenv("JOBS_URL", f"{API_BASE_URL}/jobs")
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# polling — бот сам опрашивает Telegram; webhook — Telegram присылает обновления (см. bot_webhook.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Запросы к API асинхронные: пока один пользователь ждёт документ, бот обслуживает остальных.
+# Сколько обновлений Telegram обрабатывается одновременно (обновления одного пользователя — по очереди)
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "64"))
+BOT_HTTP_MAX_CONNECTIONS = int(os.getenv("BOT_HTTP_MAX_CONNECTIONS", "64"))
+BOT_CONNECT_TIMEOUT = float(os.getenv("BOT_CONNECT_TIMEOUT", "10"))
+# Сколько ждать ответа API по типу запроса (с): генерация документа идёт минутами, термин — секундами
+REQUEST_TIMEOUTS = {
+    "term": float(os.getenv("BOT_TIMEOUT_TERM", "120")),
+    "document": float(os.getenv("BOT_TIMEOUT_DOCUMENT", "900")),
+    "feedback": float(os.getenv("BOT_TIMEOUT_FEEDBACK", "30")),
+    "download": float(os.getenv("BOT_TIMEOUT_DOWNLOAD", "120")),
+    "poll": float(os.getenv("BOT_TIMEOUT_POLL", "30")),
+}
+# Документы идут через очередь /jobs: бот опрашивает задачу и показывает прогресс в одном сообщении
+BOT_USE_JOBS = os.getenv("BOT_USE_JOBS", "true").lower() in ("1", "true", "yes")
+BOT_JOB_POLL_INTERVAL = float(os.getenv("BOT_JOB_POLL_INTERVAL", "2"))
+# Telegram ограничивает частоту правок сообщений, поэтому статус обновляется не чаще этого интервала (с)
+BOT_STATUS_EDIT_INTERVAL = float(os.getenv("BOT_STATUS_EDIT_INTERVAL", "3"))
+# Присылать готовые разделы текстом, не дожидаясь DOCX
+BOT_SEND_SECTIONS = os.getenv("BOT_SEND_SECTIONS", "false").lower() in ("1", "true", "yes")
+# В каких форматах присылать документ: "docx", "pdf", "html", несколько через запятую или "all"
+BOT_OUTPUT_FORMAT = os.getenv("BOT_OUTPUT_FORMAT", "docx")
+TELEGRAM_MESSAGE_LIMIT = 4000
+
+STAGE_LABELS = {
+    "outline": "Составляю план документа…",
+    "generation": "Генерирую документ…",
+    "export": "Все разделы готовы, собираю файл…",
+    "coalesced": "Такой же запрос уже выполняется, жду его результат…",
+}
+# Telegram показывает «печатает…» около 5 секунд, поэтому статус обновляется чаще
+CHAT_ACTION_INTERVAL = 4.0
+
+_http_client: httpx.AsyncClient | None = None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает обновления разных пользователей параллельно (не более max_concurrent_updates),
+    а обновления одного пользователя — строго по очереди, чтобы не путались шаги диалога.
+    Пока обновление ждёт своей очереди, оно не занимает общий слот. Команда /cancel идёт
+    вне очереди: она должна прервать запрос, который сейчас выполняется.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._waiting: dict[int, int] = {}
+
+    async def process_update(self, update: object, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        message = update.effective_message if isinstance(update, Update) else None
+        if user is None or (message is not None and (message.text or "").startswith("/cancel")):
+            await super().process_update(update, coroutine)
+            return
+
+        lock = self._locks.setdefault(user.id, asyncio.Lock())
+        self._waiting[user.id] = self._waiting.get(user.id, 0) + 1
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            self._waiting[user.id] -= 1
+            if not self._waiting[user.id]:
+                del self._waiting[user.id]
+                del self._locks[user.id]
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class RequestCancelled(Exception):
+    """Пользователь отменил свой запрос командой /cancel."""
+
+
+def http_client() -> httpx.AsyncClient:
+    """Общий HTTP-клиент бота: один пул соединений с API на все запросы."""
+    if _http_client is None:
+        raise RuntimeError("HTTP-клиент бота ещё не создан")
+    return _http_client
+
+
+def request_timeout(kind: str) -> httpx.Timeout:
+    return httpx.Timeout(REQUEST_TIMEOUTS.get(kind, REQUEST_TIMEOUTS["document"]), connect=BOT_CONNECT_TIMEOUT)
+
+
+async def open_http_client(application: Application) -> None:
+    global _http_client
+    _http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=BOT_HTTP_MAX_CONNECTIONS, max_keepalive_connections=BOT_HTTP_MAX_CONNECTIONS),
+        timeout=request_timeout("document"),
+    )
+
+
+async def close_http_client(application: Application) -> None:
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+@asynccontextmanager
+async def chat_action(update: Update, action: str):
+    """Держит в чате статус («печатает…», «отправляет файл…»), пока выполняется блок."""
+    async def keep_alive():
+        while True:
+            try:
+                await update.message.chat.send_action(action)
+            except Exception as e:
+                print(f"Не удалось отправить статус чата: {e}")
+            await asyncio.sleep(CHAT_ACTION_INTERVAL)
+
+    task = asyncio.create_task(keep_alive())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+
+async def run_cancellable(context: ContextTypes.DEFAULT_TYPE, coro):
+    """Выполняет запрос к API отдельной задачей, которую пользователь может отменить командой /cancel."""
+    task = asyncio.create_task(coro)
+    context.user_data['inflight'] = task
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if context.user_data.pop('cancel_requested', False):
+            raise RequestCancelled() from None
+        raise
+    finally:
+        context.user_data.pop('inflight', None)
+
 
 # --- Определяем клавиатуры ---
 main_keyboard = [
@@ -34,21 +186,175 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
 
+async def download_document(download_url: str) -> io.BytesIO:
+    """Скачивает готовый документ с API потоком (частями) и возвращает его в памяти."""
+    # Ссылка относительная, если на API не задан PUBLIC_API_URL
+    if not download_url.startswith(("http://", "https://")):
+        download_url = f"{API_BASE_URL}{download_url}"
+    buffer = io.BytesIO()
+    async with http_client().stream("GET", download_url, timeout=request_timeout("download")) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+            buffer.write(chunk)
+    buffer.seek(0)
+    return buffer
+
+
+class StatusMessage:
+    """Одно сообщение со статусом запроса, которое редактируется на месте не чаще BOT_STATUS_EDIT_INTERVAL."""
+
+    def __init__(self, reply_to):
+        self._reply_to = reply_to
+        self._message = None
+        self._text = None
+        self._edited_at = 0.0
+
+    async def show(self, text: str, force: bool = False) -> None:
+        if text == self._text:
+            return
+        now = time.monotonic()
+        if self._message is None:
+            self._message = await self._reply_to.reply_text(text)
+        elif force or now - self._edited_at >= BOT_STATUS_EDIT_INTERVAL:
+            try:
+                await self._message.edit_text(text)
+            except TelegramError as e:
+                # Правка не критична: следующий опрос задачи покажет актуальный статус
+                print(f"Не удалось обновить статус: {e}")
+                return
+        else:
+            # Слишком часто: пропускаем, статус пересчитывается на каждом опросе
+            return
+        self._text = text
+        self._edited_at = now
+
+
+def describe_progress(job: dict) -> str:
+    """Текст статуса по состоянию задачи из /jobs/{id}."""
+    if job.get("job_status") == "queued":
+        return f"Запрос в очереди, позиция {job.get('queue_position', '?')}."
+    progress = job.get("progress") or {}
+    stage = progress.get("stage")
+    done, total = progress.get("completed_sections") or 0, progress.get("total_sections")
+    if stage == "sections" and total:
+        text = f"Раздел {done}/{total} готов."
+        if progress.get("current_section") and done < total:
+            text += f"\nСейчас пишу: {progress['current_section']}"
+        return text
+    return STAGE_LABELS.get(stage, "Ищу материалы в базе знаний…")
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list[str]:
+    """Режет длинный текст на сообщения по границам абзацев."""
+    parts, current = [], ""
+    for paragraph in text.split("\n\n"):
+        while len(paragraph) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(paragraph[:limit])
+            paragraph = paragraph[limit:]
+        if current and len(current) + len(paragraph) + 2 > limit:
+            parts.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        parts.append(current)
+    return parts
+
+
+async def send_new_sections(update: Update, job_id: str, last_sent: int) -> int:
+    """Отправляет разделы, готовые после last_sent, и возвращает номер последнего отправленного."""
+    response = await http_client().get(
+        f"{JOBS_URL}/{job_id}/sections", params={"after": last_sent}, timeout=request_timeout("poll")
+    )
+    response.raise_for_status()
+    for section in response.json().get("sections", []):
+        for part in split_message(f"Раздел {section['index'] + 1}: {section['title']}\n\n{section['text']}"):
+            await update.message.reply_text(part)
+        last_sent = section["index"]
+    return last_sent
+
+
+async def wait_for_job(update: Update, payload: dict) -> httpx.Response:
+    """
+    Ставит запрос в очередь /jobs и опрашивает задачу, показывая прогресс в одном сообщении
+    (и, если включено, присылая готовые разделы). Возвращает ответ /jobs/{id}/result или отказ очереди.
+    """
+    client = http_client()
+    submitted = await client.post(JOBS_URL, json=payload, timeout=request_timeout("poll"))
+    if submitted.status_code != 200:
+        return submitted
+    job_id = submitted.json()["job_id"]
+
+    status = StatusMessage(update.message)
+    await status.show(f'Принял запрос: "{payload["query"]}". Ставлю в очередь… (отменить: /cancel)')
+    last_sent = -1
+    deadline = time.monotonic() + REQUEST_TIMEOUTS["document"]
+    while True:
+        response = await client.get(f"{JOBS_URL}/{job_id}", timeout=request_timeout("poll"))
+        response.raise_for_status()
+        job = response.json()
+        if BOT_SEND_SECTIONS:
+            last_sent = await send_new_sections(update, job_id, last_sent)
+        if job["job_status"] in ("completed", "failed"):
+            await status.show("Готово." if job["job_status"] == "completed" else "Не получилось.", force=True)
+            return await client.get(f"{JOBS_URL}/{job_id}/result", timeout=request_timeout("poll"))
+        await status.show(describe_progress(job))
+        if time.monotonic() > deadline:
+            raise httpx.TimeoutException(f"задача {job_id} не завершилась вовремя")
+        await asyncio.sleep(BOT_JOB_POLL_INTERVAL)
+
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отменяет ожидание текущего запроса пользователя."""
+    task = context.user_data.get('inflight')
+    if task is None or task.done():
+        await update.message.reply_text('Сейчас нет запроса в работе.')
+        return
+    context.user_data['cancel_requested'] = True
+    task.cancel()
+
+
 async def process_request(update: Update, context: ContextTypes.DEFAULT_TYPE, user_query: str, request_type: str, template_name: str = None) -> None:
     """Универсальная функция для отправки запроса на API и обработки ответа."""
-    await update.message.reply_text(f'Принял запрос: "{user_query}". Начинаю обработку...')
+    if context.user_data.get('inflight') is not None:
+        await update.message.reply_text('Предыдущий запрос ещё выполняется. Дождись ответа или отмени его командой /cancel.')
+        return
+    use_jobs = BOT_USE_JOBS and request_type == "document"
+    if not use_jobs:
+        await update.message.reply_text(f'Принял запрос: "{user_query}". Начинаю обработку... (отменить: /cancel)')
     if template_name:
         await update.message.reply_text(f'Использую шаблон: {template_name}')
     
-    docx_path = None
-    
     try:
         # Готовим payload для API
-        payload = {"query": user_query, "request_type": request_type}
+        payload = {
+            "query": user_query,
+            "request_type": request_type,
+            "author": update.effective_user.username or update.effective_user.full_name,
+        }
         if template_name:
             payload["template_name"] = template_name
+        if request_type == "document":
+            payload["output_format"] = BOT_OUTPUT_FORMAT
 
-        response = requests.post(ORCHESTRATOR_URL, json=payload)
+        async with chat_action(update, ChatAction.TYPING):
+            if use_jobs:
+                response = await run_cancellable(context, wait_for_job(update, payload))
+            else:
+                response = await run_cancellable(
+                    context,
+                    http_client().post(ORCHESTRATOR_URL, json=payload, timeout=request_timeout(request_type)),
+                )
+        if response.status_code == 429:
+            # Превышена квота пользователя или сервер перегружен: API подсказывает, когда повторить
+            rejection = response.json()
+            await update.message.reply_text(
+                f'{rejection.get("message", "Сервер перегружен.")} '
+                f'Повторите запрос примерно через {rejection.get("retry_after", 60)} с.'
+            )
+            return
         response.raise_for_status()
         
         result_info = response.json()
@@ -62,12 +368,16 @@ async def process_request(update: Update, context: ContextTypes.DEFAULT_TYPE, us
                 await update.message.reply_text(f'**Определение термина "{term}":**\n\n{definition}', parse_mode='Markdown')
 
             elif result_type == "document":
-                docx_path = result_info.get("file_path")
-                if docx_path and os.path.exists(docx_path):
-                    with open(docx_path, 'rb') as doc:
-                        await update.message.reply_document(document=doc, caption="Готово! Ваш документ.")
+                # files — все запрошенные форматы; у старых версий API есть только ссылка на DOCX
+                files = list((result_info.get("files") or {}).values()) or [result_info]
+                if files[0].get("download_url"):
+                    async with chat_action(update, ChatAction.UPLOAD_DOCUMENT):
+                        for info in files:
+                            doc = await run_cancellable(context, download_document(info["download_url"]))
+                            filename = info.get("filename") or "document.docx"
+                            await update.message.reply_document(document=doc, filename=filename, caption="Готово! Ваш документ.")
                 else:
-                    await update.message.reply_text("Сервер сообщил об успехе, но файл не найден.")
+                    await update.message.reply_text("Сервер сообщил об успехе, но не вернул ссылку на файл.")
             elif result_type == "qa":
                 answer = result_info.get("answer", "")
                 if not answer:
@@ -77,15 +387,15 @@ async def process_request(update: Update, context: ContextTypes.DEFAULT_TYPE, us
             error_message = result_info.get("message", "Неизвестная ошибка на сервере.")
             await update.message.reply_text(f'Не удалось обработать запрос. Причина: {error_message}')
 
+    except RequestCancelled:
+        await update.message.reply_text('Запрос отменён.')
+    except httpx.TimeoutException:
+        await update.message.reply_text(
+            f'Сервер не ответил за {REQUEST_TIMEOUTS.get(request_type, REQUEST_TIMEOUTS["document"]):.0f} с. Попробуй позже.'
+        )
     except Exception as e:
         await update.message.reply_text(f'Произошла ошибка связи с сервером: {e}')
         print(f"--- ОШИБКА В БОТЕ ---\n{e}")
-    
-    finally:
-        # Удаляем временный файл, если он был создан
-        if docx_path and os.path.exists(docx_path):
-            os.remove(docx_path)
-            print("Временный файл удален.")
 
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -188,7 +498,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                 }
 
                 try:
-                    resp = requests.post(FEEDBACK_URL, json=payload)
+                    resp = await http_client().post(FEEDBACK_URL, json=payload, timeout=request_timeout("feedback"))
                     resp.raise_for_status()
                     info = resp.json()
                     if info.get('status') == 'success':
@@ -235,10 +545,25 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
 
 if __name__ == '__main__':
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).connect_timeout(30.0).read_timeout(30.0).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .connect_timeout(30.0)
+        .read_timeout(30.0)
+        .concurrent_updates(PerUserUpdateProcessor(BOT_CONCURRENT_UPDATES))
+        .post_init(open_http_client)
+        .post_shutdown(close_http_client)
+        .build()
+    )
     
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     
-    print("Telegram-бот запущен...")
-    application.run_polling()
\ No newline at end of file
+    if BOT_MODE == "webhook":
+        from bot_webhook import run_webhook
+        print("Telegram-бот запущен в режиме webhook...")
+        run_webhook(application)
+    else:
+        print("Telegram-бот запущен...")
+        application.run_polling()
\ No newline at end of file
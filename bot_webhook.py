@@ -0,0 +1,159 @@
+# bot_webhook.py
+# Режим webhook для Telegram-бота (BOT_MODE=webhook): Telegram сам присылает обновления на
+# BOT_WEBHOOK_URL + BOT_WEBHOOK_PATH (например, через ngrok), бот сразу отвечает 200 и
+# обрабатывает их параллельно через очередь Application.
+#
+# Несколько реплик: состояние диалога (шаги правки, текущий запрос) хранится в памяти реплики,
+# поэтому все обновления пользователя должны попадать на одну и ту же реплику. Реплика, получившая
+# чужое обновление, пересылает его владельцу — реплике с номером user_id % len(BOT_REPLICAS).
+# Номер реплики задаётся BOT_REPLICA_INDEX или определяется по адресу контейнера в BOT_REPLICAS,
+# поэтому одинаковые реплики можно поднимать через docker compose --scale bot=N.
+import os
+import socket
+import httpx
+import uvicorn
+from contextlib import asynccontextmanager
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from urllib.parse import urlparse
+from telegram import Update
+from telegram.ext import Application
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Публичный адрес, на который Telegram шлёт обновления (например, https://xxxx.ngrok-free.app)
+BOT_WEBHOOK_URL = os.getenv("BOT_WEBHOOK_URL", "").rstrip("/")
+BOT_WEBHOOK_PATH = os.getenv("BOT_WEBHOOK_PATH", "/telegram")
+# Секрет, который Telegram передаёт в заголовке каждого запроса; без него чужие запросы не отличить,
+# поэтому без секрета webhook не запускается
+BOT_WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET", "")
+BOT_WEBHOOK_LISTEN = os.getenv("BOT_WEBHOOK_LISTEN", "0.0.0.0")
+BOT_WEBHOOK_PORT = int(os.getenv("BOT_WEBHOOK_PORT", "8080"))
+# Сколько одновременных соединений Telegram открывает к webhook (1–100)
+BOT_WEBHOOK_MAX_CONNECTIONS = int(os.getenv("BOT_WEBHOOK_MAX_CONNECTIONS", "40"))
+# Внутренние адреса всех реплик через запятую (в одном порядке на всех репликах) и номер текущей
+BOT_REPLICAS = [u.strip().rstrip("/") for u in os.getenv("BOT_REPLICAS", "").split(",") if u.strip()]
+# Не задан — определяется при старте (detect_replica_index)
+BOT_REPLICA_INDEX = int(os.getenv("BOT_REPLICA_INDEX") or "0")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+FORWARDED_HEADER = "X-Bot-Forwarded"
+
+
+def update_user_id(data: dict) -> int | None:
+    """Id пользователя из сырого обновления: message, callback_query и т.п. содержат поле from."""
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("chat")
+            if isinstance(sender, dict) and sender.get("id") is not None:
+                return int(sender["id"])
+    return None
+
+
+def _addresses(host: str) -> set[str]:
+    try:
+        return {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except socket.gaierror:
+        return set()
+
+
+def detect_replica_index() -> int:
+    """Номер текущей реплики: из BOT_REPLICA_INDEX или по совпадению адреса контейнера с адресом из BOT_REPLICAS."""
+    if os.getenv("BOT_REPLICA_INDEX"):
+        return int(os.getenv("BOT_REPLICA_INDEX"))
+    if len(BOT_REPLICAS) < 2:
+        return 0
+    own = _addresses(socket.gethostname())
+    for index, url in enumerate(BOT_REPLICAS):
+        if own & _addresses(urlparse(url).hostname or ""):
+            return index
+    raise SystemExit(
+        f"Не удалось определить номер реплики: адреса {sorted(own)} не совпадают ни с одним из BOT_REPLICAS. "
+        "Задайте BOT_REPLICA_INDEX явно."
+    )
+
+
+def owner_replica(user_id: int | None) -> int:
+    """Номер реплики, которая ведёт диалоги этого пользователя."""
+    if user_id is None or len(BOT_REPLICAS) < 2:
+        return BOT_REPLICA_INDEX
+    return user_id % len(BOT_REPLICAS)
+
+
+def create_webhook_app(application: Application) -> Starlette:
+    @asynccontextmanager
+    async def lifespan(app: Starlette):
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        # Webhook регистрирует одна реплика, остальные получают обновления пересылкой или через балансировщик
+        if BOT_WEBHOOK_URL and BOT_REPLICA_INDEX == 0:
+            await application.bot.set_webhook(
+                url=f"{BOT_WEBHOOK_URL}{BOT_WEBHOOK_PATH}",
+                secret_token=BOT_WEBHOOK_SECRET,
+                max_connections=BOT_WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            print(f"Webhook зарегистрирован: {BOT_WEBHOOK_URL}{BOT_WEBHOOK_PATH}")
+        await application.start()
+        async with httpx.AsyncClient(timeout=httpx.Timeout(10.0)) as forward_client:
+            app.state.forward_client = forward_client
+            yield
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+    async def receive_update(request: Request) -> Response:
+        if request.headers.get(SECRET_HEADER) != BOT_WEBHOOK_SECRET:
+            return JSONResponse({"status": "error", "message": "Неверный секрет webhook."}, status_code=403)
+        data = await request.json()
+
+        owner = owner_replica(update_user_id(data))
+        # Пересланное обновление обрабатываем на месте, даже если списки реплик разошлись: так нет циклов
+        if owner != BOT_REPLICA_INDEX and not request.headers.get(FORWARDED_HEADER):
+            try:
+                response = await request.app.state.forward_client.post(
+                    f"{BOT_REPLICAS[owner]}{BOT_WEBHOOK_PATH}",
+                    json=data,
+                    headers={SECRET_HEADER: BOT_WEBHOOK_SECRET, FORWARDED_HEADER: str(BOT_REPLICA_INDEX)},
+                )
+                response.raise_for_status()
+                return Response(status_code=200)
+            except httpx.HTTPError as e:
+                # Реплика-владелец недоступна: лучше обработать здесь, чем потерять обновление
+                print(f"Не удалось переслать обновление реплике {owner}: {e}. Обрабатываю локально.")
+
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return Response(status_code=200)
+
+    async def health(request: Request) -> Response:
+        return JSONResponse({
+            "status": "Bot webhook is running",
+            "replica": BOT_REPLICA_INDEX,
+            "replicas": len(BOT_REPLICAS) or 1,
+            "queued_updates": application.update_queue.qsize(),
+        })
+
+    return Starlette(
+        routes=[
+            Route(BOT_WEBHOOK_PATH, receive_update, methods=["POST"]),
+            Route("/", health, methods=["GET"]),
+        ],
+        lifespan=lifespan,
+    )
+
+
+def run_webhook(application: Application) -> None:
+    global BOT_REPLICA_INDEX
+    if not BOT_WEBHOOK_SECRET:
+        # Без секрета любой, кто знает адрес, может прислать поддельное обновление от имени любого пользователя
+        raise SystemExit("BOT_WEBHOOK_SECRET не задан: режим webhook без секрета не запускается.")
+    BOT_REPLICA_INDEX = detect_replica_index()
+    print(f"Реплика бота {BOT_REPLICA_INDEX} из {len(BOT_REPLICAS) or 1}.")
+    if not BOT_WEBHOOK_URL and BOT_REPLICA_INDEX == 0:
+        print("ВНИМАНИЕ: BOT_WEBHOOK_URL не задан, webhook в Telegram не регистрируется.")
+    uvicorn.run(create_webhook_app(application), host=BOT_WEBHOOK_LISTEN, port=BOT_WEBHOOK_PORT)
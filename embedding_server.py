@@ -0,0 +1,50 @@
+# embedding_server.py
+# Общий сервер эмбеддингов для нескольких воркеров API (EMBEDDINGS_BACKEND=remote).
+# Модель GPT4All загружается один раз, одиночные embed_query от всех воркеров склеиваются в микро-батчи.
+# Запуск: python -m uvicorn embedding_server:app --host 127.0.0.1 --port 8100
+import threading
+from fastapi import FastAPI
+from pydantic import BaseModel
+
+from services.embedding_service import MicroBatcher
+from langchain_community.embeddings import GPT4AllEmbeddings
+
+app = FastAPI(title="Smart Writer Embedding Server")
+
+print("Инициализирую модель GPT4All для эмбеддингов...")
+embedding_model = GPT4AllEmbeddings()
+print("Модель GPT4All готова к работе.")
+
+# Модель не рассчитана на одновременные вызовы из разных потоков
+_model_lock = threading.Lock()
+
+
+def _embed_batch(texts: list[str]) -> list[list[float]]:
+    with _model_lock:
+        return embedding_model.embed_documents(texts)
+
+
+batcher = MicroBatcher(_embed_batch)
+
+
+class QueryModel(BaseModel):
+    text: str
+
+class DocumentsModel(BaseModel):
+    texts: list[str]
+
+
+@app.get("/")
+def read_root():
+    return {"status": "Embedding server is running", **batcher.stats()}
+
+# Синхронные обработчики выполняются в пуле потоков FastAPI, поэтому одновременные
+# запросы успевают попасть в один батч
+@app.post("/embed_query")
+def embed_query(request: QueryModel):
+    return {"embedding": batcher.embed(request.text)}
+
+@app.post("/embed_documents")
+def embed_documents(request: DocumentsModel):
+    # Индексация приходит уже батчем, склеивать её с запросами не нужно
+    return {"embeddings": _embed_batch(request.texts)}
@@ -0,0 +1,81 @@
+# loadtest/bench_docx.py
+# Бенчмарк сборки DOCX на синтетическом Markdown (заголовки, абзацы, списки, таблицы, код):
+# прежний способ (новый Document() и весь текст одним абзацем) против рендера по разметке
+# на клоне базового документа ГОСТ.
+#
+# Запуск: python -m loadtest.bench_docx --lines 10000 --repeat 3
+import io
+import time
+import random
+import argparse
+
+from docx import Document
+
+from services import docx_renderer
+
+
+def build_markdown(lines: int, seed: int) -> str:
+    rnd = random.Random(seed)
+    out: list[str] = []
+    section = 0
+    while len(out) < lines:
+        section += 1
+        out += [f"## {section}. Раздел технического задания", ""]
+        for _ in range(rnd.randint(2, 5)):
+            out += [f"Система **АСУ ПГР** обеспечивает *контроль* выполнения плана горных работ, "
+                    f"показатель `{rnd.randint(1, 999)}` фиксируется в журнале смены. " * rnd.randint(1, 3), ""]
+        out += [f"- требование {section}.{i}: обработка данных диспетчеризации" for i in range(rnd.randint(3, 8))]
+        out += ["", f"1. Шаг {section}.1", f"2. Шаг {section}.2", "   - уточнение шага", ""]
+        if section % 3 == 0:
+            out += ["| Параметр | Значение | Единица |", "|---|---|---|"]
+            out += [f"| Показатель {j} | {rnd.randint(1, 1000)} | т |" for j in range(rnd.randint(3, 10))]
+            out += [""]
+        if section % 5 == 0:
+            out += ["```", "SELECT shift_id, SUM(volume) FROM trips GROUP BY shift_id;", "```", ""]
+    return "\n".join(out[:lines])
+
+
+def naive(content: str, title: str) -> bytes:
+    doc = Document()
+    doc.add_heading(title, 0)
+    doc.add_paragraph(content)
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def measure(fn, content: str, repeat: int) -> tuple[float, int]:
+    best, size = float("inf"), 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        size = len(fn(content, "Техническое задание"))
+        best = min(best, time.perf_counter() - started)
+    return best, size
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк рендера Markdown -> DOCX.")
+    parser.add_argument("--lines", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    content = build_markdown(args.lines, args.seed)
+    print(f"Markdown: {args.lines} строк, {len(content)} символов")
+
+    started = time.perf_counter()
+    docx_renderer.base_template_bytes()
+    print(f"Базовый документ ГОСТ (один раз на процесс): {time.perf_counter() - started:.3f} с")
+
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        Document(io.BytesIO(docx_renderer.base_template_bytes()))
+    print(f"Клон базового документа из байтов: {(time.perf_counter() - started) / args.repeat * 1000:.1f} мс")
+
+    for name, fn in (("одним абзацем (прежний)", naive), ("рендер Markdown", docx_renderer.render)):
+        seconds, size = measure(fn, content, args.repeat)
+        print(f"{name:<26} {seconds:7.3f} с  {size / 1024:8.1f} КБ  {args.lines / seconds:9.0f} строк/с")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# loadtest/bench_export.py
+# Бенчмарк выгрузки больших сгенерированных документов в DOCX, PDF и HTML: время разбора Markdown,
+# время и пиковая память рендера каждого формата (каждый замер — в отдельном свежем процессе, чтобы
+# пики не смешивались) и время выгрузки всех форматов сразу: последовательно против пула процессов.
+#
+# Запуск: python -m loadtest.bench_export --lines 10000,50000 --repeat 3
+import os
+import time
+import argparse
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    # Windows: пиковый RSS недоступен, остаётся пик аллокаций Python
+    resource = None
+
+from loadtest.bench_docx import build_markdown
+from services import export_service, markdown_tree
+
+
+def _max_rss_mb() -> float:
+    # ru_maxrss в Linux — в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else 0.0
+
+
+def measure_format(fmt: str, content: str, repeat: int) -> dict:
+    """Выполняется в отдельном процессе: шрифты и стили готовятся до замеров, как в пуле экспорта."""
+    export_service._warm_up_worker()
+    blocks = markdown_tree.parse(content)
+    rss_before = _max_rss_mb()
+    best, size = float("inf"), 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        size = len(export_service._render(fmt, blocks, "Техническое задание"))
+        best = min(best, time.perf_counter() - started)
+    rss_peak = _max_rss_mb() - rss_before
+
+    tracemalloc.start()
+    export_service._render(fmt, blocks, "Техническое задание")
+    _, py_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": best, "size": size, "rss_peak_mb": rss_peak, "py_peak_mb": py_peak / 1024 / 1024}
+
+
+def in_fresh_process(fn, *args):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(fn, *args).result()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарк выгрузки Markdown в DOCX/PDF/HTML.")
+    parser.add_argument("--lines", default="10000,50000", help="Размеры документов в строках через запятую")
+    parser.add_argument("--formats", default="all", help='Форматы через запятую или "all"')
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    formats = export_service.parse_formats(args.formats)
+
+    started = time.perf_counter()
+    export_service.warm_up()
+    # На одном ядре пул не ускоряет выгрузку: форматы всё равно рендерятся по очереди
+    print(f"Запуск пула ({export_service.EXPORT_RENDER_PROCESSES} процессов, ядер: {os.cpu_count()}) "
+          f"со шрифтами и стилями: {time.perf_counter() - started:.2f} с")
+
+    for lines in (int(value) for value in args.lines.split(",")):
+        content = build_markdown(lines, args.seed)
+        started = time.perf_counter()
+        blocks = markdown_tree.parse(content)
+        parse_seconds = time.perf_counter() - started
+        print(f"\nMarkdown: {lines} строк, {len(content)} символов, {len(blocks)} блоков, разбор {parse_seconds:.3f} с")
+
+        print(f"{'формат':<6} {'время, с':>9} {'размер, КБ':>11} {'пик RSS, МБ':>12} {'пик Python, МБ':>15}")
+        sequential = parse_seconds
+        for fmt in formats:
+            result = in_fresh_process(measure_format, fmt, content, args.repeat)
+            sequential += result["seconds"]
+            print(f"{fmt:<6} {result['seconds']:9.3f} {result['size'] / 1024:11.1f} "
+                  f"{result['rss_peak_mb']:12.1f} {result['py_peak_mb']:15.1f}")
+
+        best = float("inf")
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            export_service.render_formats(content, "Техническое задание", formats)
+            best = min(best, time.perf_counter() - started)
+        print(f"Все форматы: последовательно {sequential:.3f} с, пул процессов {best:.3f} с "
+              f"(включая разбор и передачу дерева в процессы)")
+
+
+if __name__ == "__main__":
+    main()
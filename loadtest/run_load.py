@@ -0,0 +1,194 @@
+# loadtest/run_load.py
+# Нагрузочный прогон API по сценарию: смесь запросов (термин, вопрос, ТЗ, руководство, правка)
+# к /process и /feedback при растущем числе одновременных клиентов. Для каждой ступени
+# считаются пропускная способность, доля ошибок и отказов (429) и перцентили задержки —
+# по ним проверяются требования tech_req.md §4.1 (10 одновременных генераций, 50 пользователей).
+#
+# Типовой прогон без внешних сервисов:
+#   python -m uvicorn loadtest.stub_llm:app --port 8900
+#   CHROMA_DB_DIR=./loadtest/chroma_db EMBEDDINGS_BACKEND=stub python -m loadtest.seed_index
+#   CHROMA_DB_DIR=./loadtest/chroma_db EMBEDDINGS_BACKEND=stub LLM_FALLBACK_PROVIDER= \
+#       OPENROUTER_API_URL=http://127.0.0.1:8900/api/v1/chat/completions python -m uvicorn main:app --port 8000
+#   python -m loadtest.run_load --concurrency 1,5,10,20,50 --duration 60
+import os
+import json
+import time
+import random
+import argparse
+import threading
+from datetime import datetime
+
+import requests
+
+TERMS = ["ГГИС", "АСУ ПГР", "цифровой двойник", "диспетчеризация", "маркшейдерия"]
+QUESTIONS = [
+    "Как оператор формирует сменный отчёт?",
+    "Какие роли пользователей есть в АСУ ПГР?",
+    "Что делать при ошибке синхронизации с ГГИС?",
+    "Как выполняется сверка плана с маркшейдерскими данными?",
+]
+TZ_QUERIES = ["Техническое задание на АСУ ПГР", "ТЗ на модуль интеграции с ГГИС"]
+MANUAL_QUERIES = ["Руководство пользователя АСУ ПГР для оператора", "Руководство пользователя модуля отчётности"]
+
+# Доли запросов каждого вида в сценарии
+MIXES = {
+    "default": {"term": 0.3, "qa": 0.35, "tz": 0.05, "manual": 0.05, "feedback": 0.25},
+    "documents": {"tz": 0.5, "manual": 0.5},
+    "interactive": {"term": 0.5, "qa": 0.5},
+}
+
+
+def build_request(kind: str, rnd: random.Random, client_id: int, seq: int, unique: bool) -> tuple[str, dict]:
+    """Возвращает (путь, тело) запроса. unique добавляет номер, чтобы не срабатывало объединение одинаковых запросов."""
+    author = f"load-user-{client_id}"
+    suffix = f" (нагрузка {client_id}-{seq})" if unique else ""
+    if kind == "term":
+        return "/process", {"query": rnd.choice(TERMS) + suffix, "request_type": "term", "author": author}
+    if kind == "qa":
+        return "/process", {"query": rnd.choice(QUESTIONS) + suffix, "request_type": "document", "author": author}
+    if kind == "tz":
+        return "/process", {"query": rnd.choice(TZ_QUERIES) + suffix, "request_type": "document", "author": author}
+    if kind == "manual":
+        return "/process", {"query": rnd.choice(MANUAL_QUERIES) + suffix, "request_type": "document", "author": author}
+    if kind == "feedback":
+        return "/feedback", {
+            "author": author, "doc_type": "ТЗ", "doc_ref": "4. Требования к Системе",
+            "operation": "comment", "comment": f"Нагрузочная правка {client_id}-{seq}",
+        }
+    raise ValueError(f"Неизвестный вид запроса: {kind}")
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)
+
+
+def _client(base_url: str, mix: dict, client_id: int, seed: int, stop_at: float, max_requests: int | None,
+            timeout: float, unique: bool, results: list, lock: threading.Lock) -> None:
+    rnd = random.Random(seed * 1000 + client_id)
+    kinds, weights = zip(*mix.items())
+    session = requests.Session()
+    seq = 0
+    while time.monotonic() < stop_at and (max_requests is None or seq < max_requests):
+        kind = rnd.choices(kinds, weights)[0]
+        path, payload = build_request(kind, rnd, client_id, seq, unique)
+        seq += 1
+        started = time.monotonic()
+        outcome = "ok"
+        try:
+            response = session.post(base_url + path, json=payload, timeout=timeout)
+            if response.status_code == 429:
+                outcome = "rejected"
+            elif response.status_code != 200 or response.json().get("status") != "success":
+                outcome = "error"
+        except requests.exceptions.Timeout:
+            outcome = "timeout"
+        except (requests.exceptions.RequestException, ValueError):
+            outcome = "error"
+        with lock:
+            results.append({"kind": kind, "outcome": outcome, "latency": time.monotonic() - started})
+
+
+def summarize(records: list[dict], elapsed: float) -> dict:
+    ok = [r["latency"] for r in records if r["outcome"] == "ok"]
+    total = len(records)
+    return {
+        "requests": total,
+        "throughput_rps": round(len(ok) / elapsed, 3) if elapsed else None,
+        "error_rate": round(sum(r["outcome"] in ("error", "timeout") for r in records) / total, 4) if total else None,
+        "rejected_rate": round(sum(r["outcome"] == "rejected" for r in records) / total, 4) if total else None,
+        "p50": percentile(ok, 0.50),
+        "p90": percentile(ok, 0.90),
+        "p95": percentile(ok, 0.95),
+        "p99": percentile(ok, 0.99),
+        "max": round(max(ok), 3) if ok else None,
+    }
+
+
+def run_step(base_url: str, mix: dict, clients: int, duration: float, max_requests: int | None,
+             timeout: float, seed: int, unique: bool) -> dict:
+    results: list[dict] = []
+    lock = threading.Lock()
+    started = time.monotonic()
+    stop_at = started + duration
+    threads = [
+        threading.Thread(
+            target=_client,
+            args=(base_url, mix, i, seed, stop_at, max_requests, timeout, unique, results, lock),
+            daemon=True,
+        )
+        for i in range(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    step = {"clients": clients, "elapsed_s": round(elapsed, 1), **summarize(results, elapsed), "by_kind": {}}
+    for kind in mix:
+        kind_records = [r for r in results if r["kind"] == kind]
+        if kind_records:
+            step["by_kind"][kind] = summarize(kind_records, elapsed)
+    return step
+
+
+def print_step(step: dict) -> None:
+    def fmt(value):
+        return "-" if value is None else value
+    print(
+        f"{step['clients']:>7} | {step['requests']:>8} | {fmt(step['throughput_rps']):>8} | "
+        f"{fmt(step['error_rate']):>6} | {fmt(step['rejected_rate']):>6} | {fmt(step['p50']):>7} | "
+        f"{fmt(step['p95']):>7} | {fmt(step['p99']):>7} | {fmt(step['max']):>7}"
+    )
+    for kind, summary in step["by_kind"].items():
+        print(f"{'':>7}   {kind:<10} n={summary['requests']} err={fmt(summary['error_rate'])} "
+              f"p50={fmt(summary['p50'])} p95={fmt(summary['p95'])}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон /process и /feedback по ступеням числа клиентов.")
+    parser.add_argument("--base-url", default=os.getenv("LOADTEST_BASE_URL", "http://127.0.0.1:8000"))
+    parser.add_argument("--mix", default="default", help=f"сценарий: {', '.join(MIXES)}")
+    parser.add_argument("--mix-file", help="JSON с долями запросов вида {\"term\": 0.5, \"qa\": 0.5}")
+    parser.add_argument("--concurrency", default="1,5,10,20,50", help="ступени числа одновременных клиентов")
+    parser.add_argument("--duration", type=float, default=60, help="длительность ступени, с")
+    parser.add_argument("--requests-per-client", type=int, help="ограничить число запросов клиента на ступени")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-unique", action="store_true", help="не делать запросы уникальными (проверка объединения)")
+    parser.add_argument("--output", help="куда сохранить JSON-отчёт (по умолчанию loadtest/results/)")
+    args = parser.parse_args()
+
+    if args.mix_file:
+        with open(args.mix_file, "r", encoding="utf-8") as f:
+            mix = json.load(f)
+    else:
+        mix = MIXES[args.mix]
+
+    steps = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    print(f"Сценарий: {mix}\nAPI: {args.base_url}\n")
+    print(" clients | requests |  req/s   | errors | 429    |   p50   |   p95   |   p99   |   max")
+    report = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "base_url": args.base_url,
+        "mix": mix,
+        "steps": [],
+    }
+    for clients in steps:
+        step = run_step(args.base_url, mix, clients, args.duration, args.requests_per_client,
+                        args.timeout, args.seed, not args.no_unique)
+        report["steps"].append(step)
+        print_step(step)
+
+    output = args.output or os.path.join("loadtest", "results", f"{datetime.now().strftime('%Y%m%dT%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nОтчёт сохранён: {output}")
+
+
+if __name__ == "__main__":
+    main()
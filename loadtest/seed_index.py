@@ -0,0 +1,70 @@
+# loadtest/seed_index.py
+# Синтетическая база знаний для нагрузочных тестов: детерминированный набор чанков про АСУ ПГР,
+# проиндексированный эмбеддингами-заглушками. Запускать с теми же CHROMA_DB_DIR и
+# EMBEDDINGS_BACKEND=stub, что и API под нагрузкой.
+#
+# Запуск: CHROMA_DB_DIR=./loadtest/chroma_db EMBEDDINGS_BACKEND=stub python -m loadtest.seed_index --chunks 2000
+import argparse
+import random
+from datetime import datetime
+
+import chromadb
+
+from services.embedding_service import StubEmbeddings
+from services.knowledge_service import CHROMA_DB_DIR
+
+TOPICS = [
+    ("ГГИС", "горно-геологическая информационная система, хранит блочные модели и данные опробования"),
+    ("АСУ ПГР", "автоматизированная система управления планированием горных работ"),
+    ("цифровой двойник", "модель карьера, синхронизируемая с данными диспетчеризации и маркшейдерии"),
+    ("диспетчеризация", "контроль работы экскаваторов и самосвалов в реальном времени"),
+    ("маркшейдерия", "съёмка и учёт объёмов горной массы, сверка с планом"),
+    ("отчётность", "сменные, суточные и месячные отчёты по выполнению плана"),
+    ("роли пользователей", "оператор, инженер-планировщик, маркшейдер, администратор"),
+    ("интеграции", "обмен данными с ERP, ГГИС и системой диспетчеризации по REST и файловому обмену"),
+]
+FILLER = ("Система обеспечивает ввод, проверку и хранение данных, формирование планов и контроль их выполнения. "
+          "Требования к надёжности включают резервное копирование и восстановление после сбоев. ")
+
+
+def build_chunks(count: int, seed: int) -> list[str]:
+    rnd = random.Random(seed)
+    chunks = []
+    for i in range(count):
+        term, definition = TOPICS[i % len(TOPICS)]
+        body = " ".join(FILLER for _ in range(rnd.randint(2, 6)))
+        chunks.append(f"{term} — {definition}. Фрагмент {i}. {body}")
+    return chunks
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Индексирует синтетическую базу знаний для нагрузочных тестов.")
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--batch", type=int, default=500)
+    args = parser.parse_args()
+
+    client = chromadb.PersistentClient(path=CHROMA_DB_DIR)
+    try:
+        client.delete_collection(name="asupgr_knowledge")
+    except Exception:
+        pass
+    collection = client.get_or_create_collection(
+        name="asupgr_knowledge",
+        metadata={"indexed_at": datetime.now().isoformat(timespec="seconds")},
+    )
+
+    embedder = StubEmbeddings()
+    chunks = build_chunks(args.chunks, args.seed)
+    for start in range(0, len(chunks), args.batch):
+        batch = chunks[start:start + args.batch]
+        collection.add(
+            documents=batch,
+            embeddings=embedder.embed_documents(batch),
+            ids=[str(start + i) for i in range(len(batch))],
+        )
+    print(f"Синтетическая база знаний готова: {len(chunks)} чанков в {CHROMA_DB_DIR}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# loadtest/stub_llm.py
+# Заглушка OpenAI-совместимого API (/api/v1/chat/completions) для нагрузочных тестов без OpenRouter.
+# Задержка до первого токена и скорость генерации берутся из настраиваемых распределений,
+# поддерживаются потоковый (SSE) и обычный режимы, а также доля ошибок 429/503.
+#
+# Запуск:   python -m uvicorn loadtest.stub_llm:app --port 8900
+# В .env API: OPENROUTER_API_URL=http://127.0.0.1:8900/api/v1/chat/completions
+import os
+import json
+import math
+import time
+import random
+import asyncio
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# fixed | uniform | lognormal — распределение времени до первого токена
+STUB_TTFT_DIST = os.getenv("STUB_TTFT_DIST", "lognormal")
+STUB_TTFT_MEDIAN = float(os.getenv("STUB_TTFT_MEDIAN", "1.0"))
+STUB_TTFT_SIGMA = float(os.getenv("STUB_TTFT_SIGMA", "0.5"))  # для lognormal; для uniform — ±доля медианы
+STUB_TOKENS_PER_SEC = float(os.getenv("STUB_TOKENS_PER_SEC", "50"))
+STUB_COMPLETION_TOKENS = int(os.getenv("STUB_COMPLETION_TOKENS", "400"))
+STUB_ERROR_RATE = float(os.getenv("STUB_ERROR_RATE", "0"))
+STUB_RATE_LIMIT_RATE = float(os.getenv("STUB_RATE_LIMIT_RATE", "0"))
+STUB_CHUNK_TOKENS = int(os.getenv("STUB_CHUNK_TOKENS", "8"))
+STUB_SEED = os.getenv("STUB_SEED")
+
+_random = random.Random(int(STUB_SEED)) if STUB_SEED else random.Random()
+
+app = FastAPI(title="Stub OpenAI-compatible LLM")
+
+_stats = {"requests": 0, "errors": 0, "rate_limited": 0, "in_flight": 0, "max_in_flight": 0}
+
+
+def sample_ttft() -> float:
+    if STUB_TTFT_DIST == "fixed":
+        return STUB_TTFT_MEDIAN
+    if STUB_TTFT_DIST == "uniform":
+        spread = STUB_TTFT_MEDIAN * STUB_TTFT_SIGMA
+        return max(0.0, _random.uniform(STUB_TTFT_MEDIAN - spread, STUB_TTFT_MEDIAN + spread))
+    return _random.lognormvariate(math.log(STUB_TTFT_MEDIAN), STUB_TTFT_SIGMA)
+
+
+def _prompt_tokens(messages: list[dict]) -> int:
+    return sum(len(m.get("content") or "") for m in messages) // 3
+
+
+def _completion_text(tokens: int) -> list[str]:
+    # Текст с разметкой, похожей на ответ модели: заголовки, абзацы, списки
+    words = ["Система", "обеспечивает", "обработку", "данных", "в", "соответствии", "с", "требованиями",
+             "АСУ", "ПГР", "и", "регламентом", "эксплуатации", "оператора"]
+    parts = ["## Раздел (ответ заглушки)\n\n"]
+    for i in range(tokens - 1):
+        parts.append(words[i % len(words)] + (".\n\n" if i % 40 == 39 else " "))
+    return parts
+
+
+def _error_response():
+    roll = _random.random()
+    if roll < STUB_RATE_LIMIT_RATE:
+        _stats["rate_limited"] += 1
+        return JSONResponse(status_code=429, content={"error": {"message": "stub rate limit"}}, headers={"Retry-After": "2"})
+    if roll < STUB_RATE_LIMIT_RATE + STUB_ERROR_RATE:
+        _stats["errors"] += 1
+        return JSONResponse(status_code=503, content={"error": {"message": "stub upstream error"}})
+    return None
+
+
+@app.get("/")
+def read_root():
+    return {"status": "Stub LLM is running", **_stats}
+
+
+@app.post("/api/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    _stats["requests"] += 1
+    error = _error_response()
+    if error is not None:
+        return error
+
+    model = body.get("model", "stub-model")
+    prompt_tokens = _prompt_tokens(body.get("messages", []))
+    completion_tokens = int(body.get("max_tokens") or STUB_COMPLETION_TOKENS)
+    completion_tokens = min(completion_tokens, STUB_COMPLETION_TOKENS)
+    parts = _completion_text(completion_tokens)
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+             "total_tokens": prompt_tokens + completion_tokens, "cost": 0.0}
+    ttft = sample_ttft()
+
+    if not body.get("stream"):
+        _stats["in_flight"] += 1
+        _stats["max_in_flight"] = max(_stats["max_in_flight"], _stats["in_flight"])
+        try:
+            await asyncio.sleep(ttft + completion_tokens / STUB_TOKENS_PER_SEC)
+        finally:
+            _stats["in_flight"] -= 1
+        return {
+            "id": f"stub-{time.time_ns()}",
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(parts)}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+    async def events():
+        _stats["in_flight"] += 1
+        _stats["max_in_flight"] = max(_stats["max_in_flight"], _stats["in_flight"])
+        try:
+            await asyncio.sleep(ttft)
+            for i in range(0, len(parts), STUB_CHUNK_TOKENS):
+                chunk = {"model": model, "choices": [{"index": 0, "delta": {"content": "".join(parts[i:i + STUB_CHUNK_TOKENS])}}]}
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                await asyncio.sleep(STUB_CHUNK_TOKENS / STUB_TOKENS_PER_SEC)
+            final = {"model": model, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+            yield f"data: {json.dumps(final)}\n\n"
+            yield "data: [DONE]\n\n"
+        finally:
+            _stats["in_flight"] -= 1
+
+    return StreamingResponse(events(), media_type="text/event-stream")
@@ -1,23 +1,27 @@
 # main.py (ВЕРСИЯ С ЖЕСТКИМ ПОШАГОВЫМ ПРОМТОМ ДЛЯ ШАБЛОНОВ)
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 import os
+import uuid
 from datetime import datetime
 from dotenv import load_dotenv
 
-# Для чтения .docx файлов
-try:
-    from docx import Document
-except ImportError:
-    print("ОШИБКА: Библиотека 'python-docx' не найдена. Выполните 'pip install python-docx'")
-    # Создаем фиктивный класс, чтобы не сломался импорт
-    class Document: pass
-
-from services.openai_service import generate_text, LLMError
-from services.knowledge_service import KnowledgeService
-from services.docx_service import create_docx
+from services.llm_service import generate_text, LLMError, warm_up as warm_up_llm
+from services import ollama_service
+from services.knowledge_service import KnowledgeService, CHROMA_DB_DIR
+from services.export_service import export_stored, parse_formats, warm_up as warm_up_export, UnknownFormatError
+from services.usage_service import usage_context, aggregate as aggregate_usage
+from services import llm_governor
+from services import document_store, prompt_service, generation_service, artifact_store, content_store
+from urllib.parse import quote
+from services.job_service import job_queue, job_summary, report_progress, report_section, JobNotFoundError
+from services.coalescing_service import process_flight, request_key
+from services import metrics_service, profiling_service
+from services.admission_service import admission, AdmissionRejectedError
+from services.template_registry import registry as template_registry, document_kind, TemplateNotFoundError
+from services.feedback_overlay import CorrectionNotFoundError, OVERRIDING_OPERATIONS, FEEDBACK_MIN_OLD_TEXT, patches_chunks
 
 load_dotenv()
 
@@ -39,14 +43,34 @@ except Exception as e:
     print(f"ОШИБКА при инициализации KnowledgeService: {e}")
     print("Попытка пересоздать базу знаний...")
     import shutil
-    if os.path.exists("./chroma_db"):
+    if os.path.exists(CHROMA_DB_DIR):
         try:
-            shutil.rmtree("./chroma_db")
+            shutil.rmtree(CHROMA_DB_DIR)
             print("Старая база данных удалена.")
         except Exception as rm_error:
             print(f"Ошибка при удалении базы: {rm_error}")
     ks = KnowledgeService()
 
+@app.on_event("startup")
+def preload_local_llm():
+    """Предзагружает и закрепляет в памяти локальную модель Ollama (если она используется)."""
+    warm_up_llm()
+
+@app.on_event("startup")
+def warm_up_export_renderers():
+    """Запускает процессы рендера и готовит в них базовый документ ГОСТ, шрифты и стили до первого запроса."""
+    warm_up_export()
+
+@app.on_event("startup")
+def load_document_templates():
+    """Разбирает новые и изменённые шаблоны из templates/ (остальные берутся из кеша скелетов)."""
+    print(f"Шаблоны документов: {template_registry.refresh()}")
+
+@app.on_event("startup")
+def start_job_workers():
+    """Запускает воркеры очереди задач /jobs (и возвращает в очередь задачи, прерванные перезапуском)."""
+    job_queue.start(lambda payload: process_user_request(ProcessRequestModel(**payload)))
+
 # --- Статические файлы ---
 # Раздаём viwer.html для доступа через ngrok/iframe
 @app.get("/viewer", response_class=HTMLResponse)
@@ -70,6 +94,9 @@ class ProcessRequestModel(BaseModel):
     query: str
     request_type: str  # "document" или "term"
     template_name: str | None = None  # Имя файла шаблона, например "ГОСТ34_Техническое задание.doc"
+    author: str | None = None  # Пользователь/автор запроса (для журнала расхода LLM)
+    profile: bool = False  # Профилировать запрос (то же, что заголовок X-Profile: 1)
+    output_format: str | None = None  # "docx", "pdf", "html", несколько через запятую или "all" (по умолчанию DEFAULT_OUTPUT_FORMAT)
 
 class FeedbackRequestModel(BaseModel):
     author: str | None = None
@@ -179,25 +206,138 @@ def has_strong_doc_type_markers(query: str) -> bool:
     )
     return any(m in q for m in markers)
 
-def read_template_file(template_name: str) -> str:
-    """Читает файл шаблона (.docx) и возвращает его текстовое содержимое."""
-    if not template_name:
-        return ""
-    
-    template_path = os.path.join("templates", template_name)
-    
-    if not os.path.exists(template_path):
-        print(f"Шаблон не найден: {template_path}")
-        return ""
-        
+class SectionGenerationError(Exception):
+    """Ошибка генерации раздела; готовые разделы уже сохранены и документ можно дозапустить."""
+    def __init__(self, message: str, document_id: str, completed_sections: int):
+        super().__init__(message)
+        self.document_id = document_id
+        self.completed_sections = completed_sections
+
+def generate_section(intent_type: str, user_query: str, section_title: str, section_hint: str,
+                     template_name: str | None = None) -> str:
+    """Ищет контекст под раздел и генерирует его текст."""
+    if intent_type == "template":
+        doc_label = document_kind(template_name)
+    else:
+        doc_label = "ТЗ" if intent_type == "tz" else "Руководства пользователя"
+    section_query = f"{user_query}. Раздел {doc_label}: {section_title}. {section_hint}"
+    section_context = ks.search_relevant_knowledge(query=section_query, n_results=60)
+    extra = {"document_kind": doc_label} if intent_type == "template" else {}
+    section_prompt = prompt_service.render(
+        f"{intent_type}_section",
+        user_query=user_query,
+        section_title=section_title,
+        section_hint=section_hint,
+        context=section_context,
+        **extra,
+    )
+    with usage_context(request_type=intent_type, section=section_title):
+        section_result = generate_text(section_prompt, system=prompt_service.SYSTEM_MESSAGE)
+    return section_result.strip()
+
+def generate_sectioned_document(document_id: str, regenerate: set[int] | None = None) -> dict:
+    """
+    Генерирует недостающие разделы документа (и разделы из regenerate), сохраняя каждый
+    сразу после готовности, затем собирает DOCX из сохранённых разделов.
+    Документ к этому моменту уже переведён в in_progress: create_document или start_generation.
+    """
+    document = document_store.load_document(document_id)
+    regenerate = regenerate or set()
+    total = len(document["sections"])
+
+    for index, section in enumerate(document["sections"]):
+        if index in document["texts"] and index not in regenerate:
+            metrics_service.count_cache("stored_sections", True)
+            report_section(index, section["title"], document["texts"][index])
+            continue
+        metrics_service.count_cache("stored_sections", False)
+        report_progress(
+            stage="sections", document_id=document_id, current_section=section["title"],
+            completed_sections=len(document["texts"]), total_sections=total,
+        )
+        try:
+            with profiling_service.span("section", title=section["title"]):
+                text = generate_section(
+                    document["intent_type"], document["query"], section["title"], section["hint"],
+                    template_name=document.get("template_name"),
+                )
+        except Exception as e:
+            document_store.update_document(document_id, status="failed", error=str(e))
+            raise SectionGenerationError(
+                f"раздел '{section['title']}' не сгенерирован: {e}", document_id, len(document["texts"])
+            ) from e
+        document_store.save_section(document_id, index, text)
+        document["texts"][index] = text
+        report_section(index, section["title"], text)
+        report_progress(completed_sections=len(document["texts"]), total_sections=total)
+        print(f"Раздел {index + 1}/{len(document['sections'])} сохранён (документ {document_id}).")
+
+    report_progress(stage="export", completed_sections=total, total_sections=total)
     try:
-        doc = Document(template_path)
-        full_text = "\n".join([para.text for para in doc.paragraphs])
-        print(f"Шаблон '{template_name}' успешно прочитан. Длина текста: {len(full_text)} символов.")
-        return full_text
+        return assemble_document(document_id)
     except Exception as e:
-        print(f"ОШИБКА при чтении шаблона '{template_name}': {e}")
-        return ""
+        # Иначе документ навсегда остался бы in_progress и повторный запуск получал бы 409
+        document_store.update_document(document_id, status="failed", error=str(e))
+        raise
+
+def document_file_fields(artifact_id: str) -> dict:
+    """Поля ответа со ссылкой на готовый файл: клиент скачивает его потоком через /download."""
+    return {
+        "artifact_id": artifact_id,
+        "filename": artifact_store.get_meta(artifact_id).get("filename"),
+        "download_url": artifact_store.download_url(artifact_id),
+    }
+
+def document_files_fields(artifacts: dict[str, str]) -> dict:
+    """Ссылки на файлы всех форматов; поля первого формата — на верхнем уровне, как раньше для DOCX."""
+    primary = next(iter(artifacts.values()))
+    return {
+        **document_file_fields(primary),
+        "files": {fmt: document_file_fields(artifact_id) for fmt, artifact_id in artifacts.items()},
+    }
+
+def export_failed_response(error: Exception, content_id: str, content: str, **fields) -> dict:
+    """Ответ, когда текст сгенерирован и сохранён, но файлы собрать не удалось: текст не теряется."""
+    return {
+        "status": "error",
+        "message": f"Документ сгенерирован, но файлы не созданы: {error}. Текст доступен по export_url.",
+        **fields,
+        **content_fields(content_id),
+        "content": content,
+    }
+
+def content_fields(content_id: str) -> dict:
+    """Id сохранённого текста и ссылка на повторную выгрузку в любом формате без генерации."""
+    return {"content_id": content_id, "export_url": f"{artifact_store.PUBLIC_API_URL}/export/{content_id}"}
+
+def assemble_document(document_id: str) -> dict:
+    """Собирает итоговый текст и файлы запрошенных форматов из сохранённых разделов."""
+    document = document_store.load_document(document_id)
+    section_texts = [document["texts"][i] for i in range(len(document["sections"]))]
+    generated_text = "\n\n".join(section_texts)
+    content_id = content_store.save(
+        generated_text, document["title"], query=document["query"], author=document.get("author"),
+        intent_type=document["intent_type"], template_name=document.get("template_name"), document_id=document_id,
+    )
+    try:
+        artifacts = export_stored(content_id, document.get("output_formats") or ["docx"])
+    except Exception as e:
+        # Текст уже сохранён: его можно выгрузить повторно через /export или дособрать через resume
+        print(f"Не удалось выгрузить документ {document_id}: {e}")
+        document_store.update_document(document_id, status="failed", error=f"выгрузка: {e}", content_id=content_id)
+        return export_failed_response(e, content_id, generated_text, document_id=document_id)
+    document_store.update_document(
+        document_id, status="completed", error=None,
+        artifact_id=next(iter(artifacts.values())), artifacts=artifacts, content_id=content_id,
+    )
+    return {
+        "status": "success",
+        "result_type": "document",
+        "document_id": document_id,
+        **content_fields(content_id),
+        **document_files_fields(artifacts),
+        "content": generated_text,
+    }
 
 # --- API Эндпоинты ---
 
@@ -207,7 +347,7 @@ def read_root():
 
 @app.post("/feedback")
 def submit_feedback(request: FeedbackRequestModel):
-    """Принимает правку к документации и сохраняет её в локальный markdown-файл."""
+    """Принимает правку к документации: markdown-файл для людей и слой правок, который поиск учитывает сразу."""
     try:
         os.makedirs("feedback", exist_ok=True)
 
@@ -239,17 +379,146 @@ def submit_feedback(request: FeedbackRequestModel):
             f.write("\n".join(content_lines))
 
         print(f"Правка сохранена в файл: {file_path}")
-        return {"status": "success", "file_path": file_path}
+        try:
+            correction_id = ks.add_correction(
+                request.operation or "comment", author=request.author, doc_type=request.doc_type,
+                doc_ref=request.doc_ref, old_text=request.old_text, new_text=request.new_text, comment=request.comment,
+            )
+        except Exception as e:
+            # Файл правки уже сохранён: её можно будет внести в источники вручную
+            print(f"Не удалось добавить правку в слой правок поиска: {e}")
+            return {"status": "success", "file_path": file_path, "correction_id": None}
+        print(f"Правка {correction_id} добавлена в слой правок поиска.")
+        response = {"status": "success", "file_path": file_path, "correction_id": correction_id}
+        if request.operation in OVERRIDING_OPERATIONS and not patches_chunks(request.operation, request.old_text):
+            response["warning"] = (
+                f"Старый текст короче {FEEDBACK_MIN_OLD_TEXT} символов: найденные фрагменты им не исправляются, "
+                "правка только добавляется в контекст. Укажите фрагмент подлиннее."
+            )
+        return response
 
     except Exception as e:
         return {"status": "error", "message": f"Не удалось сохранить правку: {e}"}
 
+@app.get("/feedback/corrections")
+def list_corrections(include_inactive: bool = False):
+    """Правки, которые поиск сейчас применяет поверх индекса."""
+    return {"status": "success", "corrections": ks.feedback.list_corrections(include_inactive=include_inactive)}
+
+@app.delete("/feedback/corrections/{correction_id}")
+def deactivate_correction(correction_id: int):
+    """Отключает правку, например после того как источник исправлен и переиндексирован."""
+    try:
+        ks.feedback.deactivate(correction_id)
+    except CorrectionNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"status": "success", "correction_id": correction_id}
+
+@app.get("/usage/report")
+def usage_report(group_by: str = "request_type", since: str | None = None):
+    """Сводка расхода LLM (токены, токены/с, стоимость, p95) в разрезе request_type/user/model/section."""
+    try:
+        return {"status": "success", "group_by": group_by, "rows": aggregate_usage(group_by=group_by, since=since)}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/llm/governor")
+def llm_governor_stats():
+    """Состояние регуляторов LLM по провайдерам: занятые слоты, глубина очереди, время ожидания, отказы."""
+    return llm_governor.stats()
+
+@app.get("/llm/ollama")
+def ollama_stats():
+    """Производительность локальной модели Ollama: токены/с декодирования и prefill."""
+    return ollama_service.get_stats()
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Метрики в формате Prometheus."""
+    body, content_type = metrics_service.render_latest()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/profiles")
+def list_request_profiles():
+    """Сохранённые профили запросов (медленные, запрошенные и сэмплированные)."""
+    return {"status": "success", "profiles": profiling_service.list_profiles()}
+
+@app.get("/profiles/{profile_id}")
+def download_request_profile(profile_id: str):
+    """Скачивание профиля запроса (JSON с деревом этапов и входными данными)."""
+    try:
+        path = profiling_service.profile_path(profile_id)
+    except profiling_service.ProfileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return FileResponse(path, media_type="application/json", filename=os.path.basename(path))
+
+@app.get("/process/coalescing")
+def process_coalescing_stats():
+    """Сколько одинаковых одновременных запросов /process обслужено одним вычислением."""
+    return {"status": "success", **process_flight.stats()}
+
+@app.get("/prompts/prefix")
+def prompt_prefix_report():
+    """Длина общего префикса промптов по шаблонам — для оценки экономии prefill за счёт кэша."""
+    return {"status": "success", "system_chars": len(prompt_service.SYSTEM_MESSAGE), "templates": prompt_service.prefix_report()}
+
 @app.post("/process")
-def process_user_request(request: ProcessRequestModel):
+def process_endpoint(request: ProcessRequestModel, x_profile: str | None = Header(default=None)):
     """
     Универсальный эндпоинт для обработки запросов на генерацию документа
     или поиск определения термина.
     """
+    if x_profile and x_profile.lower() in ("1", "true", "yes"):
+        request.profile = True
+    return run_admitted(request.author, lambda: process_user_request(request))
+
+def run_admitted(user: str | None, handler):
+    """
+    Выполняет запрос к LLM через допуск: квоты и честная очередь между пользователями, пакет запросов
+    одного не вытесняет остальных. Через него идут все синхронные эндпоинты генерации; задачи /jobs
+    ограничены своей квотой в очереди задач и числом её воркеров.
+    """
+    try:
+        with admission.admit(user):
+            return handler()
+    except AdmissionRejectedError as e:
+        return _admission_rejected_response(e)
+
+def _admission_rejected_response(e: AdmissionRejectedError) -> JSONResponse:
+    """Быстрый структурированный отказ 429 с рекомендуемым временем повтора."""
+    return JSONResponse(
+        status_code=429,
+        content=e.to_dict(),
+        headers={"Retry-After": str(round(e.retry_after))},
+    )
+
+@app.get("/admission")
+def admission_stats():
+    """Очереди допуска по пользователям: в работе, в очереди, допущено и отклонено."""
+    return {"status": "success", **admission.stats()}
+
+def process_user_request(request: ProcessRequestModel):
+    """Обработка /process (синхронно или из очереди задач) с учётом расхода, метрик и профилирования."""
+    request_id = uuid.uuid4().hex
+    # Одинаковые одновременные запросы к одной версии индекса выполняются один раз
+    key = request_key(
+        request.request_type, request.query, request.template_name, ks.index_version(), request.output_format,
+        author=request.author,
+    )
+    # Все вызовы LLM внутри запроса попадут в журнал расхода с этими атрибутами
+    with usage_context(request_id=request_id, user=request.author, request_type=request.request_type), \
+            metrics_service.track_process(request.request_type) as outcome, \
+            profiling_service.profile_request(request_id, request.dict(), requested=request.profile):
+        result, shared = process_flight.do(key, lambda: run_process_request(request))
+        outcome["status"] = result.get("status", "ok") if isinstance(result, dict) else "ok"
+    metrics_service.count_cache("process_coalescing", shared)
+    if shared:
+        report_progress(stage="coalesced")
+        return {**result, "coalesced": True}
+    return result
+
+def run_process_request(request: ProcessRequestModel):
+    """Основной конвейер /process: поиск по базе знаний, генерация и сборка документа."""
     user_query = request.query
     request_type = request.request_type
     template_name = request.template_name
@@ -262,22 +531,8 @@ def process_user_request(request: ProcessRequestModel):
             if not relevant_context or "не найдена" in relevant_context:
                 return {"status": "error", "message": f"Определение для термина '{user_query}' не найдено."}
 
-            term_prompt = f"""
-            Ты — ассистент, который находит точные определения терминов.
-            ТВОЯ ЗАДАЧА: Извлечь чистое, понятное определение для термина "{user_query}" из предоставленного текста.
-            ИСХОДНЫЙ ТЕКСТ (МОЖЕТ СОДЕРЖАТЬ HTML-РАЗМЕТКУ):
-            ---
-            {relevant_context}
-            ---
-            ИНСТРУКЦИИ:
-            1.  Внимательно прочитай ИСХОДНЫЙ ТЕКСТ.
-            2.  Найди в нем определение для термина "{user_query}".
-            3.  Сформулируй ответ, но **ОБЯЗАТЕЛЬНО УБЕРИ ВСЕ HTML-ТЕГИ**.
-            4.  Ответ должен быть коротким, четким и содержать только определение.
-            5.  Если в тексте нет четкого определения, напиши "Определение не найдено в предоставленном тексте."
-            Приступай к работе.
-            """
-            clean_definition = generate_text(term_prompt)
+            term_prompt = prompt_service.render("term", user_query=user_query, context=relevant_context)
+            clean_definition = generate_text(term_prompt, system=prompt_service.SYSTEM_MESSAGE)
             return {"status": "success", "result_type": "term", "term": user_query, "definition": clean_definition}
         except Exception as e:
             return {"status": "error", "message": f"Не удалось сгенерировать определение. Причина: {e}"}
@@ -285,182 +540,254 @@ def process_user_request(request: ProcessRequestModel):
     elif request_type == "document":
         # --- Путь 2: Генерируем документ по шаблону или как раньше ---
         try:
+            # Формат проверяем до поиска и генерации, чтобы не тратить на них время впустую
+            output_formats = parse_formats(request.output_format)
+        except UnknownFormatError as e:
+            return {"status": "error", "message": str(e)}
+        try:
+            if template_name:
+                # Разделы берутся из заранее разобранного скелета шаблона ГОСТ 34 (services/template_registry.py)
+                try:
+                    template = template_registry.get(template_name)
+                except TemplateNotFoundError as e:
+                    return {"status": "error", "message": str(e)}
+                document_id = document_store.create_document(
+                    query=user_query,
+                    intent_type="template",
+                    title=f"{template['kind']}: {user_query}",
+                    sections=template["sections"],
+                    template_name=template["template_name"],
+                    author=request.author,
+                    output_formats=output_formats,
+                )
+                return generate_sectioned_document(document_id)
+
             if is_question_like(user_query) and not has_strong_doc_type_markers(user_query):
                 relevant_context = ks.search_relevant_knowledge(query=user_query, n_results=40)
 
-                qa_prompt = f"""
-                Ты — эксперт по системе и ассистент по технической документации.
-
-                ТВОЯ ЗАДАЧА: ответить на ВОПРОС пользователя по существу, используя только предоставленную БАЗУ ЗНАНИЙ.
-
-                ВОПРОС ПОЛЬЗОВАТЕЛЯ:
-                "{user_query}"
-
-                БАЗА ЗНАНИЙ:
-                ---
-                {relevant_context}
-                ---
-
-                ИНСТРУКЦИИ:
-                1. Ответь ТОЛЬКО на этот вопрос. Не нужно составлять отдельный документ, ТЗ или Руководство пользователя.
-                2. НЕ добавляй заголовки вида "Руководство пользователя", "Техническое задание", "Документ" и т.п.
-                3. Используй БАЗУ ЗНАНИЙ, не придумывай факты. Если информации явно не хватает, аккуратно укажи, какие данные нужно уточнить.
-                4. Если вопрос про действия пользователя ("как сделать ..."), опиши шаги по порядку с точки зрения пользователя системы.
-                5. Объём ответа: от 1 до 5 абзацев, можно использовать маркированные списки для шагов или перечней.
-                6. Не смешивай описания разных систем: если в БАЗЕ ЗНАНИЙ несколько систем, ориентируйся на ту, которая прямо следует из вопроса.
-                """
+                qa_prompt = prompt_service.render("qa", user_query=user_query, context=relevant_context)
 
-                qa_answer = generate_text(qa_prompt)
+                with usage_context(request_type="qa"):
+                    qa_answer = generate_text(qa_prompt, system=prompt_service.SYSTEM_MESSAGE)
                 return {"status": "success", "result_type": "qa", "answer": qa_answer}
 
             intent_type, structure_prompt = classify_intent_and_structure(user_query)
 
-            if intent_type == "tz":
-                sections = get_tz_sections()
-                section_texts = []
-
-                for section_title, section_hint in sections:
-                    section_query = f"{user_query}. Раздел ТЗ: {section_title}. {section_hint}"
-                    section_context = ks.search_relevant_knowledge(query=section_query, n_results=60)
-
-                    section_prompt = f"""
-                    Ты — старший технический писатель и системный аналитик.
-
-                    ТВОЯ ЗАДАЧА: на основе ЗАПРОСА, БАЗЫ ЗНАНИЙ и описания раздела подготовить ПОЛНЫЙ текст раздела Технического задания под названием "{section_title}".
-
-                    ЗАПРОС ПОЛЬЗОВАТЕЛЯ:
-                    "{user_query}"
-
-                    РАЗДЕЛ ТЗ:
-                    "{section_title}"
-
-                    ЧТО НУЖНО ОСВЕТИТЬ В ЭТОМ РАЗДЕЛЕ:
-                    {section_hint}
-
-                    БАЗА ЗНАНИЙ:
-                    ---
-                    {section_context}
-                    ---
-
-                    ПРАВИЛА:
-                    1. СГЕНЕРИРУЙ ТОЛЬКО ТЕКСТ РАЗДЕЛА "{section_title}", со всеми его подпунктами, но без других разделов.
-                    2. НЕ ДЕЛАЙ КРАТКОЕ РЕЗЮМЕ. Пиши развернуто, максимально подробно, опираясь на БАЗУ ЗНАНИЙ.
-                    3. НЕ ПРИДУМЫВАЙ ФАКТЫ ВНЕ БАЗЫ ЗНАНИЙ. Если информации не хватает, явно пиши, какие данные нужно уточнить.
-                    4. НЕ СМЕШИВАЙ ОПИСАНИЯ РАЗНЫХ СИСТЕМ. Если в БАЗЕ ЗНАНИЙ есть разные системы, выбирай только ту, которая соответствует запросу.
-                    5. СОХРАНЯЙ ОФИЦИАЛЬНО-ДЕЛОВОЙ СТИЛЬ И СТРУКТУРУ ГОСТОВОГО ТЗ.
-                    """
-                    section_result = generate_text(section_prompt)
-                    section_texts.append(section_result.strip())
-
-                generated_text = "\n\n".join(section_texts)
-            elif intent_type == "manual":
-                sections = get_manual_sections()
-                section_texts = []
-
-                for section_title, section_hint in sections:
-                    section_query = f"{user_query}. Раздел Руководства пользователя: {section_title}. {section_hint}"
-                    section_context = ks.search_relevant_knowledge(query=section_query, n_results=60)
-
-                    section_prompt = f"""
-                    Ты — технический писатель, создающий подробное Руководство пользователя по системе.
-
-                    ТВОЯ ЗАДАЧА: на основе ЗАПРОСА, БАЗЫ ЗНАНИЙ и описания раздела подготовить ПОЛНЫЙ текст раздела Руководства пользователя под названием "{section_title}".
-
-                    ЗАПРОС ПОЛЬЗОВАТЕЛЯ:
-                    "{user_query}"
-
-                    РАЗДЕЛ РУКОВОДСТВА:
-                    "{section_title}"
-
-                    ЧТО НУЖНО ОСВЕТИТЬ В ЭТОМ РАЗДЕЛЕ:
-                    {section_hint}
-
-                    БАЗА ЗНАНИЙ:
-                    ---
-                    {section_context}
-                    ---
-
-                    ПРАВИЛА:
-                    1. СГЕНЕРИРУЙ ТОЛЬКО ТЕКСТ РАЗДЕЛА "{section_title}", со всеми его подпунктами, но без других разделов.
-                    2. ПИШИ С ТОЧКИ ЗРЕНИЯ КОНЕЧНОГО ПОЛЬЗОВАТЕЛЯ/ОПЕРАТОРА: что он видит в интерфейсе и какие шаги выполняет.
-                    3. НЕ ПЕРЕПИСЫВАЙ ТЕХНИЧЕСКОЕ ЗАДАНИЕ. Описывай именно практическое использование системы, а не цели проекта и бизнес-контекст.
-                    4. МАКСИМАЛЬНО ИСПОЛЬЗУЙ БАЗУ ЗНАНИЙ. Если в ней мало данных по интерфейсу, переходи на аккуратные обобщения и явно помечай, что описываешь типовой сценарий.
-                    5. НЕ ПРИДУМЫВАЙ НОВЫЕ СУЩЕСТВА, ПОДСИСТЕМЫ И ТЕРМИНЫ, КОТОРЫХ НЕТ В БАЗЕ ЗНАНИЙ.
-                    6. ИЗБЕГАЙ ПУСТОЙ ОБЩЕЙ ТЕОРИИ. Каждый подраздел должен помогать пользователю реально работать с системой.
-                    """
-                    section_result = generate_text(section_prompt)
-                    section_texts.append(section_result.strip())
-
-                generated_text = "\n\n".join(section_texts)
+            if intent_type in ("tz", "manual"):
+                sections = get_tz_sections() if intent_type == "tz" else get_manual_sections()
+                document_id = document_store.create_document(
+                    query=user_query,
+                    intent_type=intent_type,
+                    title=f"Документ: {user_query}",
+                    sections=sections,
+                    template_name=template_name,
+                    author=request.author,
+                    output_formats=output_formats,
+                )
+                return generate_sectioned_document(document_id)
             else:
-                relevant_context = ks.search_relevant_knowledge(query=user_query, n_results=100)
-
-                prompt = f"""
-                Ты — старший технический писатель и системный аналитик.
-
-                ТВОЯ ЗАДАЧА: на основе ЗАПРОСА и БАЗЫ ЗНАНИЙ подготовить МАКСИМАЛЬНО ПОДРОБНЫЙ, полноформатный документ (например, Техническое задание по ГОСТ, подробное Руководство пользователя или аналогичный по глубине документ), а не краткую выжимку.
-
-                ЗАПРОС:
-                "{user_query}"
-
-                БАЗА ЗНАНИЙ:
-                ---
-                {relevant_context}
-                ---
-
-                ОБЩИЕ ПРАВИЛА:
-                1.  НЕ ДЕЛАЙ КРАТКОЕ РЕЗЮМЕ. Это должен быть развернутый документ уровня аналитика/проектировщика, а не конспект.
-                2.  ИСПОЛЬЗУЙ МАКСИМУМ РЕЛЕВАНТНОЙ ИНФОРМАЦИИ из БАЗЫ ЗНАНИЙ, не выбрасывай важные детали, если они относятся к теме.
-                3.  НЕ ПРИДУМЫВАЙ ФАКТЫ. Используй только то, что есть в БАЗЕ ЗНАНИЙ. Если данных для какого‑то аспекта нет — прямо укажи, что информация отсутствует.
-                4.  НЕЛЬЗЯ СМЕШИВАТЬ РАЗНЫЕ СИСТЕМЫ. Если в БАЗЕ ЗНАНИЙ есть описания разных систем (АСУ ПГР, цифровой двойник, другие), выбери ОДНУ целевую систему/объект, который следует из ЗАПРОСА, и описывай только её. Не объединяй описания разных систем в один документ.
-                5.  СТРУКТУРА ДОЛЖНА БЫТЬ ЛОГИЧЕСКИ ПОЛНОЙ: введение, область применения, термины и сокращения (если есть), общие сведения о системе, требования (функциональные, нефункциональные, к интерфейсам, интеграциям, надёжности и т.п.), архитектура/состав, пользовательские роли и сценарии, порядок ввода в действие, сопровождение и т.д. Адаптируй структуру под тип документа, но делай её максимально полной.
-
-                ИНСТРУКЦИИ ПО РАБОТЕ:
-                1.  Определи тип документа по ЗАПРОСУ (Техническое задание, Руководство пользователя, описание подсистемы и т.п.).
-                2.  Определи целевую систему/объект (например, цифровой двойник, АСУ ПГР и т.п.) и строго придерживайся именно её.
-                3.  Внимательно изучи БАЗУ ЗНАНИЙ и выбери все фрагменты, относящиеся к выбранному типу документа и целевой системе.
-                4.  Построй подробный документ с чёткими разделами и подпунктами. Каждый раздел заполняй максимально полно, используя релевантные фрагменты из БАЗЫ ЗНАНИЙ.
-                5.  Если для какого‑то раздела данных мало или нет, явно укажи это текстом (например: "Информация по данному аспекту в базе знаний отсутствует"), но не опускай раздел полностью.
-
-                СФОРМИРУЙ ИТОГОВЫЙ ДОКУМЕНТ:
-                - Полноформатный, детализированный.
-                - В официально‑деловом стиле, понятный аналитику, архитектору и разработчику.
-                - Без искусственного сокращения объёма: не пытайся уместить всё в несколько абзацев, раскрывай тему настолько подробно, насколько позволяет БАЗА ЗНАНИЙ.
-                """
-
-                generated_text = generate_text(prompt)
+                # План документа + параллельное раскрытие разделов (см. GENERAL_GENERATION_MODE)
+                report_progress(stage="generation")
+                relevant_chunks = ks.search_relevant_chunks(query=user_query, n_results=100)
+                generated_text = generation_service.generate_general_document(
+                    user_query, relevant_chunks, search=ks.search_relevant_chunks
+                )
 
             title = f"Документ: {user_query}"
-            docx_path = create_docx(content=generated_text, title=title)
+            content_id = content_store.save(
+                generated_text, title, query=user_query, author=request.author, intent_type=intent_type,
+            )
+            try:
+                artifacts = export_stored(content_id, output_formats)
+            except Exception as e:
+                print(f"Не удалось выгрузить документ {content_id}: {e}")
+                return export_failed_response(e, content_id, generated_text)
             
             return {
                 "status": "success",
                 "result_type": "document",
-                "file_path": docx_path,
+                **content_fields(content_id),
+                **document_files_fields(artifacts),
                 "content": generated_text,
             }
 
+        except SectionGenerationError as e:
+            return _section_error_response(e)
         except Exception as e:
             return {"status": "error", "message": f"Произошла непредвиденная ошибка: {e}"}
     
     else:
         return {"status": "error", "message": f"Неверный тип запроса: '{request_type}'. Используйте 'document' или 'term'."}
 
+# --- Асинхронные задачи /process ---
+
+@app.post("/jobs")
+def submit_job(request: ProcessRequestModel):
+    """Ставит запрос /process в очередь и сразу возвращает id задачи."""
+    try:
+        job_id = job_queue.submit(request.dict())
+    except AdmissionRejectedError as e:
+        return _admission_rejected_response(e)
+    return {"status": "success", "job_id": job_id, "job_status": "queued"}
+
+@app.get("/jobs/stats")
+def job_queue_stats():
+    """Число задач в очереди, в работе и завершённых."""
+    return {"status": "success", **job_queue.stats()}
+
+@app.get("/jobs/{job_id}")
+def get_job_status(job_id: str):
+    """Статус и прогресс задачи."""
+    try:
+        return {"status": "success", **job_summary(job_queue.get(job_id))}
+    except JobNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.get("/jobs/{job_id}/sections")
+def get_job_sections(job_id: str, after: int = -1):
+    """Готовые разделы документа (с номером больше after) — их можно показывать до готовности DOCX."""
+    try:
+        return {"status": "success", "job_id": job_id, "sections": job_queue.sections(job_id, after)}
+    except JobNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(job_id: str):
+    """Результат задачи — тот же ответ, что вернул бы синхронный /process."""
+    try:
+        job = job_queue.get(job_id)
+    except JobNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if job["status"] in ("queued", "running"):
+        raise HTTPException(status_code=409, detail=f"Задача {job_id} ещё не завершена (статус: {job['status']}).")
+    if job["result"] is None:
+        return {"status": "error", "message": job["error"] or "Задача завершилась без результата.", "job_id": job_id}
+    return {**job["result"], "job_id": job_id}
+
+# --- Документы, сгенерированные по разделам ---
+
+def run_document_generation(document: dict, handler):
+    """
+    Повторная генерация существующего документа: документ атомарно занимается (in_progress) до допуска,
+    поэтому параллельный resume/regenerate того же документа сразу получает 409, а не пишет те же файлы.
+    """
+    document_id = document["document_id"]
+    try:
+        previous = document_store.start_generation(document_id)
+    except document_store.DocumentBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    try:
+        response = run_admitted(document.get("author"), handler)
+    except Exception as e:
+        document_store.update_document(document_id, status="failed", error=str(e))
+        raise
+    if isinstance(response, JSONResponse):
+        # Отказ в допуске: генерация не начиналась, возвращаем документу прежний статус
+        document_store.update_document(document_id, **previous)
+    return response
+
+def _section_error_response(e: "SectionGenerationError") -> dict:
+    return {
+        "status": "error",
+        "message": str(e),
+        "document_id": e.document_id,
+        "completed_sections": e.completed_sections,
+    }
+
+@app.get("/templates")
+def list_templates():
+    """Шаблоны из templates/ с числом выделенных разделов (0 — шаблон для генерации по разделам не годится)."""
+    return {"status": "success", "templates": template_registry.list()}
+
+@app.get("/documents/{document_id}")
+def get_document_status(document_id: str):
+    """Статус документа и готовность каждого раздела."""
+    try:
+        return {"status": "success", **document_store.document_summary(document_store.load_document(document_id))}
+    except document_store.DocumentNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.post("/documents/{document_id}/resume")
+def resume_document(document_id: str):
+    """Догенерирует недостающие разделы упавшего документа, не трогая готовые."""
+    try:
+        document = document_store.load_document(document_id)
+    except document_store.DocumentNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    def resume():
+        with usage_context(request_id=uuid.uuid4().hex, user=document.get("author"), request_type="resume"):
+            try:
+                return generate_sectioned_document(document_id)
+            except SectionGenerationError as e:
+                return _section_error_response(e)
+    return run_document_generation(document, resume)
+
+@app.post("/documents/{document_id}/sections/{section}/regenerate")
+def regenerate_document_section(document_id: str, section: str):
+    """Перегенерирует один раздел (по номеру с 1 или названию) и пересобирает DOCX."""
+    try:
+        document = document_store.load_document(document_id)
+        index = document_store.find_section_index(document, section)
+    except document_store.DocumentNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]))
+    def regenerate():
+        with usage_context(request_id=uuid.uuid4().hex, user=document.get("author"), request_type="regenerate"):
+            try:
+                return generate_sectioned_document(document_id, regenerate={index})
+            except SectionGenerationError as e:
+                return _section_error_response(e)
+    return run_document_generation(document, regenerate)
+
 # --- Старые эндпоинты для совместимости ---
 
 @app.post("/generate")
 def generate_documentation(request: RequestModel):
     """Старый эндпоинт для генерации документов. Оставлен для совместимости."""
-    return process_user_request(ProcessRequestModel(query=request.query, request_type="document"))
+    process_request = ProcessRequestModel(query=request.query, request_type="document")
+    return run_admitted(process_request.author, lambda: process_user_request(process_request))
 
 @app.post("/get_term")
 def get_term_definition(request: TermRequestModel):
     """Эндпоинт для получения определения конкретного термина."""
-    return process_user_request(ProcessRequestModel(query=request.term, request_type="term"))
+    process_request = ProcessRequestModel(query=request.term, request_type="term")
+    return run_admitted(process_request.author, lambda: process_user_request(process_request))
+
+@app.get("/export/{content_id}")
+def export_content(content_id: str, format: str | None = None):
+    """Выгрузка уже сгенерированного документа в другом формате без LLM: один формат — сам файл, несколько — ссылки."""
+    try:
+        formats = parse_formats(format)
+        artifacts = export_stored(content_id, formats)
+        meta = content_store.get_meta(content_id)
+    except UnknownFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except content_store.ContentNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if len(artifacts) == 1:
+        return download_file(next(iter(artifacts.values())))
+    return {
+        "status": "success",
+        "title": meta["title"],
+        **content_fields(content_id),
+        **document_files_fields(artifacts),
+    }
 
 @app.get("/download/{filename:path}")
 def download_file(filename: str):
-    """Скачивание сгенерированных документов из папки output."""
+    """Скачивание сгенерированных документов: потоком из хранилища файлов по id или из папки output."""
+    if artifact_store.is_artifact_id(filename):
+        try:
+            meta = artifact_store.get_meta(filename)
+            chunks = artifact_store.iter_chunks(filename)
+        except artifact_store.ArtifactNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        headers = {"Content-Disposition": f"attachment; filename*=UTF-8''{quote(meta.get('filename') or filename)}"}
+        if meta.get("size") is not None:
+            headers["Content-Length"] = str(meta["size"])
+        return StreamingResponse(chunks, media_type=meta.get("content_type") or artifact_store.DOCX_CONTENT_TYPE, headers=headers)
+
     # Убираем путь к папке output, если он есть в filename
     if filename.startswith("output/"):
         filename = filename[7:]  # Убираем "output/"
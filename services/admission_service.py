@@ -0,0 +1,208 @@
+# services/admission_service.py
+# Допуск запросов /process с честным разделением между пользователями. У каждого пользователя
+# (автор запроса или id пользователя бота) ограничено число одновременных и ожидающих запросов,
+# а освободившийся общий слот достаётся пользователям по кругу (round-robin), а не в порядке
+# прихода: пакет запросов одного пользователя не вытесняет остальных. Лишние запросы сразу
+# отклоняются с рекомендуемым временем повтора.
+# Синхронный эндпоинт ждёт допуска в потоке пула FastAPI (anyio, по умолчанию 40 потоков), поэтому
+# общая очередь ограничена: max_concurrent + max_queued меньше пула, и на /documents, /download,
+# /jobs и прочие быстрые запросы всегда остаются свободные потоки.
+import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+from services import metrics_service
+
+load_dotenv()
+
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "8"))
+ADMISSION_PER_USER_CONCURRENT = int(os.getenv("ADMISSION_PER_USER_CONCURRENT", "2"))
+ADMISSION_PER_USER_QUEUE = int(os.getenv("ADMISSION_PER_USER_QUEUE", "3"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "300"))
+# Общий предел ожидающих запросов всех пользователей: сверх него — мгновенный отказ 429
+ADMISSION_MAX_QUEUED = int(os.getenv("ADMISSION_MAX_QUEUED", "16"))
+# Размер пула потоков синхронных эндпоинтов (по умолчанию у anyio)
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+# Оценка длительности запроса до накопления статистики (с)
+ADMISSION_DEFAULT_SERVICE_TIME = float(os.getenv("ADMISSION_DEFAULT_SERVICE_TIME", "60"))
+
+ANONYMOUS_USER = "anonymous"
+
+
+class AdmissionRejectedError(Exception):
+    """Запрос не допущен: превышена квота пользователя, переполнена общая очередь или истекло ожидание."""
+
+    def __init__(self, message: str, user: str, reason: str, retry_after: float):
+        super().__init__(message)
+        self.user = user
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def to_dict(self) -> dict:
+        return {
+            "status": "error",
+            "error": "too_many_requests",
+            "reason": self.reason,
+            "user": self.user,
+            "message": str(self),
+            "retry_after": round(self.retry_after),
+        }
+
+
+class _Ticket:
+    def __init__(self):
+        self.granted = False
+
+
+class _UserState:
+    def __init__(self):
+        self.active = 0
+        self.waiting: deque[_Ticket] = deque()
+        self.admitted = 0
+        self.rejected = 0
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent: int, per_user_concurrent: int, per_user_queue: int, max_wait: float,
+                 max_queued: int):
+        self.max_concurrent = max_concurrent
+        self.per_user_concurrent = per_user_concurrent
+        self.per_user_queue = per_user_queue
+        self.max_wait = max_wait
+        self.max_queued = max_queued
+        if max_concurrent + max_queued >= THREADPOOL_SIZE:
+            print(f"ВНИМАНИЕ: ADMISSION_MAX_CONCURRENT + ADMISSION_MAX_QUEUED = {max_concurrent + max_queued} "
+                  f"не меньше пула потоков ({THREADPOOL_SIZE}): ожидающие запросы могут занять все потоки API.")
+        self._cond = threading.Condition()
+        self._users: dict[str, _UserState] = {}
+        # Очередь обхода пользователей с ожидающими запросами (round-robin)
+        self._rotation: deque[str] = deque()
+        self._in_flight = 0
+        self._queued = 0
+        self._service_time = ADMISSION_DEFAULT_SERVICE_TIME
+
+    def estimate_retry_after(self, pending: int, parallel: int | None = None) -> float:
+        """Через сколько секунд у пользователя с pending запросами освободится место."""
+        parallel = parallel or self.per_user_concurrent
+        return max(1.0, self._service_time * pending / max(1, parallel))
+
+    def _reject(self, user: str, state: _UserState, reason: str, message: str,
+                retry_after: float | None = None) -> None:
+        state.rejected += 1
+        metrics_service.count_admission_rejection(user, reason)
+        if retry_after is None:
+            # Запросы пользователя идут не более чем по per_user_concurrent одновременно
+            retry_after = self.estimate_retry_after(state.active + len(state.waiting))
+        raise AdmissionRejectedError(message, user, reason, retry_after)
+
+    def _dispatch(self) -> None:
+        """Раздаёт свободные слоты ожидающим по кругу, пропуская пользователей, упёршихся в свою квоту."""
+        granted = False
+        while self._in_flight < self.max_concurrent and self._rotation:
+            for _ in range(len(self._rotation)):
+                user = self._rotation[0]
+                self._rotation.rotate(-1)
+                state = self._users[user]
+                if state.waiting and state.active < self.per_user_concurrent:
+                    ticket = state.waiting.popleft()
+                    ticket.granted = True
+                    self._queued -= 1
+                    state.active += 1
+                    self._in_flight += 1
+                    granted = True
+                    if not state.waiting:
+                        self._rotation.remove(user)
+                    break
+            else:
+                break
+        if granted:
+            self._cond.notify_all()
+
+    def _publish(self, user: str, state: _UserState) -> None:
+        metrics_service.set_admission_user(user, active=state.active, queued=len(state.waiting))
+
+    @contextmanager
+    def admit(self, user: str | None):
+        """Ждёт своей очереди и держит слот на время обработки запроса."""
+        user = user or ANONYMOUS_USER
+        ticket = _Ticket()
+        deadline = time.monotonic() + self.max_wait
+        with self._cond:
+            state = self._users.setdefault(user, _UserState())
+            if state.active + len(state.waiting) >= self.per_user_concurrent + self.per_user_queue:
+                self._reject(
+                    user, state, "user_quota",
+                    f"У пользователя {user} уже {state.active} запросов в работе и {len(state.waiting)} в очереди. "
+                    "Дождитесь их завершения.",
+                )
+            if self._in_flight >= self.max_concurrent and self._queued >= self.max_queued:
+                # Не занимаем поток пула ожиданием: очередь и так длиннее, чем сервер разберёт быстро
+                self._reject(
+                    user, state, "server_queue",
+                    f"Сервер перегружен: {self._in_flight} запросов в работе и {self._queued} в очереди.",
+                    retry_after=self.estimate_retry_after(self._queued + 1, self.max_concurrent),
+                )
+            state.waiting.append(ticket)
+            self._queued += 1
+            if user not in self._rotation:
+                self._rotation.append(user)
+            self._dispatch()
+            self._publish(user, state)
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    state.waiting.remove(ticket)
+                    self._queued -= 1
+                    if not state.waiting and user in self._rotation:
+                        self._rotation.remove(user)
+                    self._publish(user, state)
+                    self._reject(user, state, "queue_timeout",
+                                 f"Запрос ждал в очереди дольше {self.max_wait:.0f} с. Сервер перегружен.")
+                self._cond.wait(timeout=remaining)
+            state.admitted += 1
+            self._publish(user, state)
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._cond:
+                # Скользящая оценка длительности запроса для retry_after
+                self._service_time = 0.8 * self._service_time + 0.2 * (time.monotonic() - started)
+                state.active -= 1
+                self._in_flight -= 1
+                self._dispatch()
+                self._publish(user, state)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "in_flight": self._in_flight,
+                "max_concurrent": self.max_concurrent,
+                "queued": self._queued,
+                "max_queued": self.max_queued,
+                "per_user_concurrent": self.per_user_concurrent,
+                "per_user_queue": self.per_user_queue,
+                "avg_service_time": round(self._service_time, 1),
+                "users": {
+                    user: {
+                        "active": s.active,
+                        "queued": len(s.waiting),
+                        "admitted": s.admitted,
+                        "rejected": s.rejected,
+                    }
+                    for user, s in self._users.items()
+                },
+            }
+
+
+admission = AdmissionController(
+    max_concurrent=ADMISSION_MAX_CONCURRENT,
+    per_user_concurrent=ADMISSION_PER_USER_CONCURRENT,
+    per_user_queue=ADMISSION_PER_USER_QUEUE,
+    max_wait=ADMISSION_MAX_WAIT,
+    max_queued=ADMISSION_MAX_QUEUED,
+)
@@ -0,0 +1,154 @@
+# services/artifact_store.py
+# Хранилище готовых файлов (DOCX) для выдачи по HTTP. Файл адресуется хешем содержимого, клиенты
+# (бот, viewer) скачивают его потоком через /download/<id>, поэтому боту и API не нужен общий диск.
+#   disk   — каталог ARTIFACT_DIR (для нескольких реплик API — общий том или смонтированное хранилище)
+#   memory — LRU в памяти процесса, ограниченный ARTIFACT_MEMORY_MAX_MB (одна реплика или ссылка
+#            на конкретную реплику через PUBLIC_API_URL)
+import os
+import json
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Iterator
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ARTIFACT_BACKEND = os.getenv("ARTIFACT_BACKEND", "disk")
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "artifacts")
+ARTIFACT_MEMORY_MAX_MB = float(os.getenv("ARTIFACT_MEMORY_MAX_MB", "256"))
+ARTIFACT_CHUNK_SIZE = int(os.getenv("ARTIFACT_CHUNK_SIZE", str(64 * 1024)))
+# Адрес, по которому клиенты достают именно эту реплику API ("" — относительные ссылки)
+PUBLIC_API_URL = os.getenv("PUBLIC_API_URL", "").rstrip("/")
+
+DOCX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+
+class ArtifactNotFoundError(Exception):
+    """Файл с указанным id отсутствует в хранилище."""
+    pass
+
+
+def is_artifact_id(value: str) -> bool:
+    return len(value) == 64 and all(c in "0123456789abcdef" for c in value)
+
+
+def _atomic_write(path: str, data: bytes) -> None:
+    # Уникальный временный файл: одинаковый файл могут сохранять одновременно несколько потоков и реплик
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class DiskArtifactStore:
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, artifact_id: str) -> str:
+        if not is_artifact_id(artifact_id):
+            raise ArtifactNotFoundError(f"Некорректный id файла: {artifact_id}")
+        return os.path.join(self.directory, artifact_id[:2], artifact_id)
+
+    def put(self, artifact_id: str, data: bytes, meta: dict) -> None:
+        path = self._path(artifact_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Метаданные пишутся первыми: появившийся файл сразу отдаётся с именем и типом
+        _atomic_write(f"{path}.json", json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+        # Содержимое адресуется хешем: если файл уже есть, он тот же самый
+        if not os.path.exists(path):
+            _atomic_write(path, data)
+
+    def meta(self, artifact_id: str) -> dict:
+        path = self._path(artifact_id)
+        if not os.path.exists(path):
+            raise ArtifactNotFoundError(f"Файл {artifact_id} не найден.")
+        try:
+            with open(f"{path}.json", "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {"size": os.path.getsize(path)}
+
+    def iter_chunks(self, artifact_id: str) -> Iterator[bytes]:
+        path = self._path(artifact_id)
+        if not os.path.exists(path):
+            raise ArtifactNotFoundError(f"Файл {artifact_id} не найден.")
+
+        def chunks():
+            with open(path, "rb") as f:
+                while chunk := f.read(ARTIFACT_CHUNK_SIZE):
+                    yield chunk
+
+        return chunks()
+
+
+class MemoryArtifactStore:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: OrderedDict[str, tuple[bytes, dict]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def put(self, artifact_id: str, data: bytes, meta: dict) -> None:
+        with self._lock:
+            if artifact_id in self._items:
+                self._items.move_to_end(artifact_id)
+                self._items[artifact_id] = (self._items[artifact_id][0], meta)
+                return
+            self._items[artifact_id] = (data, meta)
+            self._size += len(data)
+            # Вытесняем самые старые файлы, но только что добавленный оставляем в любом случае
+            while self._size > self.max_bytes and len(self._items) > 1:
+                _, (old_data, _) = self._items.popitem(last=False)
+                self._size -= len(old_data)
+
+    def _get(self, artifact_id: str) -> tuple[bytes, dict]:
+        with self._lock:
+            if artifact_id not in self._items:
+                raise ArtifactNotFoundError(f"Файл {artifact_id} не найден (или вытеснен из памяти).")
+            self._items.move_to_end(artifact_id)
+            return self._items[artifact_id]
+
+    def meta(self, artifact_id: str) -> dict:
+        return self._get(artifact_id)[1]
+
+    def iter_chunks(self, artifact_id: str) -> Iterator[bytes]:
+        data = memoryview(self._get(artifact_id)[0])
+        return (bytes(data[i:i + ARTIFACT_CHUNK_SIZE]) for i in range(0, len(data), ARTIFACT_CHUNK_SIZE))
+
+
+if ARTIFACT_BACKEND == "memory":
+    _store = MemoryArtifactStore(int(ARTIFACT_MEMORY_MAX_MB * 1024 * 1024))
+else:
+    _store = DiskArtifactStore(ARTIFACT_DIR)
+
+
+def put(data: bytes, filename: str, content_type: str = DOCX_CONTENT_TYPE) -> str:
+    """Сохраняет файл и возвращает его id (sha256 содержимого)."""
+    artifact_id = hashlib.sha256(data).hexdigest()
+    _store.put(artifact_id, data, {"filename": filename, "content_type": content_type, "size": len(data)})
+    return artifact_id
+
+
+def exists(artifact_id: str) -> bool:
+    """Есть ли файл в хранилище (в памяти он мог быть вытеснен)."""
+    try:
+        _store.meta(artifact_id)
+        return True
+    except ArtifactNotFoundError:
+        return False
+
+
+def get_meta(artifact_id: str) -> dict:
+    """Имя файла, content-type и размер."""
+    return _store.meta(artifact_id)
+
+
+def iter_chunks(artifact_id: str) -> Iterator[bytes]:
+    """Содержимое файла частями по ARTIFACT_CHUNK_SIZE (для потоковой отдачи)."""
+    return _store.iter_chunks(artifact_id)
+
+
+def download_url(artifact_id: str) -> str:
+    return f"{PUBLIC_API_URL}/download/{artifact_id}"
@@ -0,0 +1,96 @@
+# services/coalescing_service.py
+# Объединение одинаковых одновременных запросов (single-flight). Когда команда одновременно
+# просит у бота одно и то же ТЗ или термин, конвейер поиска и LLM выполняется один раз:
+# повторные запросы присоединяются к уже идущему вычислению и получают его результат.
+# Документы объединяются только в пределах одного автора: результат содержит document_id, content_id и
+# ссылки на файлы, по которым документ можно дорабатывать и выгружать, а это право владельца.
+import re
+import threading
+
+
+def normalize_query(query: str) -> str:
+    """Приводит запрос к каноническому виду: регистр, пробелы, пунктуация по краям."""
+    query = re.sub(r"\s+", " ", (query or "").lower().replace("ё", "е")).strip()
+    return query.strip(" .,!?;:«»\"'")
+
+
+def request_key(request_type: str, query: str, template_name: str | None, index_version: str,
+                output_format: str | None = None, author: str | None = None) -> tuple:
+    """
+    Ключ объединения: одинаковые по смыслу запросы к одной версии индекса дают одинаковый ключ.
+    Для документов в ключ входит автор; определения терминов разделяются между всеми пользователями.
+    """
+    request_type = (request_type or "").strip().lower()
+    return (
+        request_type,
+        normalize_query(query),
+        (template_name or "").strip(),
+        index_version,
+        (output_format or "").replace(" ", "").lower(),
+        (author or "") if request_type == "document" else "",
+    )
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """Выполняет fn один раз на ключ среди одновременных вызовов; остальные ждут и получают тот же результат."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[tuple, _Call] = {}
+        self._executed = 0
+        self._coalesced = 0
+
+    def do(self, key: tuple, fn):
+        """Возвращает (результат, shared): shared=True, если результат получен от чужого вычисления."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.followers += 1
+                self._coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self._executed += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            # Ключ удаляется до пробуждения ожидающих: следующий запрос после завершения считается заново
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+            if call.followers:
+                print(f"Single-flight: результат разделён с {call.followers} одинаковыми запросами.")
+        return call.result, False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "executed": self._executed,
+                # Столько полных прогонов конвейера (поиск + LLM) сэкономлено
+                "coalesced": self._coalesced,
+                "in_flight": len(self._calls),
+                "waiting": sum(c.followers for c in self._calls.values()),
+            }
+
+
+process_flight = SingleFlight()
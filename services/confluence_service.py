@@ -57,16 +57,16 @@ def search_confluence(query: str, limit: int = 10) -> str:
         print(f"   Произошла ошибка при поиске в Confluence: {e}")
         return ""
 
-def get_all_pages_from_space(space_key: str, limit: int = 50) -> list[str]:
+def iter_pages_from_space(space_key: str, limit: int = 50):
     """
-    Рекурсивно получает все страницы из указанного пространства Confluence.
+    Отдаёт страницы указанного пространства Confluence по одной, запрашивая их порциями по limit.
     """
     if not confluence:
         print("Клиент Confluence не доступен. Загрузка всех страниц не выполнена.")
-        return []
+        return
 
-    all_content = []
     start = 0
+    loaded = 0
     has_more = True
 
     print(f"  Скачивание страниц из пространства '{space_key}'...")
@@ -79,29 +79,32 @@ def get_all_pages_from_space(space_key: str, limit: int = 50) -> list[str]:
                 limit=limit,
                 expand='body.storage'
             )
-            
-            if not response:
-                has_more = False
-                break
-
-            for page in response:
-                title = page.get('title', 'Без заголовка')
-                # Извлекаем текст из body.storage
-                content = page.get('body', {}).get('storage', {}).get('value', '')
-                if content:
-                    formatted_page = f"--- СТРАНИЦА: {title} ---\n{content}"
-                    all_content.append(formatted_page)
-            
-            # Проверяем, есть ли еще страницы
-            if len(response) < limit:
-                has_more = False
-            else:
-                start += limit
-                print(f"    Загружено {len(all_content)} страниц, продолжаю...")
-
         except Exception as e:
             print(f"    ОШИБКА при получении страниц: {e}")
+            break
+
+        if not response:
+            break
+
+        for page in response:
+            title = page.get('title', 'Без заголовка')
+            # Извлекаем текст из body.storage
+            content = page.get('body', {}).get('storage', {}).get('value', '')
+            if content:
+                loaded += 1
+                yield f"--- СТРАНИЦА: {title} ---\n{content}"
+
+        # Проверяем, есть ли еще страницы
+        if len(response) < limit:
             has_more = False
+        else:
+            start += limit
+            print(f"    Загружено {loaded} страниц, продолжаю...")
 
-    print(f"  Завершили загрузку. Всего страниц: {len(all_content)}")
-    return all_content
+    print(f"  Завершили загрузку. Всего страниц: {loaded}")
+
+def get_all_pages_from_space(space_key: str, limit: int = 50) -> list[str]:
+    """
+    Рекурсивно получает все страницы из указанного пространства Confluence.
+    """
+    return list(iter_pages_from_space(space_key, limit=limit))
@@ -0,0 +1,100 @@
+# services/content_store.py
+# Хранилище сгенерированного текста документов. Готовый Markdown сохраняется под id, равным sha256
+# от заголовка и текста, вместе с метаданными запроса, поэтому тот же документ можно выгрузить в
+# другом формате или скачать повторно через /export/<id>, не запуская LLM заново. Одинаковый текст
+# получает тот же id, а одновременные одинаковые запросы не затирают чужие файлы.
+#
+# Структура на диске:
+#   generated/<id[:2]>/<id>.md     — текст документа (Markdown)
+#   generated/<id[:2]>/<id>.json   — заголовок, запрос, автор, время и выгрузки {формат: id файла}
+import os
+import json
+import uuid
+import hashlib
+import threading
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CONTENT_STORE_DIR = os.getenv("CONTENT_STORE_DIR", "generated")
+
+_lock = threading.Lock()
+
+
+class ContentNotFoundError(Exception):
+    """Документ с указанным id отсутствует в хранилище."""
+    pass
+
+
+def content_id_for(content: str, title: str) -> str:
+    return hashlib.sha256(f"{title}\n\n{content}".encode("utf-8")).hexdigest()
+
+
+def _path(content_id: str, ext: str) -> str:
+    # id — hex sha256, проверяем, чтобы из URL нельзя было выйти за пределы хранилища
+    if len(content_id) != 64 or not all(c in "0123456789abcdef" for c in content_id):
+        raise ContentNotFoundError(f"Некорректный id документа: {content_id}")
+    return os.path.join(CONTENT_STORE_DIR, content_id[:2], f"{content_id}.{ext}")
+
+
+def _atomic_write(path: str, text: str) -> None:
+    # Уникальный временный файл: одинаковый документ могут сохранять одновременно несколько потоков
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def _read_meta(content_id: str) -> dict:
+    meta_path = _path(content_id, "json")
+    if not os.path.exists(meta_path):
+        raise ContentNotFoundError(f"Документ {content_id} не найден.")
+    with open(meta_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save(content: str, title: str, **meta) -> str:
+    """Сохраняет текст документа с метаданными (query, author, intent_type и т.п.) и возвращает его id."""
+    content_id = content_id_for(content, title)
+    text_path = _path(content_id, "md")
+    os.makedirs(os.path.dirname(text_path), exist_ok=True)
+    with _lock:
+        if not os.path.exists(text_path):
+            _atomic_write(text_path, content)
+        try:
+            # Тот же текст уже сохранялся: прежние выгрузки и время создания остаются
+            stored = _read_meta(content_id)
+        except ContentNotFoundError:
+            stored = {
+                "content_id": content_id,
+                "title": title,
+                "size": len(content.encode("utf-8")),
+                "exports": {},
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+            }
+        # Метаданные описывают первый запрос, давший этот текст; повторы их не переписывают
+        for key, value in meta.items():
+            if value is not None:
+                stored.setdefault(key, value)
+        _atomic_write(_path(content_id, "json"), json.dumps(stored, ensure_ascii=False, indent=2))
+    return content_id
+
+
+def load(content_id: str) -> tuple[str, dict]:
+    """Текст документа и его метаданные."""
+    meta = _read_meta(content_id)
+    with open(_path(content_id, "md"), "r", encoding="utf-8") as f:
+        return f.read(), meta
+
+
+def get_meta(content_id: str) -> dict:
+    return _read_meta(content_id)
+
+
+def record_exports(content_id: str, artifacts: dict[str, str]) -> None:
+    """Запоминает id готовых файлов по форматам, чтобы повторная выгрузка не рендерила документ заново."""
+    with _lock:
+        meta = _read_meta(content_id)
+        meta["exports"] = {**meta.get("exports", {}), **artifacts}
+        _atomic_write(_path(content_id, "json"), json.dumps(meta, ensure_ascii=False, indent=2))
@@ -0,0 +1,171 @@
+# services/document_store.py
+# Хранилище документов, генерируемых по разделам (ТЗ, Руководство пользователя).
+# Каждый раздел сохраняется сразу после генерации, поэтому упавший на середине документ
+# можно дозапустить, а отдельный раздел — перегенерировать без повторной работы LLM над остальными.
+#
+# Структура на диске:
+#   documents/<document_id>/meta.json        — запрос, список разделов, статус
+#   documents/<document_id>/sections/NN.md   — готовый текст раздела NN
+import os
+import json
+import uuid
+import threading
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DOCUMENT_STORE_DIR = os.getenv("DOCUMENT_STORE_DIR", "documents")
+# Документ в статусе in_progress без обновлений дольше этого срока считается брошенным (процесс упал)
+# и может быть запущен заново; каждый сохранённый раздел продлевает срок
+DOCUMENT_STALE_SECONDS = int(os.getenv("DOCUMENT_STALE_SECONDS", "1800"))
+
+_lock = threading.Lock()
+
+
+class DocumentNotFoundError(Exception):
+    """Документ с указанным id отсутствует в хранилище."""
+    pass
+
+
+class DocumentBusyError(Exception):
+    """Документ уже генерируется другим запросом."""
+    pass
+
+
+def _doc_dir(document_id: str) -> str:
+    # id генерируется нами (hex), но проверяем, чтобы из URL нельзя было выйти за пределы хранилища
+    if not document_id or not all(c in "0123456789abcdef" for c in document_id):
+        raise DocumentNotFoundError(f"Некорректный id документа: {document_id}")
+    return os.path.join(DOCUMENT_STORE_DIR, document_id)
+
+
+def _atomic_write(path: str, text: str) -> None:
+    # Уникальный временный файл: один и тот же файл могут записывать одновременно несколько потоков
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def _read_meta(document_id: str) -> dict:
+    meta_path = os.path.join(_doc_dir(document_id), "meta.json")
+    if not os.path.exists(meta_path):
+        raise DocumentNotFoundError(f"Документ {document_id} не найден.")
+    with open(meta_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_meta(document_id: str, meta: dict) -> None:
+    meta["updated_at"] = datetime.now().isoformat(timespec="seconds")
+    _atomic_write(
+        os.path.join(_doc_dir(document_id), "meta.json"),
+        json.dumps(meta, ensure_ascii=False, indent=2),
+    )
+
+
+def create_document(query: str, intent_type: str, title: str, sections: list[tuple[str, str]],
+                    template_name: str | None = None, author: str | None = None,
+                    output_formats: list[str] | None = None) -> str:
+    """Регистрирует новый документ и возвращает его id."""
+    document_id = uuid.uuid4().hex
+    os.makedirs(os.path.join(_doc_dir(document_id), "sections"), exist_ok=True)
+    now = datetime.now().isoformat(timespec="seconds")
+    meta = {
+        "document_id": document_id,
+        "query": query,
+        "intent_type": intent_type,
+        "title": title,
+        "template_name": template_name,
+        "author": author,
+        "sections": [{"title": t, "hint": h} for t, h in sections],
+        "status": "in_progress",
+        "error": None,
+        "output_formats": output_formats or ["docx"],
+        "artifact_id": None,
+        "artifacts": {},
+        "created_at": now,
+    }
+    with _lock:
+        _write_meta(document_id, meta)
+    return document_id
+
+
+def load_document(document_id: str) -> dict:
+    """Возвращает метаданные документа и тексты уже готовых разделов (texts: {индекс: текст})."""
+    meta = _read_meta(document_id)
+    sections_dir = os.path.join(_doc_dir(document_id), "sections")
+    texts = {}
+    for index in range(len(meta["sections"])):
+        section_path = os.path.join(sections_dir, f"{index:02d}.md")
+        if os.path.exists(section_path):
+            with open(section_path, "r", encoding="utf-8") as f:
+                texts[index] = f.read()
+    meta["texts"] = texts
+    return meta
+
+
+def save_section(document_id: str, index: int, text: str) -> None:
+    """Сохраняет текст раздела сразу после генерации и отмечает в метаданных, что генерация жива."""
+    section_path = os.path.join(_doc_dir(document_id), "sections", f"{index:02d}.md")
+    with _lock:
+        _atomic_write(section_path, text)
+        _write_meta(document_id, _read_meta(document_id))
+
+
+def start_generation(document_id: str) -> dict:
+    """
+    Атомарно переводит документ в in_progress и возвращает прежние status и error.
+    Если документ уже генерируется (и не брошен), бросает DocumentBusyError.
+    """
+    with _lock:
+        meta = _read_meta(document_id)
+        if meta["status"] == "in_progress":
+            updated_at = datetime.fromisoformat(meta.get("updated_at") or meta["created_at"])
+            if (datetime.now() - updated_at).total_seconds() < DOCUMENT_STALE_SECONDS:
+                raise DocumentBusyError(f"Документ {document_id} уже генерируется, дождитесь завершения.")
+            print(f"Документ {document_id} в статусе in_progress без обновлений с {updated_at}, запускаю заново.")
+        previous = {"status": meta["status"], "error": meta.get("error")}
+        meta.update(status="in_progress", error=None)
+        _write_meta(document_id, meta)
+    return previous
+
+
+def update_document(document_id: str, **fields) -> None:
+    """Обновляет поля метаданных (status, error, artifact_id, artifacts и т.п.)."""
+    with _lock:
+        meta = _read_meta(document_id)
+        meta.update(fields)
+        _write_meta(document_id, meta)
+
+
+def find_section_index(document: dict, section: str) -> int:
+    """Находит раздел по номеру (с 1) или по названию."""
+    section = section.strip()
+    titles = [s["title"] for s in document["sections"]]
+    if section.isdigit() and 1 <= int(section) <= len(titles):
+        return int(section) - 1
+    for index, title in enumerate(titles):
+        if title == section or title.lower().startswith(section.lower()):
+            return index
+    raise KeyError(f"Раздел '{section}' не найден. Доступные разделы: {'; '.join(titles)}")
+
+
+def document_summary(document: dict) -> dict:
+    """Краткое описание документа для API: статус и готовность каждого раздела."""
+    return {
+        "document_id": document["document_id"],
+        "title": document["title"],
+        "intent_type": document["intent_type"],
+        "status": document["status"],
+        "error": document.get("error"),
+        "artifact_id": document.get("artifact_id"),
+        "artifacts": document.get("artifacts") or {},
+        "content_id": document.get("content_id"),
+        "sections": [
+            {"index": i + 1, "title": s["title"], "done": i in document["texts"]}
+            for i, s in enumerate(document["sections"])
+        ],
+        "completed_sections": len(document["texts"]),
+        "total_sections": len(document["sections"]),
+    }
@@ -0,0 +1,237 @@
+# services/docx_renderer.py
+# Рендер дерева блоков Markdown (services/markdown_tree.py) в DOCX: заголовки, списки, таблицы,
+# цитаты и блоки кода получают свои стили из базового документа, оформленного по ГОСТ
+# (Times New Roman 14, полуторный интервал, абзацный отступ 1,25 см, поля 30/15/20/20 мм).
+# Базовый документ собирается один раз на процесс, а для каждого запроса клонируется из байтов.
+# Кроме разбора Markdown модуль не зависит от остальных сервисов, чтобы его можно было выполнять в пуле процессов.
+import io
+import os
+import threading
+from functools import lru_cache
+
+from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
+from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+from docx.oxml.table import CT_Tbl
+from docx.shared import Cm, Mm, Pt, RGBColor
+from docx.table import Table
+from docx.text.paragraph import Paragraph
+
+from services import markdown_tree
+
+# Свой .docx с готовыми стилями вместо встроенного ГОСТ-оформления (необязательно)
+DOCX_BASE_TEMPLATE = os.getenv("DOCX_BASE_TEMPLATE", "")
+
+BASE_FONT = "Times New Roman"
+CODE_FONT = "Courier New"
+CODE_STYLE = "Code"
+TABLE_TEXT_STYLE = "Table Text"
+
+_base_lock = threading.Lock()
+
+
+def _set_font(style, name: str, size: float | None = None, bold: bool | None = None) -> None:
+    style.font.name = name
+    rfonts = style.element.get_or_add_rPr().get_or_add_rFonts()
+    # Темы шрифтов (Calibri Light у заголовков) перекрывают явно заданный шрифт
+    for attr in ("w:asciiTheme", "w:hAnsiTheme", "w:eastAsiaTheme", "w:cstheme"):
+        rfonts.attrib.pop(qn(attr), None)
+    rfonts.set(qn("w:eastAsia"), name)
+    rfonts.set(qn("w:cs"), name)
+    if size is not None:
+        style.font.size = Pt(size)
+    if bold is not None:
+        style.font.bold = bold
+    style.font.color.rgb = RGBColor(0, 0, 0)
+
+
+def _ensure_paragraph_style(doc, name: str):
+    try:
+        return doc.styles[name]
+    except KeyError:
+        style = doc.styles.add_style(name, WD_STYLE_TYPE.PARAGRAPH)
+        style.base_style = doc.styles["Normal"]
+        return style
+
+
+def _apply_gost_styles(doc) -> None:
+    for section in doc.sections:
+        section.page_width, section.page_height = Mm(210), Mm(297)
+        section.left_margin, section.right_margin = Mm(30), Mm(15)
+        section.top_margin, section.bottom_margin = Mm(20), Mm(20)
+
+    normal = doc.styles["Normal"]
+    _set_font(normal, BASE_FONT, 14)
+    fmt = normal.paragraph_format
+    fmt.line_spacing = 1.5
+    fmt.first_line_indent = Cm(1.25)
+    fmt.space_before = fmt.space_after = Pt(0)
+    fmt.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
+
+    title = doc.styles["Title"]
+    _set_font(title, BASE_FONT, 16, bold=True)
+    pbdr = title.element.get_or_add_pPr().find(qn("w:pBdr"))
+    if pbdr is not None:
+        title.element.pPr.remove(pbdr)
+    title.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    title.paragraph_format.first_line_indent = Cm(0)
+    title.paragraph_format.space_after = Pt(12)
+
+    for level in range(1, 7):
+        heading = doc.styles[f"Heading {level}"]
+        _set_font(heading, BASE_FONT, 16 if level == 1 else 14, bold=True)
+        heading.font.italic = False
+        hfmt = heading.paragraph_format
+        hfmt.first_line_indent = Cm(1.25)
+        hfmt.alignment = WD_ALIGN_PARAGRAPH.LEFT
+        hfmt.space_before, hfmt.space_after = Pt(12), Pt(6)
+        hfmt.keep_with_next = True
+
+    for name in ("List Bullet", "List Bullet 2", "List Bullet 3", "List", "List 2", "List 3", "Quote"):
+        _set_font(doc.styles[name], BASE_FONT, 14)
+    doc.styles["Quote"].font.italic = True
+
+    code = _ensure_paragraph_style(doc, CODE_STYLE)
+    _set_font(code, CODE_FONT, 10)
+    code.paragraph_format.line_spacing = 1.0
+    code.paragraph_format.first_line_indent = Cm(0)
+    code.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.LEFT
+    code.paragraph_format.space_before = code.paragraph_format.space_after = Pt(6)
+
+    table_text = _ensure_paragraph_style(doc, TABLE_TEXT_STYLE)
+    _set_font(table_text, BASE_FONT, 12)
+    table_text.paragraph_format.line_spacing = 1.0
+    table_text.paragraph_format.first_line_indent = Cm(0)
+    table_text.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.LEFT
+
+
+@lru_cache(maxsize=1)
+def base_template_bytes() -> bytes:
+    """Базовый документ со стилями ГОСТ (или DOCX_BASE_TEMPLATE) без содержимого, собранный один раз."""
+    with _base_lock:
+        if DOCX_BASE_TEMPLATE:
+            doc = Document(DOCX_BASE_TEMPLATE)
+            _ensure_paragraph_style(doc, CODE_STYLE)
+            _ensure_paragraph_style(doc, TABLE_TEXT_STYLE)
+        else:
+            doc = Document()
+            _apply_gost_styles(doc)
+        # Оставляем только параметры раздела (sectPr): содержимое шаблона в документ не попадает
+        body = doc.element.body
+        for child in list(body):
+            if child.tag != qn("w:sectPr"):
+                body.remove(child)
+        buffer = io.BytesIO()
+        doc.save(buffer)
+        return buffer.getvalue()
+
+
+def _add_spans(paragraph, spans: list[tuple[str, str]]) -> None:
+    """Добавляет куски текста с разметкой (жирный, курсив, код) отдельными runs."""
+    for style, text in spans:
+        run = paragraph.add_run(text)
+        if style == "b":
+            run.bold = True
+        elif style == "i":
+            run.italic = True
+        elif style == "code":
+            run.font.name = CODE_FONT
+
+
+class _Renderer:
+    """
+    Блоки добавляются прямо в XML тела документа. Document.add_paragraph ищет sectPr среди всех
+    уже добавленных блоков, а присваивание стиля по объекту ищет стиль по умолчанию среди всех
+    стилей — на документе в десятки тысяч строк это квадратичная работа.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        section = doc.sections[-1]
+        self.block_width = section.page_width - section.left_margin - section.right_margin
+        self.body = doc.element.body
+        # sectPr должен быть последним в теле: снимаем его на время рендера и возвращаем в finish()
+        self.sect_pr = self.body.find(qn("w:sectPr"))
+        if self.sect_pr is not None:
+            self.body.remove(self.sect_pr)
+        self.style_ids: dict[str, str] = {}
+
+    def style_id(self, name: str) -> str:
+        style_id = self.style_ids.get(name)
+        if style_id is None:
+            style_id = self.style_ids[name] = self.doc.styles[name].style_id
+        return style_id
+
+    def new_paragraph(self, style_name: str = "Normal") -> Paragraph:
+        p = OxmlElement("w:p")
+        self.body.append(p)
+        if style_name != "Normal":
+            p.style = self.style_id(style_name)
+        return Paragraph(p, self.doc._body)
+
+    def paragraph(self, spans: list[tuple[str, str]], style_name: str = "Normal") -> Paragraph:
+        paragraph = self.new_paragraph(style_name)
+        _add_spans(paragraph, spans)
+        return paragraph
+
+    def table(self, rows: list[list[list[tuple[str, str]]]]) -> None:
+        columns = max(len(row) for row in rows)
+        tbl = CT_Tbl.new_tbl(len(rows), columns, self.block_width)
+        tbl.tblPr.style = self.style_id("Table Grid")
+        self.body.append(tbl)
+        text_style_id = self.style_id(TABLE_TEXT_STYLE)
+        for row_index, (row, table_row) in enumerate(zip(rows, Table(tbl, self.doc._body).rows)):
+            for spans, cell in zip(row, table_row.cells):
+                paragraph = cell.paragraphs[0]
+                paragraph._p.style = text_style_id
+                if row_index == 0:
+                    paragraph.add_run(markdown_tree.plain_text(spans)).bold = True
+                else:
+                    _add_spans(paragraph, spans)
+
+    def finish(self) -> None:
+        if self.sect_pr is not None:
+            self.body.append(self.sect_pr)
+
+    def render(self, blocks: list[tuple], title: str | None) -> None:
+        if title:
+            self.paragraph([("", title)], "Title")
+        for block in blocks:
+            kind = block[0]
+            if kind == "paragraph":
+                self.paragraph(block[1])
+            elif kind == "heading":
+                self.paragraph(block[2], f"Heading {block[1]}")
+            elif kind == "bullet":
+                self.paragraph(block[2], f"List Bullet{_level_suffix(block[1])}")
+            elif kind == "numbered":
+                # Номер берём из текста: нумерация Word сквозная и не перезапускается у каждого списка
+                self.paragraph(markdown_tree.with_prefix(f"{block[2]} ", block[3]), f"List{_level_suffix(block[1])}")
+            elif kind == "quote":
+                self.paragraph(block[1], "Quote")
+            elif kind == "code":
+                # Переносы строк внутри одного абзаца: run.text превращает \n в разрывы строк
+                self.new_paragraph(CODE_STYLE).add_run(block[1])
+            elif kind == "table":
+                self.table(block[1])
+        self.finish()
+
+
+def _level_suffix(level: int) -> str:
+    return f" {level + 1}" if level else ""
+
+
+def render_blocks(blocks: list[tuple], title: str | None = None) -> bytes:
+    """Рендерит дерево блоков в DOCX на копии базового документа и возвращает байты файла."""
+    doc = Document(io.BytesIO(base_template_bytes()))
+    _Renderer(doc).render(blocks, title)
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def render(content: str, title: str | None = None) -> bytes:
+    """Рендерит Markdown в DOCX (разбор и рендер в одном вызове)."""
+    return render_blocks(markdown_tree.parse(content), title)
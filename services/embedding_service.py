@@ -0,0 +1,173 @@
+# services/embedding_service.py
+# Выбор модели эмбеддингов для KnowledgeService. По умолчанию модель GPT4All загружается в процесс
+# (local). При нескольких воркерах uvicorn каждый грузил бы свою копию модели, поэтому можно
+# вынести её в общий сервер эмбеддингов (embedding_server.py) и переключиться на remote:
+# модель загружается один раз, а запросы всех воркеров склеиваются в микро-батчи.
+import os
+import time
+import hashlib
+import threading
+import requests
+from typing import Callable, List
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# local — модель в процессе, remote — общий сервер эмбеддингов, stub — детерминированная заглушка (нагрузочные тесты)
+EMBEDDINGS_BACKEND = os.getenv("EMBEDDINGS_BACKEND", "local")
+EMBEDDING_SERVER_URL = os.getenv("EMBEDDING_SERVER_URL", "http://127.0.0.1:8100")
+EMBEDDING_SERVER_TIMEOUT = float(os.getenv("EMBEDDING_SERVER_TIMEOUT", "60"))
+# Параметры микро-батчинга на стороне сервера
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "10"))
+# Размерность заглушки совпадает с моделью GPT4All (all-MiniLM-L6-v2), чтобы индексы были совместимы
+STUB_EMBEDDING_DIM = int(os.getenv("STUB_EMBEDDING_DIM", "384"))
+
+
+class EmbeddingCountError(Exception):
+    """Модель вернула не по одному вектору на каждый текст."""
+    pass
+
+
+def check_embedding_count(texts: List[str], embeddings: List[List[float]]) -> List[List[float]]:
+    # Векторы раздаются по позиции: при несовпадении числа текст получил бы чужой вектор
+    if len(embeddings) != len(texts):
+        raise EmbeddingCountError(f"Получено {len(embeddings)} эмбеддингов на {len(texts)} текстов.")
+    return embeddings
+
+
+class RemoteEmbeddings:
+    """Клиент общего сервера эмбеддингов с интерфейсом embed_query/embed_documents, как у GPT4AllEmbeddings."""
+
+    def __init__(self, base_url: str = EMBEDDING_SERVER_URL, timeout: float = EMBEDDING_SERVER_TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        # Сессия держит соединение с сервером открытым между запросами
+        self._session = requests.Session()
+
+    def _post(self, path: str, payload: dict) -> dict:
+        response = self._session.post(f"{self.base_url}{path}", json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._post("/embed_query", {"text": text})["embedding"]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return check_embedding_count(texts, self._post("/embed_documents", {"texts": texts})["embeddings"])
+
+
+class StubEmbeddings:
+    """
+    Детерминированная заглушка для нагрузочных тестов: вектор строится из хешей слов текста,
+    поэтому тексты с общими словами близки, а модель не нужна. Интерфейс как у GPT4AllEmbeddings.
+    """
+
+    def __init__(self, dim: int = STUB_EMBEDDING_DIM):
+        self.dim = dim
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = [0.0] * self.dim
+        for word in text.lower().split():
+            digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dim
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = sum(v * v for v in vector) ** 0.5 or 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(t) for t in texts]
+
+
+class _Pending:
+    def __init__(self, text: str):
+        self.text = text
+        self.done = threading.Event()
+        self.embedding = None
+        self.error: Exception | None = None
+
+
+class MicroBatcher:
+    """
+    Склеивает одиночные запросы эмбеддинга из разных потоков в батчи: первый запрос ждёт
+    до max_wait_ms, пока подтянутся другие, затем весь батч считается одним вызовом embed_batch.
+    """
+
+    def __init__(self, embed_batch: Callable[[List[str]], List[List[float]]],
+                 max_batch: int = EMBEDDING_BATCH_SIZE, max_wait_ms: float = EMBEDDING_BATCH_WAIT_MS):
+        self.embed_batch = embed_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._cond = threading.Condition()
+        self._queue: list[_Pending] = []
+        self._batches = 0
+        self._items = 0
+        self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def embed(self, text: str) -> List[float]:
+        pending = _Pending(text)
+        with self._cond:
+            self._queue.append(pending)
+            self._cond.notify()
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.embedding
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.max_wait
+                while len(self._queue) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(timeout=remaining)
+                batch = self._queue[:self.max_batch]
+                del self._queue[:self.max_batch]
+
+            try:
+                texts = [p.text for p in batch]
+                # Несовпадение числа векторов — ошибка всего батча, а не раздача векторов наугад
+                embeddings = check_embedding_count(texts, self.embed_batch(texts))
+                for pending, embedding in zip(batch, embeddings):
+                    pending.embedding = embedding
+            except Exception as e:
+                for pending in batch:
+                    pending.error = e
+            finally:
+                self._batches += 1
+                self._items += len(batch)
+                for pending in batch:
+                    pending.done.set()
+
+    def stats(self) -> dict:
+        with self._cond:
+            queued = len(self._queue)
+        return {
+            "batches": self._batches,
+            "items": self._items,
+            "avg_batch_size": round(self._items / self._batches, 2) if self._batches else None,
+            "queued": queued,
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+
+def create_embeddings():
+    """Создаёт модель эмбеддингов согласно EMBEDDINGS_BACKEND."""
+    if EMBEDDINGS_BACKEND == "remote":
+        print(f"Использую общий сервер эмбеддингов: {EMBEDDING_SERVER_URL}")
+        return RemoteEmbeddings()
+    if EMBEDDINGS_BACKEND == "stub":
+        print("ВНИМАНИЕ: используются эмбеддинги-заглушки (EMBEDDINGS_BACKEND=stub), только для нагрузочных тестов.")
+        return StubEmbeddings()
+
+    from langchain_community.embeddings import GPT4AllEmbeddings
+    print("Инициализирую модель GPT4All для эмбеддингов...")
+    model = GPT4AllEmbeddings()
+    print("Модель GPT4All готова к работе.")
+    return model
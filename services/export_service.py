@@ -0,0 +1,138 @@
+# services/export_service.py
+# Выгрузка Markdown-ответа модели в DOCX, PDF и HTML. Текст разбирается в дерево блоков один раз
+# (services/markdown_tree.py), а каждый запрошенный формат рендерится из этого дерева в своём процессе
+# пула параллельно. Рендер — чистая работа CPU под GIL: документ на десятки тысяч строк занимает
+# секунды и тормозил бы остальные потоки API (EXPORT_RENDER_PROCESSES=0 — рендер в текущем потоке).
+# Процессы пула при старте собирают базовый DOCX, регистрируют шрифты PDF и строят стили, поэтому
+# запросы этого не повторяют. Текст документа хранится в services/content_store.py, и повторная
+# выгрузка в уже готовом формате отдаёт прежний файл без рендера.
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dotenv import load_dotenv
+
+from services import artifact_store, content_store, docx_renderer, html_service, markdown_tree, pdf_service
+from services.metrics_service import time_stage
+
+load_dotenv()
+
+# По процессу на формат: DOCX, PDF и HTML одного документа рендерятся одновременно
+EXPORT_RENDER_PROCESSES = int(os.getenv("EXPORT_RENDER_PROCESSES", os.getenv("DOCX_RENDER_PROCESSES", "3")))
+# Формат файла, если в запросе output_format не указан
+DEFAULT_OUTPUT_FORMAT = os.getenv("DEFAULT_OUTPUT_FORMAT", "docx")
+
+RENDERERS = {
+    "docx": docx_renderer.render_blocks,
+    "pdf": pdf_service.render,
+    "html": html_service.render,
+}
+CONTENT_TYPES = {
+    "docx": artifact_store.DOCX_CONTENT_TYPE,
+    "pdf": "application/pdf",
+    "html": "text/html; charset=utf-8",
+}
+
+_executor: ProcessPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+class UnknownFormatError(Exception):
+    """Запрошен формат, который сервис выгружать не умеет."""
+    pass
+
+
+def parse_formats(output_format: str | None) -> list[str]:
+    """"pdf", "docx,html" или "all" -> список форматов без повторов; пусто -> DEFAULT_OUTPUT_FORMAT."""
+    value = (output_format or DEFAULT_OUTPUT_FORMAT).strip().lower()
+    if value == "all":
+        return list(RENDERERS)
+    formats = []
+    for fmt in (part.strip().lstrip(".") for part in value.split(",")):
+        if not fmt or fmt in formats:
+            continue
+        if fmt not in RENDERERS:
+            raise UnknownFormatError(
+                f"Формат '{fmt}' не поддерживается. Доступные форматы: {', '.join(RENDERERS)} или all."
+            )
+        formats.append(fmt)
+    return formats or [DEFAULT_OUTPUT_FORMAT]
+
+
+def _warm_up_worker() -> None:
+    """Инициализатор процесса пула: всё, что не зависит от запроса, готовится один раз."""
+    docx_renderer.base_template_bytes()
+    pdf_service.warm_up()
+
+
+def _render(fmt: str, blocks: list[tuple], title: str | None) -> bytes:
+    return RENDERERS[fmt](blocks, title)
+
+
+def _render_executor() -> ProcessPoolExecutor | None:
+    global _executor
+    with _executor_lock:
+        if _executor is None and EXPORT_RENDER_PROCESSES > 0:
+            # spawn: форк процесса с потоками uvicorn и открытыми соединениями небезопасен
+            _executor = ProcessPoolExecutor(
+                max_workers=EXPORT_RENDER_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warm_up_worker,
+            )
+        return _executor
+
+
+def render_formats(content: str, title: str | None, formats: list[str]) -> dict[str, bytes]:
+    """Рендерит Markdown во все форматы параллельно в пуле процессов (или на месте, если пул отключён или сломан)."""
+    global _executor
+    blocks = markdown_tree.parse(content)
+    executor = _render_executor()
+    if executor is not None:
+        try:
+            futures = {fmt: executor.submit(_render, fmt, blocks, title) for fmt in formats}
+            return {fmt: future.result() for fmt, future in futures.items()}
+        except BrokenProcessPool as e:
+            print(f"Пул рендера недоступен ({e}), рендерю в текущем процессе.")
+            with _executor_lock:
+                _executor = None
+    return {fmt: _render(fmt, blocks, title) for fmt in formats}
+
+
+def warm_up() -> None:
+    """Запускает процессы рендера заранее, до первого запроса (инициализатор готовит шрифты и стили)."""
+    executor = _render_executor()
+    if executor is None:
+        _warm_up_worker()
+        return
+    # Пул поднимает процессы по мере надобности: по задаче на процесс, чтобы стартовали все
+    for future in [executor.submit(_render, "html", [], None) for _ in range(EXPORT_RENDER_PROCESSES)]:
+        future.result()
+
+
+def export_document(content: str, title: str, formats: list[str]) -> dict[str, str]:
+    """Создаёт файлы документа в запрошенных форматах и кладёт их в хранилище файлов. Возвращает {формат: id файла}."""
+    print(f"Создаю файлы ({', '.join(formats)}): {title}")
+    with time_stage("export"):
+        rendered = render_formats(content, title, formats)
+        # Файлы собираются в памяти: бот и клиенты скачивают их по HTTP, общий диск не нужен
+        artifacts = {
+            fmt: artifact_store.put(data, filename=f"{title.replace(' ', '_')}.{fmt}", content_type=CONTENT_TYPES[fmt])
+            for fmt, data in rendered.items()
+        }
+
+    print(f"Файлы сохранены в хранилище: {artifacts}")
+    return artifacts
+
+
+def export_stored(content_id: str, formats: list[str]) -> dict[str, str]:
+    """Файлы сохранённого документа по форматам: готовые берутся из хранилища, недостающие рендерятся из текста."""
+    exports = content_store.get_meta(content_id).get("exports", {})
+    artifacts = {fmt: exports[fmt] for fmt in formats if exports.get(fmt) and artifact_store.exists(exports[fmt])}
+    missing = [fmt for fmt in formats if fmt not in artifacts]
+    if missing:
+        content, meta = content_store.load(content_id)
+        rendered = export_document(content, meta["title"], missing)
+        content_store.record_exports(content_id, rendered)
+        artifacts.update(rendered)
+    return {fmt: artifacts[fmt] for fmt in formats}
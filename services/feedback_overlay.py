@@ -0,0 +1,211 @@
+# services/feedback_overlay.py
+# Правки документации (/feedback) как слой поверх основного индекса. Раньше правка ложилась
+# markdown-файлом в feedback/ и попадала в поиск только после правки источников и полной
+# переиндексации. Теперь каждая правка сохраняется в SQLite вместе со своим эмбеддингом и
+# учитывается поиском сразу:
+#   - "replace"/"delete" со старым текстом исправляют найденные чанки, где этот текст встречается
+#     (только сам найденный фрагмент; слишком короткий старый текст чанки не меняет — см. FEEDBACK_MIN_OLD_TEXT);
+#   - правки, близкие к запросу по эмбеддингу, и правки, изменившие найденные чанки, идут в контекст
+#     первыми, выше устаревших фрагментов основного индекса.
+# Правок мало (сотни), поэтому поиск по ним — полный перебор косинусной близости в numpy.
+import os
+import re
+import sqlite3
+import threading
+import numpy as np
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+FEEDBACK_DB_PATH = os.getenv("FEEDBACK_DB_PATH", "feedback/overlay.db")
+# Сколько правок, близких к запросу, добавлять в контекст и с какой косинусной близостью (0–1)
+FEEDBACK_N_RESULTS = int(os.getenv("FEEDBACK_N_RESULTS", "5"))
+FEEDBACK_MIN_SIMILARITY = float(os.getenv("FEEDBACK_MIN_SIMILARITY", "0.35"))
+# Минимальная длина старого текста (без лишних пробелов), при которой правка исправляет чанки: короткий
+# фрагмент вроде одного слова встречается в посторонних чанках. Такая правка только попадает в контекст
+FEEDBACK_MIN_OLD_TEXT = int(os.getenv("FEEDBACK_MIN_OLD_TEXT", "20"))
+
+OVERRIDING_OPERATIONS = ("replace", "delete")
+OPERATION_LABELS = {
+    "replace": "заменить",
+    "delete": "удалить",
+    "add": "добавить",
+    "comment": "комментарий",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS corrections (
+    correction_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    author        TEXT,
+    doc_type      TEXT,
+    doc_ref       TEXT,
+    operation     TEXT NOT NULL,
+    old_text      TEXT,
+    new_text      TEXT,
+    comment       TEXT,
+    embedding     BLOB NOT NULL,
+    active        INTEGER NOT NULL DEFAULT 1,
+    created_at    TEXT NOT NULL
+);
+"""
+_COLUMNS = "correction_id, author, doc_type, doc_ref, operation, old_text, new_text, comment, active, created_at"
+
+
+
+class CorrectionNotFoundError(Exception):
+    """Правка с указанным id отсутствует."""
+    pass
+
+
+def _old_text_pattern(old_text: str) -> re.Pattern | None:
+    """
+    Шаблон поиска старого текста в чанке: любые пробелы и переносы строк между словами, границы слов по краям.
+    None — текст слишком короткий, чтобы исправлять им чанки.
+    """
+    words = old_text.split()
+    if len(" ".join(words)) < FEEDBACK_MIN_OLD_TEXT:
+        return None
+    pattern = r"\s+".join(re.escape(word) for word in words)
+    if re.match(r"\w", words[0]):
+        pattern = r"(?<!\w)" + pattern
+    if re.search(r"\w$", words[-1]):
+        pattern += r"(?!\w)"
+    return re.compile(pattern)
+
+
+def patches_chunks(operation: str, old_text: str | None) -> bool:
+    """Будет ли правка исправлять найденные чанки (а не только попадать в контекст)."""
+    return operation in OVERRIDING_OPERATIONS and bool(old_text) and _old_text_pattern(old_text) is not None
+
+
+def correction_text(operation: str, old_text: str | None, new_text: str | None, comment: str | None) -> str:
+    """Текст, по которому строится эмбеддинг правки: и старый текст (им совпадут устаревшие чанки), и новый."""
+    return "\n".join(part for part in (old_text, new_text, comment) if part) or operation
+
+
+def format_correction(correction: dict) -> str:
+    """Правка в виде фрагмента контекста для LLM."""
+    lines = [
+        "--- ПРАВКА ДОКУМЕНТАЦИИ (приоритетнее остальных фрагментов) ---",
+        f"Операция: {OPERATION_LABELS.get(correction['operation'], correction['operation'])}",
+    ]
+    if correction.get("doc_ref"):
+        lines.append(f"Документ/раздел: {correction['doc_ref']}")
+    if correction.get("old_text"):
+        lines.append(f"Было (устарело): {correction['old_text']}")
+    if correction.get("new_text"):
+        lines.append(f"Стало: {correction['new_text']}")
+    if correction.get("comment"):
+        lines.append(f"Комментарий: {correction['comment']}")
+    return "\n".join(lines)
+
+
+class FeedbackOverlay:
+    def __init__(self, db_path: str = FEEDBACK_DB_PATH):
+        self._lock = threading.Lock()
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+            self._conn.commit()
+        # (version, активные правки, матрица их нормированных эмбеддингов, правки-замены); перечитывается,
+        # когда меняется version(), и подменяется целиком, чтобы параллельный поиск не видел смесь старого и нового
+        self._snapshot: tuple = (None, [], None, [])
+
+    def version(self) -> str:
+        """Меняется при добавлении и отключении правок (в том числе другой репликой API)."""
+        with self._lock:
+            max_id, active = self._conn.execute(
+                "SELECT COALESCE(MAX(correction_id), 0), COALESCE(SUM(active), 0) FROM corrections"
+            ).fetchone()
+        return f"{max_id}-{active}"
+
+    def add(self, embedding: list[float], operation: str, author: str | None = None, doc_type: str | None = None,
+            doc_ref: str | None = None, old_text: str | None = None, new_text: str | None = None,
+            comment: str | None = None) -> int:
+        vector = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO corrections (author, doc_type, doc_ref, operation, old_text, new_text, comment, "
+                "embedding, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (author, doc_type, doc_ref, operation, old_text, new_text, comment, vector.tobytes(),
+                 datetime.now().isoformat(timespec="seconds")),
+            )
+            self._conn.commit()
+            return cursor.lastrowid
+
+    def deactivate(self, correction_id: int) -> None:
+        """Отключает правку (например, когда источник уже исправлен и переиндексирован)."""
+        with self._lock:
+            updated = self._conn.execute(
+                "UPDATE corrections SET active = 0 WHERE correction_id = ?", (correction_id,)
+            ).rowcount
+            self._conn.commit()
+        if not updated:
+            raise CorrectionNotFoundError(f"Правка {correction_id} не найдена.")
+
+    def list_corrections(self, include_inactive: bool = False) -> list[dict]:
+        where = "" if include_inactive else "WHERE active = 1"
+        with self._lock:
+            rows = self._conn.execute(f"SELECT {_COLUMNS} FROM corrections {where} ORDER BY correction_id").fetchall()
+        return [dict(row) for row in rows]
+
+    def _load(self) -> tuple[list[dict], np.ndarray | None, list[tuple[int, re.Pattern, str]]]:
+        version = self.version()
+        if version != self._snapshot[0]:
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT {_COLUMNS}, embedding FROM corrections WHERE active = 1 ORDER BY correction_id"
+                ).fetchall()
+            corrections = [{k: row[k] for k in row.keys() if k != "embedding"} for row in rows]
+            matrix = None
+            if rows:
+                matrix = np.stack([np.frombuffer(row["embedding"], dtype=np.float32) for row in rows])
+                norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+                matrix = matrix / np.where(norms == 0, 1, norms)
+            # (индекс правки, шаблон старого текста, на что заменить)
+            overrides = []
+            for i, c in enumerate(corrections):
+                if c["operation"] not in OVERRIDING_OPERATIONS or not c["old_text"]:
+                    continue
+                pattern = _old_text_pattern(c["old_text"])
+                if pattern is not None:
+                    overrides.append((i, pattern, (c["new_text"] or "") if c["operation"] == "replace" else ""))
+            self._snapshot = (version, corrections, matrix, overrides)
+        return self._snapshot[1:]
+
+    def apply(self, query_embedding: list[float], chunks: list[str],
+              n_results: int = FEEDBACK_N_RESULTS, min_similarity: float = FEEDBACK_MIN_SIMILARITY) -> list[str]:
+        """Исправляет найденные чанки правками и ставит сами правки в начало списка."""
+        corrections, matrix, overrides = self._load()
+        if not corrections:
+            return chunks
+
+        applied: set[int] = set()
+        patched_chunks = []
+        for chunk in chunks:
+            for index, pattern, replacement in overrides:
+                # Заменяется только найденный фрагмент: переносы строк и разметка остального чанка сохраняются
+                chunk, count = pattern.subn(lambda _: replacement, chunk)
+                if count:
+                    applied.add(index)
+            if chunk.strip():
+                patched_chunks.append(chunk)
+
+        similar: list[int] = []
+        if matrix is not None:
+            query = np.asarray(query_embedding, dtype=np.float32)
+            norm = np.linalg.norm(query)
+            if norm and query.shape[0] == matrix.shape[1]:
+                scores = matrix @ (query / norm)
+                similar = [int(i) for i in np.argsort(-scores)[:n_results] if scores[i] >= min_similarity]
+
+        selected = list(dict.fromkeys([*sorted(applied), *similar]))
+        # Заменяющие и удаляющие правки — выше дополнений и комментариев
+        selected.sort(key=lambda i: corrections[i]["operation"] not in OVERRIDING_OPERATIONS)
+        return [format_correction(corrections[i]) for i in selected] + patched_chunks
@@ -0,0 +1,200 @@
+# services/generation_service.py
+# Генерация документа для пути "general" (свободный запрос без жёсткой структуры разделов).
+# Небольшой контекст уходит в один промпт. Большой обрабатывается в режиме map-reduce:
+# группы чанков параллельно сжимаются в заметки по запросу (map), а итоговый документ
+# пишется уже по заметкам (reduce). Так большой контекст помещается в окно небольших
+# локальных моделей, а prefill у крупных моделей становится короче.
+# В режиме outline (по умолчанию) короткий вызов сначала строит план документа, затем каждый
+# пункт плана раскрывается параллельно со своим поиском по базе знаний: длина документа больше
+# не упирается в лимит токенов одного вызова и скорость одного потока декодирования.
+import os
+import re
+import contextvars
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+from services import prompt_service
+from services.llm_service import generate_text
+from services.usage_service import usage_context
+from services.job_service import report_progress, report_section
+from services.profiling_service import span
+from services.knowledge_service import NOT_FOUND_MESSAGE
+
+load_dotenv()
+
+# outline — план + параллельное раскрытие разделов, auto — single/map_reduce по порогу,
+# single — всегда один промпт, map_reduce — всегда map-reduce
+GENERAL_GENERATION_MODE = os.getenv("GENERAL_GENERATION_MODE", "outline")
+# Если суммарный контекст больше порога (в символах), включается map-reduce
+MAP_REDUCE_THRESHOLD_CHARS = int(os.getenv("MAP_REDUCE_THRESHOLD_CHARS", "24000"))
+# Размер группы чанков для одного map-вызова (в символах)
+MAP_GROUP_CHARS = int(os.getenv("MAP_GROUP_CHARS", "12000"))
+MAP_REDUCE_WORKERS = int(os.getenv("MAP_REDUCE_WORKERS", "4"))
+# Сколько раз можно повторно сжимать заметки, если они всё ещё не помещаются в порог
+MAP_REDUCE_MAX_ROUNDS = int(os.getenv("MAP_REDUCE_MAX_ROUNDS", "2"))
+OUTLINE_MAX_SECTIONS = int(os.getenv("OUTLINE_MAX_SECTIONS", "12"))
+# Выборка контекста для построения плана (в символах) и число чанков на поиск под раздел
+OUTLINE_CONTEXT_CHARS = int(os.getenv("OUTLINE_CONTEXT_CHARS", "12000"))
+OUTLINE_SECTION_RESULTS = int(os.getenv("OUTLINE_SECTION_RESULTS", "30"))
+OUTLINE_WORKERS = int(os.getenv("OUTLINE_WORKERS", "4"))
+
+NO_NOTES_MARKER = "НЕТ РЕЛЕВАНТНЫХ СВЕДЕНИЙ"
+CHUNK_SEPARATOR = "\n\n---\n\n"
+# "1. Название | что раскрыть" (допускаем "1)" и тире вместо вертикальной черты)
+_OUTLINE_LINE = re.compile(r"^\s*(\d+)[.)]\s+(.+?)\s*(?:\||\s[—–-]\s)\s*(.+?)\s*$")
+_OUTLINE_TITLE_ONLY = re.compile(r"^\s*(\d+)[.)]\s+(.+?)\s*$")
+
+
+def group_chunks(chunks: list[str], max_chars: int = MAP_GROUP_CHARS) -> list[str]:
+    """Склеивает подряд идущие чанки в группы не длиннее max_chars (одиночный чанк может быть длиннее)."""
+    groups = []
+    current = []
+    current_len = 0
+    for chunk in chunks:
+        if current and current_len + len(chunk) > max_chars:
+            groups.append(CHUNK_SEPARATOR.join(current))
+            current, current_len = [], 0
+        current.append(chunk)
+        current_len += len(chunk) + len(CHUNK_SEPARATOR)
+    if current:
+        groups.append(CHUNK_SEPARATOR.join(current))
+    return groups
+
+
+def _map_group(user_query: str, group: str, label: str) -> str:
+    prompt = prompt_service.render("map_notes", user_query=user_query, context=group)
+    with usage_context(section=label):
+        notes = generate_text(prompt, system=prompt_service.SYSTEM_MESSAGE)
+    return notes.strip()
+
+
+def condense_chunks(user_query: str, chunks: list[str]) -> list[str]:
+    """Шаг map: параллельно сжимает группы чанков в заметки, пустые результаты отбрасываются."""
+    groups = group_chunks(chunks)
+    print(f"Map-reduce: {len(chunks)} чанков -> {len(groups)} групп, параллельно {MAP_REDUCE_WORKERS}.")
+    with ThreadPoolExecutor(max_workers=MAP_REDUCE_WORKERS, thread_name_prefix="map") as executor:
+        # Копируем контекст, чтобы вызовы в потоках попали в журнал расхода с атрибутами запроса
+        futures = [
+            executor.submit(contextvars.copy_context().run, _map_group, user_query, group, f"map {i + 1}/{len(groups)}")
+            for i, group in enumerate(groups)
+        ]
+        notes = [future.result() for future in futures]
+    return [n for n in notes if n and NO_NOTES_MARKER not in n[:len(NO_NOTES_MARKER) + 10]]
+
+
+def map_reduce_generate(user_query: str, chunks: list[str]) -> str:
+    """Map-reduce: заметки по группам чанков, при необходимости повторное сжатие, затем итоговый документ."""
+    notes = chunks
+    for _ in range(MAP_REDUCE_MAX_ROUNDS):
+        notes = condense_chunks(user_query, notes)
+        if sum(len(n) for n in notes) <= MAP_REDUCE_THRESHOLD_CHARS or len(notes) <= 1:
+            break
+
+    context = CHUNK_SEPARATOR.join(notes) if notes else NOT_FOUND_MESSAGE
+    prompt = prompt_service.render("general", user_query=user_query, context=context)
+    with usage_context(section="reduce"):
+        return generate_text(prompt, system=prompt_service.SYSTEM_MESSAGE)
+
+
+def parse_outline(text: str) -> list[tuple[str, str]]:
+    """Разбирает ответ модели с планом в список (название раздела, что раскрыть)."""
+    sections = []
+    for line in text.splitlines():
+        line = line.strip().strip("*").strip()
+        match = _OUTLINE_LINE.match(line)
+        if match:
+            sections.append((f"{match.group(1)}. {match.group(2).strip('*').strip()}", match.group(3)))
+            continue
+        match = _OUTLINE_TITLE_ONLY.match(line)
+        if match:
+            title = f"{match.group(1)}. {match.group(2).strip('*').strip()}"
+            sections.append((title, f"Раскрыть раздел «{match.group(2)}» по запросу."))
+    return sections[:OUTLINE_MAX_SECTIONS]
+
+
+def build_outline(user_query: str, chunks: list[str]) -> list[tuple[str, str]]:
+    """Фаза 1: короткий вызов строит план документа по выборке контекста."""
+    sample = []
+    sample_len = 0
+    for chunk in chunks:
+        if sample and sample_len + len(chunk) > OUTLINE_CONTEXT_CHARS:
+            break
+        sample.append(chunk)
+        sample_len += len(chunk)
+    context = CHUNK_SEPARATOR.join(sample) if sample else NOT_FOUND_MESSAGE
+    prompt = prompt_service.render("outline", user_query=user_query, context=context, max_sections=OUTLINE_MAX_SECTIONS)
+    with usage_context(section="outline"), span("outline"):
+        return parse_outline(generate_text(prompt, system=prompt_service.SYSTEM_MESSAGE))
+
+
+def _expand_section(user_query: str, outline_text: str, title: str, hint: str,
+                    search: Callable[..., list[str]]) -> str:
+    with span("section", title=title):
+        return _expand_section_text(user_query, outline_text, title, hint, search)
+
+
+def _expand_section_text(user_query: str, outline_text: str, title: str, hint: str,
+                         search: Callable[..., list[str]]) -> str:
+    section_chunks = search(query=f"{user_query}. Раздел: {title}. {hint}", n_results=OUTLINE_SECTION_RESULTS)
+    prompt = prompt_service.render(
+        "outline_section",
+        user_query=user_query,
+        outline=outline_text,
+        section_title=title,
+        section_hint=hint,
+        context=CHUNK_SEPARATOR.join(section_chunks) if section_chunks else NOT_FOUND_MESSAGE,
+    )
+    with usage_context(section=title):
+        return generate_text(prompt, system=prompt_service.SYSTEM_MESSAGE).strip()
+
+
+def outline_generate(user_query: str, chunks: list[str], search: Callable[..., list[str]]) -> str | None:
+    """
+    Фаза 2: раскрывает пункты плана параллельно, каждый со своим поиском, и склеивает по порядку.
+    Возвращает None, если план построить не удалось (тогда вызывающий переходит на другой режим).
+    """
+    report_progress(stage="outline")
+    outline = build_outline(user_query, chunks)
+    if len(outline) < 2:
+        print("План документа не распознан, перехожу на генерацию без плана.")
+        return None
+
+    outline_text = "\n".join(f"{title} | {hint}" for title, hint in outline)
+    print(f"План документа: {len(outline)} разделов, раскрываю параллельно {OUTLINE_WORKERS}.")
+    with ThreadPoolExecutor(max_workers=OUTLINE_WORKERS, thread_name_prefix="outline") as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, _expand_section, user_query, outline_text, title, hint, search)
+            for title, hint in outline
+        ]
+        parts = []
+        for (title, _), future in zip(outline, futures):
+            parts.append(future.result())
+            report_section(len(parts) - 1, title, parts[-1])
+            report_progress(stage="sections", completed_sections=len(parts), total_sections=len(outline))
+    return "\n\n".join(parts)
+
+
+def generate_general_document(user_query: str, chunks: list[str],
+                              search: Callable[..., list[str]] | None = None) -> str:
+    """
+    Генерирует документ в режиме GENERAL_GENERATION_MODE. Для outline нужен search(query, n_results) —
+    поиск чанков под каждый раздел; без него используется выбор между одним промптом и map-reduce.
+    """
+    with usage_context(request_type="general"):
+        if GENERAL_GENERATION_MODE == "outline" and search is not None and chunks:
+            document = outline_generate(user_query, chunks, search)
+            if document is not None:
+                return document
+
+        context_chars = sum(len(c) for c in chunks)
+        use_map_reduce = GENERAL_GENERATION_MODE == "map_reduce" or (
+            GENERAL_GENERATION_MODE in ("auto", "outline") and context_chars > MAP_REDUCE_THRESHOLD_CHARS
+        )
+        if use_map_reduce and chunks:
+            print(f"Контекст {context_chars} символов > {MAP_REDUCE_THRESHOLD_CHARS}: генерирую в режиме map-reduce.")
+            return map_reduce_generate(user_query, chunks)
+
+        context = CHUNK_SEPARATOR.join(chunks) if chunks else NOT_FOUND_MESSAGE
+        prompt = prompt_service.render("general", user_query=user_query, context=context)
+        return generate_text(prompt, system=prompt_service.SYSTEM_MESSAGE)
@@ -33,28 +33,33 @@ def list_md_files_from_git() -> list:
 
     return all_files
 
-def load_git_knowledge() -> str:
-    """Загружает текст из всех .md файлов в Git."""
+def iter_git_documents():
+    """Отдаёт .md файлы из Git по одному (с заголовком "--- ФАЙЛ: ... ---"), не собирая их в одну строку."""
     print("Загружаю знания из Git (чтение .md файлов из всех нужных папок)...")
     
     md_files = list_md_files_from_git()
     if not md_files:
         print("Не найдено .md файлов в репозитории.")
-        return ""
+        return
         
     print(f"Найдено {len(md_files)} .md файлов. Начинаю загрузку...")
     
-    full_text = ""
+    total_chars = 0
     for file_path in md_files:
         try:
             raw_url = f"https://raw.githubusercontent.com/{GITHUB_OWNER}/{GITHUB_REPO_NAME}/main/{file_path}"
             response = requests.get(raw_url)
             response.raise_for_status()
             content = response.text
-            full_text += f"--- ФАЙЛ: {file_path} ---\n\n{content}\n\n"
-            
         except Exception as e:
             print(f"   !!! Ошибка при загрузке файла {file_path}: {e}")
+            continue
+        document = f"--- ФАЙЛ: {file_path} ---\n\n{content}\n\n"
+        total_chars += len(document)
+        yield document
             
-    print(f"Загрузка из Git завершена. Общий размер: {len(full_text)} символов.")
-    return full_text
\ No newline at end of file
+    print(f"Загрузка из Git завершена. Общий размер: {total_chars} символов.")
+
+def load_git_knowledge() -> str:
+    """Загружает текст из всех .md файлов в Git одной строкой."""
+    return "".join(iter_git_documents())
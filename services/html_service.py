@@ -1,85 +1,99 @@
 # services/html_service.py
-import markdown
-import os
+# Рендер дерева блоков Markdown (services/markdown_tree.py) в самостоятельную HTML-страницу со
+# встроенными стилями. Страница собирается списком строк и склеивается один раз в конце.
+# Кроме разбора Markdown модуль не зависит от остальных сервисов, чтобы его можно было выполнять в пуле процессов.
+from html import escape
 
-def create_html(content: str, title: str) -> str:
-    """
-    Конвертирует Markdown-текст в красивый HTML-файл.
-    """
-    print(f"Создаю HTML файл: {title}.html")
-    
-    # 1. Конвертируем Markdown в HTML
-    html_content = markdown.markdown(content, extensions=['tables', 'fenced_code'])
-    
-    # 2. Создаем полную HTML-страницу с базовыми стилями
-    full_html = f"""
-    <!DOCTYPE html>
-    <html lang="ru">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>{title}</title>
-        <style>
-            body {{
-                font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, Helvetica, Arial, sans-serif, "Apple Color Emoji", "Segoe UI Emoji", sans-serif;
-                line-height: 1.6;
-                color: #333;
-                max-width: 800px;
-                margin: 0 auto;
-                padding: 20px;
-                background-color: #f4f4f4;
-            }}
-            h1, h2, h3, h4, h5, h6 {{
-                color: #2c3e50;
-                border-bottom: 2px solid #3498db;
-                padding-bottom: 10px;
-            }}
-            table {{
-                border-collapse: collapse;
-                width: 100%;
-                margin: 20px 0;
-                box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-            }}
-            th, td {{
-                border: 1px solid #ddd;
-                padding: 12px;
-                text-align: left;
-                background-color: #f2f2f2;
-            }}
-            th {{
-                font-weight: bold;
-            }}
-            pre {{
-                background-color: #282c34;
-                color: #fff;
-                padding: 15px;
-                border-radius: 5px;
-                overflow-x: auto;
-                font-family: 'Courier New', Courier, monospace;
-            }}
-            blockquote {{
-                border-left: 5px solid #ccc;
-                margin-left: 20px;
-                padding-left: 15px;
-                color: #777;
-                font-style: italic;
-            }}
-        </style>
-    </head>
-    <body>
-        <h1>{title}</h1>
-        {html_content}
-    </body>
-    </html>
-    """
-    
-    # 3. Сохраняем файл
-    if not os.path.exists("output"):
-        os.makedirs("output")
-        
-    file_path = os.path.join("output", f"{title.replace(' ', '_')}.html")
-    with open(file_path, 'w', encoding='utf-8') as f:
-        f.write(full_html)
-        
-    print(f"Файл сохранен по пути: {file_path}")
-    return file_path
\ No newline at end of file
+_STYLE = """
+body {
+    font-family: "Times New Roman", "Liberation Serif", serif;
+    font-size: 14pt;
+    line-height: 1.5;
+    color: #000;
+    max-width: 800px;
+    margin: 0 auto;
+    padding: 20px;
+}
+h1.title { text-align: center; }
+h1, h2, h3, h4, h5, h6 { font-size: 14pt; margin: 12pt 0 6pt; }
+h1 { font-size: 16pt; }
+p { text-indent: 1.25cm; margin: 0; text-align: justify; }
+table { border-collapse: collapse; width: 100%; margin: 12pt 0; font-size: 12pt; line-height: 1.2; }
+th, td { border: 1px solid #000; padding: 4px 6px; text-align: left; vertical-align: top; }
+pre { font-family: "Courier New", monospace; font-size: 10pt; line-height: 1.2; background-color: #f4f4f4;
+      padding: 8px; overflow-x: auto; }
+code { font-family: "Courier New", monospace; }
+blockquote { margin: 0 0 0 1.25cm; font-style: italic; }
+"""
+
+_INLINE_TAGS = {"b": "strong", "i": "em", "code": "code"}
+_LIST_TAGS = {"bullet": "ul", "numbered": "ol"}
+
+
+def _inline(spans: list[tuple[str, str]]) -> str:
+    parts = []
+    for style, text in spans:
+        tag = _INLINE_TAGS.get(style)
+        parts.append(f"<{tag}>{escape(text)}</{tag}>" if tag else escape(text))
+    return "".join(parts)
+
+
+def _table(rows: list[list[list[tuple[str, str]]]]) -> str:
+    header = "".join(f"<th>{_inline(spans)}</th>" for spans in rows[0])
+    body = "".join(
+        "<tr>" + "".join(f"<td>{_inline(spans)}</td>" for spans in row) + "</tr>"
+        for row in rows[1:]
+    )
+    return f"<table><thead><tr>{header}</tr></thead><tbody>{body}</tbody></table>"
+
+
+def render(blocks: list[tuple], title: str | None = None) -> bytes:
+    """Рендерит дерево блоков в HTML-страницу и возвращает её байты (UTF-8)."""
+    out = [
+        '<!DOCTYPE html>\n<html lang="ru">\n<head>\n<meta charset="UTF-8">\n',
+        '<meta name="viewport" content="width=device-width, initial-scale=1.0">\n',
+        f"<title>{escape(title or '')}</title>\n<style>{_STYLE}</style>\n</head>\n<body>\n",
+    ]
+    if title:
+        out.append(f'<h1 class="title">{escape(title)}</h1>\n')
+
+    # Открытые списки: (тег, уровень). Пункты списка в дереве плоские, вложенность — по уровню
+    open_lists: list[tuple[str, int]] = []
+
+    def close_lists(level: int = -1) -> None:
+        while open_lists and open_lists[-1][1] > level:
+            out.append(f"</li></{open_lists.pop()[0]}>\n")
+
+    for block in blocks:
+        kind = block[0]
+        if kind in _LIST_TAGS:
+            tag, level = _LIST_TAGS[kind], block[1]
+            close_lists(level)
+            if open_lists and open_lists[-1][1] == level and open_lists[-1][0] != tag:
+                close_lists(level - 1)
+            if open_lists and open_lists[-1][1] == level:
+                out.append("</li>")
+            else:
+                out.append(f"<{tag}>")
+                open_lists.append((tag, level))
+            if kind == "numbered":
+                number = block[2].rstrip(".)")
+                out.append(f'<li value="{number}">{_inline(block[3])}')
+            else:
+                out.append(f"<li>{_inline(block[2])}")
+            continue
+        close_lists()
+
+        if kind == "paragraph":
+            out.append(f"<p>{_inline(block[1])}</p>\n")
+        elif kind == "heading":
+            out.append(f"<h{block[1]}>{_inline(block[2])}</h{block[1]}>\n")
+        elif kind == "quote":
+            out.append(f"<blockquote>{_inline(block[1])}</blockquote>\n")
+        elif kind == "code":
+            out.append(f"<pre><code>{escape(block[1])}</code></pre>\n")
+        elif kind == "table":
+            out.append(_table(block[1]) + "\n")
+    close_lists()
+    out.append("</body>\n</html>\n")
+    return "".join(out).encode("utf-8")
@@ -0,0 +1,364 @@
+# services/job_service.py
+# Асинхронная очередь задач для /process. Генерация документа идёт минутами, и длинный
+# HTTP-запрос обрывают ngrok, прокси и таймауты бота. Теперь клиент получает id задачи сразу,
+# задачу выполняет пул воркеров, а статус, прогресс и результат запрашиваются отдельно.
+# Задачи хранятся в SQLite, которую могут делить несколько реплик API. Задачу берёт в работу ровно
+# одна реплика (атомарный захват), а пока задача выполняется, реплика-владелец продлевает её аренду.
+# Задачи с истёкшей арендой (реплика упала или перезапустилась) возвращаются в очередь, а после
+# JOB_MAX_ATTEMPTS попыток помечаются как failed, чтобы падающая задача не перезапускалась бесконечно.
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable
+from dotenv import load_dotenv
+
+from services import metrics_service
+from services.admission_service import admission, AdmissionRejectedError, ANONYMOUS_USER
+
+load_dotenv()
+
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "jobs/jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Как часто воркер перепроверяет очередь, если его не разбудили (с)
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "5"))
+# Сколько задач одного пользователя может быть в очереди и в работе одновременно
+JOB_MAX_PENDING_PER_USER = int(os.getenv("JOB_MAX_PENDING_PER_USER", "5"))
+# Аренда задачи (с): владелец продлевает её каждые JOB_LEASE_SECONDS / 3, просроченная задача считается брошенной
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+# Сколько раз задачу можно взять в работу, прежде чем считать её неисполнимой
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+# Статусы: queued -> running -> completed | failed
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id       TEXT PRIMARY KEY,
+    request_type TEXT,
+    author       TEXT,
+    payload      TEXT NOT NULL,
+    status       TEXT NOT NULL,
+    progress     TEXT,
+    result       TEXT,
+    error        TEXT,
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    worker_id    TEXT,
+    heartbeat_at REAL,
+    created_at   TEXT NOT NULL,
+    started_at   TEXT,
+    finished_at  TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE INDEX IF NOT EXISTS jobs_author ON jobs (author, status, started_at);
+-- Готовые разделы документа: клиент может показывать их, не дожидаясь DOCX
+CREATE TABLE IF NOT EXISTS job_sections (
+    job_id     TEXT NOT NULL,
+    idx        INTEGER NOT NULL,
+    title      TEXT,
+    text       TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (job_id, idx)
+);
+"""
+# Колонки, добавленные после первой версии схемы: в существующую базу дописываются при старте
+_ADDED_COLUMNS = {"worker_id": "TEXT", "heartbeat_at": "REAL"}
+
+# Порядок выдачи задач из очереди (q — ожидающая задача); по нему же считается позиция в очереди
+_CLAIM_ORDER = (
+    "(SELECT COUNT(*) FROM jobs r WHERE r.status = 'running' AND r.author IS q.author), "
+    "IFNULL((SELECT MAX(s.started_at) FROM jobs s WHERE s.author IS q.author), ''), "
+    "q.rowid"
+)
+
+# id задачи, которую выполняет текущий поток (для report_progress из глубины конвейера)
+_current_job: contextvars.ContextVar[str | None] = contextvars.ContextVar("current_job", default=None)
+
+
+class JobNotFoundError(Exception):
+    """Задача с указанным id отсутствует в хранилище."""
+    pass
+
+
+def _now() -> str:
+    # Миллисекунды нужны для честной очереди: по started_at определяется, кого обслуживали давнее
+    return datetime.now().isoformat(timespec="milliseconds")
+
+
+class JobQueue:
+    def __init__(self, db_path: str, workers: int):
+        self.db_path = db_path
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._threads: list[threading.Thread] = []
+        self._handler: Callable[[dict], dict] | None = None
+        self._stopping = False
+        self._stopped = threading.Event()
+        # Владелец задач этого процесса (на одном хосте может работать несколько процессов API)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Одно соединение на процесс под замком: нагрузка на хранилище мизерная по сравнению с LLM
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            for name, column_type in _ADDED_COLUMNS.items():
+                if name not in columns:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {column_type}")
+            self._conn.commit()
+
+    @contextmanager
+    def _db(self, immediate: bool = False):
+        # immediate: транзакция сразу берёт блокировку записи, и проверка с последующей записью
+        # (квота, захват задачи) не пересекается с такими же транзакциями других реплик
+        with self._lock:
+            try:
+                if immediate:
+                    self._conn.execute("BEGIN IMMEDIATE")
+                yield self._conn
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def start(self, handler: Callable[[dict], dict]) -> None:
+        """Запускает воркеры и продление аренды. Задачи, прерванные перезапуском, вернутся в очередь
+        по истечении аренды: сразу при старте их не отличить от задач, которые выполняют другие реплики."""
+        if self._threads:
+            return
+        self._handler = handler
+        threads = [threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True)]
+        threads += [
+            threading.Thread(target=self._worker, name=f"job-worker-{i + 1}", daemon=True) for i in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+            self._threads.append(thread)
+        print(f"Очередь задач запущена: {self.workers} воркеров ({self.worker_id}), хранилище {self.db_path}.")
+
+    def stop(self) -> None:
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+        self._stopped.set()
+
+    def submit(self, payload: dict) -> str:
+        """Ставит задачу в очередь и сразу возвращает её id. Сверх квоты пользователя — AdmissionRejectedError."""
+        job_id = uuid.uuid4().hex
+        user = payload.get("author") or ANONYMOUS_USER
+        with self._db(immediate=True) as conn:
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running') AND IFNULL(author, ?) = ?",
+                (ANONYMOUS_USER, user),
+            ).fetchone()[0]
+            if pending >= JOB_MAX_PENDING_PER_USER:
+                metrics_service.count_admission_rejection(user, "job_quota")
+                raise AdmissionRejectedError(
+                    f"У пользователя {user} уже {pending} задач в очереди и в работе. Дождитесь их завершения.",
+                    user, "job_quota", admission.estimate_retry_after(pending, parallel=self.workers),
+                )
+            conn.execute(
+                "INSERT INTO jobs (job_id, request_type, author, payload, status, created_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?)",
+                (job_id, payload.get("request_type"), payload.get("author"),
+                 json.dumps(payload, ensure_ascii=False), _now()),
+            )
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    @staticmethod
+    def _release_stale(conn: sqlite3.Connection) -> int:
+        """Возвращает в очередь задачи с истёкшей арендой; исчерпавшие попытки помечает как failed."""
+        expired = time.time() - JOB_LEASE_SECONDS
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? "
+            "WHERE status = 'running' AND IFNULL(heartbeat_at, 0) < ? AND attempts >= ?",
+            (f"Задача прервана {JOB_MAX_ATTEMPTS} раз(а) и больше не перезапускается.", _now(),
+             expired, JOB_MAX_ATTEMPTS),
+        )
+        return conn.execute(
+            "UPDATE jobs SET status = 'queued', started_at = NULL, worker_id = NULL, heartbeat_at = NULL "
+            "WHERE status = 'running' AND IFNULL(heartbeat_at, 0) < ?",
+            (expired,),
+        ).rowcount
+
+    def _heartbeat(self) -> None:
+        """Продлевает аренду задач, которые выполняет этот процесс."""
+        while True:
+            try:
+                with self._db() as conn:
+                    conn.execute(
+                        "UPDATE jobs SET heartbeat_at = ? WHERE status = 'running' AND worker_id = ?",
+                        (time.time(), self.worker_id),
+                    )
+            except sqlite3.Error as e:
+                print(f"Очередь задач: не удалось продлить аренду задач: {e}")
+            # Отдельное событие, а не _wakeup: notify() из submit должен будить воркер, а не этот поток
+            if self._stopped.wait(timeout=JOB_LEASE_SECONDS / 3):
+                return
+
+    def _claim(self) -> sqlite3.Row | None:
+        # Честная очередь: первой берётся старейшая задача пользователя, у которого сейчас меньше всего
+        # задач в работе, а при равенстве — того, кого обслуживали давнее (round-robin между пользователями).
+        # Выбор и захват — в одной транзакции с блокировкой записи, поэтому задачу получает одна реплика
+        with self._db(immediate=True) as conn:
+            stale = self._release_stale(conn)
+            if stale:
+                print(f"Очередь задач: {stale} задач с истёкшей арендой возвращены в очередь.")
+            row = conn.execute(
+                f"SELECT q.* FROM jobs q WHERE q.status = 'queued' ORDER BY {_CLAIM_ORDER} LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            claimed = conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1, worker_id = ?, "
+                "heartbeat_at = ? WHERE job_id = ? AND status = 'queued'",
+                (_now(), self.worker_id, time.time(), row["job_id"]),
+            ).rowcount
+            return row if claimed else None
+
+    def _finish(self, job_id: str, result: dict | None, error: str | None) -> None:
+        status = "failed" if error else "completed"
+        with self._db() as conn:
+            updated = conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? "
+                "WHERE job_id = ? AND status = 'running' AND worker_id = ?",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None,
+                 error, _now(), job_id, self.worker_id),
+            ).rowcount
+        if not updated:
+            print(f"Задача {job_id}: аренда истекла, задачу забрала другая реплика — результат не сохранён.")
+
+    def _worker(self) -> None:
+        while True:
+            with self._wakeup:
+                if self._stopping:
+                    return
+            row = self._claim()
+            if row is None:
+                with self._wakeup:
+                    if not self._stopping:
+                        self._wakeup.wait(timeout=JOB_POLL_INTERVAL)
+                continue
+
+            job_id = row["job_id"]
+            print(f"Задача {job_id} ({row['request_type']}) взята в работу ({threading.current_thread().name}).")
+            token = _current_job.set(job_id)
+            try:
+                result = self._handler(json.loads(row["payload"]))
+                # Конвейер /process сообщает об ошибках через status="error", а не исключением
+                error = result.get("message") if isinstance(result, dict) and result.get("status") == "error" else None
+                self._finish(job_id, result, error)
+            except Exception as e:
+                print(f"Задача {job_id} завершилась с ошибкой: {e}")
+                self._finish(job_id, None, str(e))
+            finally:
+                _current_job.reset(token)
+
+    def report_progress(self, job_id: str, **fields) -> None:
+        with self._db() as conn:
+            row = conn.execute("SELECT progress FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                return
+            progress = json.loads(row["progress"]) if row["progress"] else {}
+            progress.update(fields)
+            progress["updated_at"] = _now()
+            conn.execute(
+                "UPDATE jobs SET progress = ? WHERE job_id = ?",
+                (json.dumps(progress, ensure_ascii=False), job_id),
+            )
+
+    def add_section(self, job_id: str, index: int, title: str, text: str) -> None:
+        with self._db() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO job_sections (job_id, idx, title, text, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, index, title, text, _now()),
+            )
+
+    def sections(self, job_id: str, after: int = -1) -> list[dict]:
+        """Готовые разделы задачи с номером больше after, по порядку."""
+        with self._db() as conn:
+            if conn.execute("SELECT 1 FROM jobs WHERE job_id = ?", (job_id,)).fetchone() is None:
+                raise JobNotFoundError(f"Задача {job_id} не найдена.")
+            rows = conn.execute(
+                "SELECT idx, title, text FROM job_sections WHERE job_id = ? AND idx > ? ORDER BY idx",
+                (job_id, after),
+            ).fetchall()
+        return [{"index": row["idx"], "title": row["title"], "text": row["text"]} for row in rows]
+
+    def get(self, job_id: str) -> dict:
+        """Возвращает задачу целиком (с payload и результатом)."""
+        with self._db() as conn:
+            row = conn.execute("SELECT rowid, * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            raise JobNotFoundError(f"Задача {job_id} не найдена.")
+        job = dict(row)
+        rowid = job.pop("rowid")
+        for key in ("payload", "progress", "result"):
+            job[key] = json.loads(job[key]) if job[key] else None
+        if job["status"] == "queued":
+            job["queue_position"] = self._queue_position(rowid)
+        return job
+
+    def _queue_position(self, rowid: int) -> int:
+        # Место в порядке _claim на текущий момент: он пересчитывается при каждой выдаче, поэтому позиция —
+        # оценка (задачи других пользователей могут обогнать задачу, если их автор давно не обслуживался)
+        with self._db() as conn:
+            row = conn.execute(
+                "SELECT position FROM (SELECT q.rowid AS id, "
+                f"ROW_NUMBER() OVER (ORDER BY {_CLAIM_ORDER}) AS position "
+                "FROM jobs q WHERE q.status = 'queued') WHERE id = ?",
+                (rowid,),
+            ).fetchone()
+        # Задачу могли забрать между чтением статуса и подсчётом
+        return row[0] if row else 0
+
+    def stats(self) -> dict:
+        with self._db() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {"workers": self.workers, **{s: counts.get(s, 0) for s in ("queued", "running", "completed", "failed")}}
+
+
+def report_progress(**fields) -> None:
+    """Обновляет прогресс текущей задачи. Вне воркера очереди (синхронный /process) ничего не делает."""
+    job_id = _current_job.get()
+    if job_id is not None:
+        job_queue.report_progress(job_id, **fields)
+
+
+def report_section(index: int, title: str, text: str) -> None:
+    """Публикует готовый раздел текущей задачи (индекс с нуля). Вне воркера очереди ничего не делает."""
+    job_id = _current_job.get()
+    if job_id is not None:
+        job_queue.add_section(job_id, index, title, text)
+
+
+def job_summary(job: dict) -> dict:
+    """Краткое описание задачи для API (без payload и результата)."""
+    summary = {
+        "job_id": job["job_id"],
+        "job_status": job["status"],
+        "request_type": job["request_type"],
+        "progress": job["progress"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+    }
+    if "queue_position" in job:
+        summary["queue_position"] = job["queue_position"]
+    return summary
+
+
+job_queue = JobQueue(JOB_DB_PATH, JOB_WORKERS)
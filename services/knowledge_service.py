@@ -1,7 +1,12 @@
 # services/knowledge_service.py (Версия с GPT4All, Git, Confluence и локальными файлами)
 import os
+import queue
+import threading
+import contextvars
 import numpy as np
-from typing import List
+from datetime import datetime
+from itertools import islice
+from typing import Iterable, Iterator, List
 
 # Shim для совместимости chromadb с NumPy 2.x
 # В NumPy 2.0 удалили np.float_ и ряд псевдонимов, которые всё ещё используют зависимости chromadb.
@@ -14,22 +19,53 @@ if not hasattr(np, "uint"):
 
 import chromadb
 from chromadb.config import Settings
-from langchain_community.embeddings import GPT4AllEmbeddings
 from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, TextLoader
 
 # Импортируем наши старые сервисы для загрузки данных
-from services.git_service import load_git_knowledge
-from services.confluence_service import search_confluence # Он нам понадобится для API
+from services.git_service import iter_git_documents
+from services.embedding_service import create_embeddings
+from services.metrics_service import time_stage, observe_context
+from services.confluence_service import search_confluence, iter_pages_from_space # Он нам понадобится для API
+from services.feedback_overlay import FeedbackOverlay, correction_text
+
+NOT_FOUND_MESSAGE = "Релевантная информация в базе знаний не найдена."
+CHROMA_DB_DIR = os.getenv("CHROMA_DB_DIR", "./chroma_db")
+COLLECTION_NAME = "asupgr_knowledge"
+# Новая версия индекса строится под временным именем с этим префиксом и подменяет рабочую только целиком
+BUILDING_COLLECTION_PREFIX = f"{COLLECTION_NAME}__building_"
+# Прежняя версия на время подмены переименовывается сюда и удаляется, когда рабочее имя уже у новой
+RETIRED_COLLECTION_PREFIX = f"{COLLECTION_NAME}__retired_"
+# Индексация идёт пачками: столько чанков эмбеддится и записывается за раз
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "64"))
+# Сколько готовых пачек может ждать записи; если запись отстаёт, чтение и эмбеддинги останавливаются
+INGEST_MAX_PENDING_BATCHES = int(os.getenv("INGEST_MAX_PENDING_BATCHES", "2"))
+# Сколько страниц Confluence запрашивать за раз
+INGEST_CONFLUENCE_PAGE_SIZE = int(os.getenv("INGEST_CONFLUENCE_PAGE_SIZE", "50"))
+
+
+def _batched(items: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _joined(items: Iterable[str], separator: str) -> Iterator[str]:
+    """Как separator.join(items), но потоком."""
+    for index, item in enumerate(items):
+        if index:
+            yield separator
+        yield item
+
 
 class KnowledgeService:
-    def __init__(self, persist_directory: str = "./chroma_db"):
+    def __init__(self, persist_directory: str = CHROMA_DB_DIR):
         """Инициализирует ChromaDB и модель GPT4All."""
         self.persist_directory = persist_directory
         self.client = chromadb.PersistentClient(path=persist_directory)
         
         # Пытаемся получить или создать коллекцию с обработкой ошибок миграции
         try:
-            self.collection = self.client.get_or_create_collection(name="asupgr_knowledge")
+            self.collection = self.client.get_or_create_collection(name=COLLECTION_NAME)
         except Exception as e:
             # Если ошибка связана с несовместимостью схемы БД, удаляем старую базу
             if "no such column" in str(e) or "OperationalError" in str(type(e).__name__):
@@ -45,179 +81,271 @@ class KnowledgeService:
                 
                 # Пересоздаём клиент и коллекцию
                 self.client = chromadb.PersistentClient(path=persist_directory)
-                self.collection = self.client.get_or_create_collection(name="asupgr_knowledge")
+                self.collection = self.client.get_or_create_collection(name=COLLECTION_NAME)
                 print("Новая база данных ChromaDB создана успешно.")
             else:
                 # Если это другая ошибка, пробрасываем её дальше
                 raise
         
-        # Инициализируем модель GPT4All. Она скачает модель при первом запуске.
-        print("Инициализирую модель GPT4All для эмбеддингов...")
-        self.embedding_model = GPT4AllEmbeddings()
-        print("Модель GPT4All готова к работе.")
-
-    def _chunk_text(self, text: str, chunk_size: int = 1000, overlap: int = 100) -> List[str]:
-        """Разбивает большой текст на пересекающиеся чанки."""
-        if not text or len(text) <= chunk_size:
-            return [text] if text else []
-        
-        chunks = []
-        start = 0
-        while start < len(text):
-            end = start + chunk_size
-            chunks.append(text[start:end])
-            start = end - overlap
-        return chunks
-
-    def _load_local_files(self) -> str:
-        """Читает все .pdf, .docx и .md файлы из папки 'data' и возвращает единый текст."""
+        # Модель GPT4All в процессе (скачается при первом запуске) или общий сервер эмбеддингов,
+        # см. EMBEDDINGS_BACKEND
+        self.embedding_model = create_embeddings()
+        # Правки из /feedback поверх индекса: учитываются поиском сразу, без переиндексации
+        self.feedback = FeedbackOverlay()
+
+    def _iter_chunks(self, pieces: Iterable[str], chunk_size: int = 1000, overlap: int = 100) -> Iterator[str]:
+        """
+        Режет поток текста на пересекающиеся чанки, не склеивая его в одну строку: в памяти только
+        текущий кусок и хвост предыдущего. Чанки те же, что при нарезке всего текста целиком.
+        """
+        step = chunk_size - overlap
+        buffer, emitted = "", False
+        for piece in pieces:
+            buffer += piece
+            pos = 0
+            # Чанк отдаём, только когда за ним точно есть продолжение — как при нарезке всего текста сразу
+            while len(buffer) - pos > chunk_size:
+                yield buffer[pos:pos + chunk_size]
+                emitted = True
+                pos += step
+            buffer = buffer[pos:]
+        if not emitted:
+            if buffer:
+                yield buffer
+            return
+        while buffer:
+            yield buffer[:chunk_size]
+            buffer = buffer[step:]
+
+    def _iter_local_files(self) -> Iterator[str]:
+        """Читает .pdf, .docx и .md файлы из папки 'data' по одному и отдаёт текст каждого."""
         data_folder = "data"
-        all_texts = []
         print("Загрузка данных из локальной папки 'data'...")
         
         try:
-            for filename in os.listdir(data_folder):
-                file_path = os.path.join(data_folder, filename)
-                print(f"  Обрабатываю файл: {filename}")
-
-                if filename.endswith(".pdf"):
-                    try:
-                        loader = PyPDFLoader(file_path)
-                        documents = loader.load()
-                        text_content = "\n\n".join([doc.page_content for doc in documents])
-                        all_texts.append(text_content)
-                    except Exception as e:
-                        print(f"    ОШИБКА при чтении PDF {filename}: {e}")
-
-                elif filename.endswith(".docx"):
-                    try:
-                        loader = Docx2txtLoader(file_path)
-                        documents = loader.load()
-                        text_content = documents[0].page_content
-                        all_texts.append(text_content)
-                    except Exception as e:
-                        print(f"    ОШИБКА при чтении DOCX {filename}: {e}")
-                
-                elif filename.lower().endswith(".md"):
-                    try:
-                        loader = TextLoader(file_path, encoding="utf-8")
-                        documents = loader.load()
-                        text_content = "\n\n".join([doc.page_content for doc in documents])
-                        all_texts.append(text_content)
-                    except Exception as e:
-                        print(f"    ОШИБКА при чтении MD {filename}: {e}")
-                
-                elif filename.endswith(".doc"):
-                    print(f"    ПРОПУЩЕН (старый формат .doc): {filename}. Пожалуйста, преобразуйте в .docx.")
-                
-                else:
-                    print(f"    Пропускаю файл неподдерживаемого формата: {filename}")
-
+            filenames = os.listdir(data_folder)
         except FileNotFoundError:
             print(f"    Папка '{data_folder}' не найдена. Локальные файлы не будут добавлены.")
-            return ""
-        except Exception as e:
-            print(f"    Произошла ошибка при чтении файлов: {e}")
-            return ""
+            return
+
+        loaded, total_chars = 0, 0
+        for filename in filenames:
+            file_path = os.path.join(data_folder, filename)
+            print(f"  Обрабатываю файл: {filename}")
+            text_content = None
 
-        if not all_texts:
+            if filename.endswith(".pdf"):
+                try:
+                    # Страницы PDF читаются лениво, а не списком всех страниц сразу
+                    pages = PyPDFLoader(file_path).lazy_load()
+                    text_content = "\n\n".join(doc.page_content for doc in pages)
+                except Exception as e:
+                    print(f"    ОШИБКА при чтении PDF {filename}: {e}")
+
+            elif filename.endswith(".docx"):
+                try:
+                    text_content = Docx2txtLoader(file_path).load()[0].page_content
+                except Exception as e:
+                    print(f"    ОШИБКА при чтении DOCX {filename}: {e}")
+            
+            elif filename.lower().endswith(".md"):
+                try:
+                    documents = TextLoader(file_path, encoding="utf-8").load()
+                    text_content = "\n\n".join(doc.page_content for doc in documents)
+                except Exception as e:
+                    print(f"    ОШИБКА при чтении MD {filename}: {e}")
+            
+            elif filename.endswith(".doc"):
+                print(f"    ПРОПУЩЕН (старый формат .doc): {filename}. Пожалуйста, преобразуйте в .docx.")
+            
+            else:
+                print(f"    Пропускаю файл неподдерживаемого формата: {filename}")
+
+            if text_content is not None:
+                loaded += 1
+                total_chars += len(text_content)
+                yield text_content
+
+        if not loaded:
             print("    В папке 'data' не найдено поддерживаемых документов (.pdf, .docx, .md).")
-            return ""
-        
-        local_text = "\n\n--- НОВЫЙ ЛОКАЛЬНЫЙ ДОКУМЕНТ ---\n\n".join(all_texts)
-        print(f"    Загружено текста из локальных файлов: {len(local_text)} символов.")
-        return local_text
+            return
+        print(f"    Загружено текста из локальных файлов: {total_chars} символов.")
 
-    def _load_all_confluence_data(self) -> str:
-        """Скачивает ВСЕ страницы из указанного пространства Confluence."""
+    def _iter_confluence_pages(self) -> Iterator[str]:
+        """Скачивает ВСЕ страницы из указанного пространства Confluence, отдавая их по одной."""
         print("Начинаю загрузку ВСЕХ данных из Confluence...")
         space_key = os.getenv("SPACE_KEY")
         
         if not space_key:
             print("    ОШИБКА: Переменная SPACE_KEY не найдена в .env файле. Пропускаю загрузку из Confluence.")
-            return ""
+            return
 
-        # Здесь мы используем функцию из confluence_service.py для получения всех страниц
-        # Вам может понадобиться добавить эту функцию в confluence_service.py
-        # или адаптировать этот код под ваш API-клиент
         try:
-            # Предполагается, что в confluence_service.py есть такая функция
-            from services.confluence_service import get_all_pages_from_space
-            pages_content = get_all_pages_from_space(space_key=space_key)
-            
-            if not pages_content:
-                print("    В Confluence не найдено страниц или произошла ошибка.")
-                return ""
-
-            full_confluence_text = "\n\n--- НОВАЯ СТРАНИЦА CONFLUENCE ---\n\n".join(pages_content)
-            print(f"    Загружено текста из Confluence: {len(full_confluence_text)} символов.")
-            return full_confluence_text
-            
-        except ImportError:
-            print("    ОШИБКА: Функция get_all_pages_from_space не найдена в confluence_service.py. Пропускаю загрузку.")
-            print("    Вам нужно добавить эту функцию для скачивания всех страниц.")
-            return ""
+            yield from iter_pages_from_space(space_key=space_key, limit=INGEST_CONFLUENCE_PAGE_SIZE)
         except Exception as e:
             print(f"    Произошла ошибка при загрузке из Confluence: {e}")
-            return ""
+
+    def _iter_corpus(self) -> Iterator[str]:
+        """Весь корпус потоком кусков текста в прежнем порядке и с прежними разделителями."""
+        print("Загрузка данных из Git...")
+        yield "--- ИНФОРМАЦИЯ ИЗ GIT ---\n"
+        yield from iter_git_documents()
+        yield "\n\n--- ИНФОРМАЦИЯ ИЗ CONFLUENCE ---\n"
+        yield from _joined(self._iter_confluence_pages(), "\n\n--- НОВАЯ СТРАНИЦА CONFLUENCE ---\n\n")
+        yield "\n\n--- ИНФОРМАЦИЯ ИЗ ЛОКАЛЬНЫХ ФАЙЛОВ ---\n"
+        yield from _joined(self._iter_local_files(), "\n\n--- НОВЫЙ ЛОКАЛЬНЫЙ ДОКУМЕНТ ---\n\n")
 
     def create_knowledge_base(self):
-        """Индексирует все знания из Git, Confluence и локальных файлов в векторную базу."""
+        """
+        Индексирует все знания из Git, Confluence и локальных файлов в векторную базу потоком:
+        чтение -> нарезка -> эмбеддинги -> запись пачками по INGEST_BATCH_SIZE чанков. Эмбеддинги
+        считаются в отдельном потоке и передаются на запись через очередь на INGEST_MAX_PENDING_BATCHES
+        пачек: если запись отстаёт, чтение и эмбеддинги ждут. Память ограничена размером пачек, а не корпуса.
+
+        Запись идёт в отдельную коллекцию, а рабочая подменяется ею только после успешного завершения:
+        поиск во время индексации работает по прежнему индексу, а при сбое прежний индекс остаётся.
+        """
         print("Начинаю индексацию базы знаний из всех источников...")
-        
-        # 1. Загружаем данные из всех источников
-        print("Загрузка данных из Git...")
-        git_text = load_git_knowledge()
 
-        # Вызываем НОВУЮ функцию для загрузки всех данных из Confluence
-        confluence_text = self._load_all_confluence_data()
+        # Недостроенные и не удалённые прежние коллекции прошлых прерванных индексаций
+        for collection in self.client.list_collections():
+            name = getattr(collection, "name", collection)
+            if name.startswith((BUILDING_COLLECTION_PREFIX, RETIRED_COLLECTION_PREFIX)):
+                print(f"Удаляю коллекцию прошлой прерванной индексации: {name}")
+                self.client.delete_collection(name=name)
 
-        # Вызываем функцию для загрузки локальных файлов
-        local_text = self._load_local_files()
-        
-        # 2. Объединяем все тексты в один
-        full_text = (
-            f"--- ИНФОРМАЦИЯ ИЗ GIT ---\n{git_text}\n\n"
-            f"--- ИНФОРМАЦИЯ ИЗ CONFLUENCE ---\n{confluence_text}\n\n"
-            f"--- ИНФОРМАЦИЯ ИЗ ЛОКАЛЬНЫХ ФАЙЛОВ ---\n{local_text}"
+        indexed_at = datetime.now().isoformat(timespec="seconds")
+        stamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        # Метка переиндексации попадает в index_version() — по ней сбрасываются ключи кэшей
+        building = self.client.create_collection(
+            name=f"{BUILDING_COLLECTION_PREFIX}{stamp}",
+            metadata={"indexed_at": indexed_at},
         )
-        
-        # 3. Разбиваем на чанки
-        chunks = self._chunk_text(full_text)
-        print(f"Текст разбит на {len(chunks)} чанков.")
-        
-        # 4. Очищаем старую коллекцию
-        self.client.delete_collection(name="asupgr_knowledge")
-        self.collection = self.client.get_or_create_collection(name="asupgr_knowledge")
-        
-        # 5. Создаем эмбеддинги для всех чанков
-        print("Создаю эмбеддинги для чанков... Это может занять время.")
-        embeddings = self.embedding_model.embed_documents(chunks)
-        
-        # 6. Добавляем в базу
-        ids = [str(i) for i in range(len(chunks))]
-        self.collection.add(
-            documents=chunks,
-            embeddings=embeddings,
-            ids=ids
+
+        pending: queue.Queue = queue.Queue(maxsize=max(1, INGEST_MAX_PENDING_BATCHES))
+        stop = threading.Event()
+        context = contextvars.copy_context()
+
+        def offer(item) -> bool:
+            # put с таймаутом: если запись упала, поток не должен висеть на полной очереди
+            while not stop.is_set():
+                try:
+                    pending.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def embed_batches():
+            try:
+                next_id = 0
+                for batch in _batched(self._iter_chunks(self._iter_corpus()), INGEST_BATCH_SIZE):
+                    embeddings = self.embedding_model.embed_documents(batch)
+                    ids = [str(i) for i in range(next_id, next_id + len(batch))]
+                    next_id += len(batch)
+                    if not offer((ids, batch, embeddings)):
+                        return
+                offer(None)
+            except BaseException as e:
+                offer(e)
+
+        print(f"Создаю эмбеддинги и записываю чанки пачками по {INGEST_BATCH_SIZE}... Это может занять время.")
+        producer = threading.Thread(target=context.run, args=(embed_batches,), name="ingest-embed", daemon=True)
+        producer.start()
+        added, batches = 0, 0
+        try:
+            while True:
+                item = pending.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                ids, batch, embeddings = item
+                building.upsert(documents=batch, embeddings=embeddings, ids=ids)
+                added += len(batch)
+                batches += 1
+                if batches % 20 == 0:
+                    print(f"    Записано {added} чанков...")
+        except BaseException:
+            print("Индексация прервана, прежний индекс остаётся рабочим.")
+            self.client.delete_collection(name=building.name)
+            raise
+        finally:
+            stop.set()
+            producer.join()
+
+        # Поиск этого процесса переключается на новую коллекцию сразу (объект коллекции привязан к её id,
+        # а не к имени). Прежняя сначала только переименовывается, и до её удаления новая уже под рабочим
+        # именем: API в другом процессе переоткрывает коллекцию по имени (_refresh_collection)
+        self.collection = building
+        previous = self.client.get_or_create_collection(name=COLLECTION_NAME)
+        previous.modify(name=f"{RETIRED_COLLECTION_PREFIX}{stamp}")
+        building.modify(name=COLLECTION_NAME)
+        self.client.delete_collection(name=previous.name)
+        print(f"База знаний успешно проиндексирована. Добавлено {added} документов.")
+
+    def _refresh_collection(self):
+        """
+        Переоткрывает рабочую коллекцию по имени, если create_index.py в другом процессе подменил её
+        новой: прежний объект коллекции привязан к id уже удалённой коллекции.
+        """
+        try:
+            current = self.client.get_collection(name=COLLECTION_NAME)
+        except Exception as e:
+            # Рабочего имени нет лишь в момент между переименованиями при подмене — оставляем прежнюю
+            print(f"Коллекция {COLLECTION_NAME} недоступна ({e}), продолжаю с текущей.")
+            return self.collection
+        if current.id != self.collection.id:
+            print("Индекс пересобран другим процессом, переключаюсь на новую коллекцию.")
+            self.collection = current
+        return self.collection
+
+    def index_version(self) -> str:
+        """Версия индекса для ключей кэшей и объединения запросов: меняется при переиндексации и новых правках."""
+        collection = self._refresh_collection()
+        metadata = collection.metadata or {}
+        return f"{metadata.get('indexed_at', 'initial')}:{collection.count()}:{self.feedback.version()}"
+
+    def add_correction(self, operation: str, author: str | None = None, doc_type: str | None = None,
+                       doc_ref: str | None = None, old_text: str | None = None, new_text: str | None = None,
+                       comment: str | None = None) -> int:
+        """Сохраняет правку в слой правок (один эмбеддинг) и возвращает её id. Поиск учитывает её сразу."""
+        embedding = self.embedding_model.embed_documents([correction_text(operation, old_text, new_text, comment)])[0]
+        return self.feedback.add(
+            embedding, operation, author=author, doc_type=doc_type, doc_ref=doc_ref,
+            old_text=old_text, new_text=new_text, comment=comment,
         )
-        print(f"База знаний успешно проиндексирована. Добавлено {len(chunks)} документов.")
 
-    def search_relevant_knowledge(self, query: str, n_results: int = 80) -> str:
-        """Ищет релевантные чанки по запросу пользователя."""
+    def search_relevant_chunks(self, query: str, n_results: int = 80) -> List[str]:
+        """Ищет релевантные чанки по запросу пользователя и возвращает их списком."""
         print(f"Ищу релевантную информацию по запросу: '{query}'")
         
-        query_embedding = self.embedding_model.embed_query(query)
-        results = self.collection.query(
-            query_embeddings=[query_embedding],
-            n_results=n_results
-        )
+        with time_stage("embedding"):
+            query_embedding = self.embedding_model.embed_query(query)
+        with time_stage("chroma_query"):
+            collection = self.collection
+            try:
+                results = collection.query(query_embeddings=[query_embedding], n_results=n_results)
+            except Exception:
+                # Коллекцию могла удалить переиндексация в другом процессе: повторяем по новой
+                if self._refresh_collection() is collection:
+                    raise
+                results = self.collection.query(query_embeddings=[query_embedding], n_results=n_results)
         
-        if not results['documents'] or not results['documents'][0]:
-            return "Релевантная информация в базе знаний не найдена."
-            
-        retrieved_chunks = results['documents'][0]
-        context = "\n\n---\n\n".join(retrieved_chunks)
+        retrieved_chunks = results['documents'][0] if results['documents'] else []
+        with time_stage("feedback_overlay"):
+            retrieved_chunks = self.feedback.apply(query_embedding, retrieved_chunks)
+        if not retrieved_chunks:
+            observe_context(0)
+            return []
+
+        observe_context(sum(len(c) for c in retrieved_chunks))
         print(f"Найдено {len(retrieved_chunks)} релевантных чанков.")
-        
-        return context
\ No newline at end of file
+        return retrieved_chunks
+
+    def search_relevant_knowledge(self, query: str, n_results: int = 80) -> str:
+        """Ищет релевантные чанки по запросу пользователя."""
+        retrieved_chunks = self.search_relevant_chunks(query, n_results=n_results)
+        if not retrieved_chunks:
+            return NOT_FOUND_MESSAGE
+        return "\n\n---\n\n".join(retrieved_chunks)
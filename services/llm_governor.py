@@ -0,0 +1,201 @@
+# services/llm_governor.py
+# Общий на процесс регулятор исходящих запросов к LLM: лимиты запросов/токенов в минуту
+# (token bucket), ограничение одновременных вызовов и ограниченная очередь ожидания,
+# которая отклоняет запросы с понятной ошибкой, если ждать приходится дольше дедлайна.
+# У каждого провайдера свой регулятор: резервная Ollama не должна упираться в лимиты OpenRouter,
+# от которых она и спасает. Настройки провайдера — LLM_<ПРОВАЙДЕР>_<НАСТРОЙКА> (например,
+# LLM_OLLAMA_MAX_CONCURRENCY), иначе общие LLM_<НАСТРОЙКА>.
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+from services.openai_service import LLMError
+
+load_dotenv()
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_RPM = float(os.getenv("LLM_RPM", "20"))  # 0 — без ограничения
+LLM_TPM = float(os.getenv("LLM_TPM", "0"))  # 0 — без ограничения
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "100"))
+LLM_MAX_WAIT = float(os.getenv("LLM_MAX_WAIT", "120"))
+# Оценка токенов до вызова: символов на токен и ожидаемая длина ответа
+LLM_CHARS_PER_TOKEN = float(os.getenv("LLM_CHARS_PER_TOKEN", "3"))
+LLM_EXPECTED_COMPLETION_TOKENS = int(os.getenv("LLM_EXPECTED_COMPLETION_TOKENS", "1500"))
+# Значения по умолчанию, отличные от общих: у локальной Ollama нет квот провайдера,
+# а одновременность ограничивает её собственный пул (OLLAMA_NUM_PARALLEL)
+_PROVIDER_DEFAULTS = {
+    "ollama": {"RPM": "0", "TPM": "0"},
+}
+
+
+class LLMOverloadedError(LLMError):
+    """Запрос отклонён регулятором: очередь переполнена или истёк дедлайн ожидания."""
+    pass
+
+
+class TokenBucket:
+    """Token bucket с ёмкостью в минутный лимит и равномерным пополнением. Не потокобезопасен сам по себе."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Сколько секунд ждать, пока в ведре наберётся amount. 0 — можно брать сразу."""
+        if not self.enabled:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        """Списывает amount (отрицательное значение возвращает токены при переоценке)."""
+        if not self.enabled:
+            return
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - min(amount, self.capacity))
+
+
+class LLMGovernor:
+    def __init__(self, max_concurrency: int, rpm: float, tpm: float, max_queue: int, max_wait: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        self._max_waiting_seen = 0
+        self._admitted = 0
+        self._rejected = 0
+        self._waits = deque(maxlen=500)
+
+    def estimate_tokens(self, prompt: str) -> int:
+        return int(len(prompt) / LLM_CHARS_PER_TOKEN) + LLM_EXPECTED_COMPLETION_TOKENS
+
+    def _admission_wait(self, estimated_tokens: int) -> float:
+        """0 — можно пропускать; >0 — через сколько секунд проверить снова."""
+        if self._in_flight >= self.max_concurrency:
+            return self.max_wait  # разбудит notify при освобождении слота
+        return max(self._requests.wait_time(1), self._tokens.wait_time(estimated_tokens))
+
+    def _reject(self, reason: str) -> None:
+        self._rejected += 1
+        raise LLMOverloadedError(
+            f"LLM перегружена: {reason}. Повторите запрос позже.",
+            retry_after=self.max_wait,
+        )
+
+    @contextmanager
+    def slot(self, prompt: str):
+        """
+        Ждёт свободный слот и бюджет лимитов, затем держит слот на время вызова.
+        Внутри блока можно вызвать report_usage(total_tokens), чтобы поправить оценку токенов.
+        """
+        estimated = self.estimate_tokens(prompt)
+        started = time.monotonic()
+        deadline = started + self.max_wait
+
+        with self._cond:
+            if self._waiting >= self.max_queue:
+                self._reject(f"очередь ожидания заполнена ({self.max_queue})")
+            self._waiting += 1
+            self._max_waiting_seen = max(self._max_waiting_seen, self._waiting)
+            try:
+                while True:
+                    pause = self._admission_wait(estimated)
+                    if pause <= 0:
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject(f"ожидание в очереди превысило {self.max_wait:.0f} с")
+                    self._cond.wait(timeout=min(pause, remaining))
+            finally:
+                self._waiting -= 1
+
+            self._requests.consume(1)
+            self._tokens.consume(estimated)
+            self._in_flight += 1
+            self._admitted += 1
+            self._waits.append(time.monotonic() - started)
+
+        usage = {"estimated": estimated}
+
+        def report_usage(total_tokens: int | None) -> None:
+            if total_tokens is None:
+                return
+            with self._cond:
+                self._tokens.consume(total_tokens - usage["estimated"])
+                usage["estimated"] = total_tokens
+
+        try:
+            yield report_usage
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            waits = sorted(self._waits)
+            return {
+                "in_flight": self._in_flight,
+                "max_concurrency": self.max_concurrency,
+                "queue_depth": self._waiting,
+                "max_queue_depth_seen": self._max_waiting_seen,
+                "max_queue": self.max_queue,
+                "admitted": self._admitted,
+                "rejected": self._rejected,
+                "wait_avg": round(sum(waits) / len(waits), 3) if waits else None,
+                "wait_p95": round(waits[min(len(waits) - 1, int(0.95 * len(waits)))], 3) if waits else None,
+                "wait_max": round(waits[-1], 3) if waits else None,
+            }
+
+
+_governors: dict[str, LLMGovernor] = {}
+_governors_lock = threading.Lock()
+
+
+def _provider_setting(provider: str, name: str, default: float) -> str:
+    specific = os.getenv(f"LLM_{provider.upper()}_{name}")
+    if specific is not None:
+        return specific
+    return _PROVIDER_DEFAULTS.get(provider, {}).get(name, str(default))
+
+
+def governor_for(provider: str) -> LLMGovernor:
+    """Регулятор провайдера (создаётся при первом обращении)."""
+    with _governors_lock:
+        if provider not in _governors:
+            _governors[provider] = LLMGovernor(
+                max_concurrency=int(_provider_setting(provider, "MAX_CONCURRENCY", LLM_MAX_CONCURRENCY)),
+                rpm=float(_provider_setting(provider, "RPM", LLM_RPM)),
+                tpm=float(_provider_setting(provider, "TPM", LLM_TPM)),
+                max_queue=int(_provider_setting(provider, "MAX_QUEUE", LLM_MAX_QUEUE)),
+                max_wait=float(_provider_setting(provider, "MAX_WAIT", LLM_MAX_WAIT)),
+            )
+        return _governors[provider]
+
+
+def stats() -> dict:
+    """Состояние регуляторов по провайдерам."""
+    with _governors_lock:
+        governors = dict(_governors)
+    return {provider: g.stats() for provider, g in governors.items()}
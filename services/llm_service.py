@@ -0,0 +1,262 @@
+# services/llm_service.py
+# Устойчивый слой диспетчеризации запросов к LLM.
+# Поверх одиночных вызовов провайдеров (openai_service, ollama_service) добавляет:
+# таймаут на вызов, повторы с экспоненциальной задержкой и джиттером (с учётом Retry-After),
+# опциональный хеджирующий дубль запроса после порога p95 и circuit breaker,
+# который переключает генерацию на локальную Ollama, пока основной провайдер недоступен.
+import os
+import random
+import threading
+import time
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dotenv import load_dotenv
+
+from services import openai_service, ollama_service
+from services.openai_service import LLMError
+from services.usage_service import record_call
+from services.llm_governor import governor_for, LLMOverloadedError
+from services.metrics_service import track_llm_call, observe_llm_call
+from services.profiling_service import span
+
+load_dotenv()
+
+# --- Настройки (все можно переопределить через .env) ---
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "openrouter")
+LLM_FALLBACK_PROVIDER = os.getenv("LLM_FALLBACK_PROVIDER", "ollama")  # пустая строка отключает failover
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "180"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1.0"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "30"))
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "0") == "1"
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "60"))
+# Предзагрузка локальной модели при старте: по умолчанию — если Ollama основной провайдер
+OLLAMA_PRELOAD = os.getenv("OLLAMA_PRELOAD", "1" if LLM_PROVIDER == "ollama" else "0") == "1"
+
+_PROVIDERS = {
+    "openrouter": openai_service.complete,
+    "ollama": ollama_service.complete,
+}
+
+
+class CircuitBreaker:
+    """Простой circuit breaker: closed -> open после N подряд ошибок -> half-open после паузы."""
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        """Можно ли сейчас обращаться к провайдеру. В half-open пропускается один пробный запрос."""
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def release_trial(self) -> None:
+        """Вызов завершился без оценки доступности провайдера: счётчики не меняются, пробный слот освобождается."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                # Неудачный пробный запрос снова открывает breaker на полный cooldown
+                self._opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """Скользящее окно длительностей успешных вызовов для оценки квантилей."""
+
+    def __init__(self, maxlen: int = 200):
+        self._samples = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q: float) -> float | None:
+        with self._lock:
+            if len(self._samples) < LLM_HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(q * len(ordered)))
+        return ordered[index]
+
+
+_breakers = {name: CircuitBreaker(LLM_BREAKER_THRESHOLD, LLM_BREAKER_COOLDOWN) for name in _PROVIDERS}
+_latencies = {name: LatencyTracker() for name in _PROVIDERS}
+_hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm-hedge")
+
+
+def _backoff_delay(attempt: int, retry_after: float | None) -> float:
+    """Full jitter: случайная задержка в [0, base * 2^attempt], но не меньше Retry-After."""
+    delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def _timed_call(provider: str, prompt: str, model: str | None, system: str | None) -> str:
+    """
+    Один вызов провайдера через регулятор нагрузки этого провайдера.
+    Каждая попытка (в т.ч. неудачная) пишется в журнал расхода.
+    """
+    call = _PROVIDERS[provider]
+    with span(f"llm:{provider}", prompt_chars=len(prompt)) as call_span, \
+            governor_for(provider).slot((system or "") + prompt) as report_usage, track_llm_call(provider):
+        started = time.monotonic()
+        try:
+            if model:
+                result = call(prompt, model=model, timeout=LLM_TIMEOUT, system=system)
+            else:
+                result = call(prompt, timeout=LLM_TIMEOUT, system=system)
+        except LLMError:
+            record_call(provider, model, time.monotonic() - started, status="error")
+            observe_llm_call(provider, time.monotonic() - started, status="error")
+            raise
+        latency = time.monotonic() - started
+        if result.get("prompt_tokens") is not None or result.get("completion_tokens") is not None:
+            report_usage((result.get("prompt_tokens") or 0) + (result.get("completion_tokens") or 0))
+    _latencies[provider].add(latency)
+    if call_span is not None:
+        call_span.attrs.update(
+            model=result.get("model"),
+            ttft=result.get("ttft"),
+            prompt_tokens=result.get("prompt_tokens"),
+            completion_tokens=result.get("completion_tokens"),
+        )
+    observe_llm_call(provider, latency, ttft=result.get("ttft"))
+    record_call(
+        provider,
+        result.get("model"),
+        latency,
+        ttft=result.get("ttft"),
+        prompt_tokens=result.get("prompt_tokens"),
+        completion_tokens=result.get("completion_tokens"),
+        cost=result.get("cost"),
+    )
+    return result["text"]
+
+
+def _hedged_call(provider: str, prompt: str, model: str | None, system: str | None) -> str:
+    """Если ответ не пришёл за p95, отправляет дубль запроса и берёт первый успешный ответ."""
+    hedge_delay = _latencies[provider].quantile(LLM_HEDGE_QUANTILE)
+    if not LLM_HEDGE_ENABLED or hedge_delay is None:
+        return _timed_call(provider, prompt, model, system)
+
+    # Копируем контекст, чтобы атрибуты журнала расхода дошли до потоков пула
+    futures = [_hedge_executor.submit(contextvars.copy_context().run, _timed_call, provider, prompt, model, system)]
+    done, _ = wait(futures, timeout=hedge_delay)
+    if not done:
+        print(f"Ответ {provider} не получен за p95 ({hedge_delay:.1f} с). Отправляю хеджирующий запрос...")
+        futures.append(_hedge_executor.submit(contextvars.copy_context().run, _timed_call, provider, prompt, model, system))
+
+    last_error = None
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                return future.result()
+            except LLMError as e:
+                last_error = e
+    raise last_error
+
+
+def _call_with_retries(provider: str, prompt: str, model: str | None, system: str | None) -> str:
+    breaker = _breakers[provider]
+    last_error = None
+
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        if not breaker.allow():
+            raise LLMError(f"Провайдер {provider} временно отключён (circuit breaker: {breaker.state}).")
+        try:
+            result = _hedged_call(provider, prompt, model, system)
+            breaker.record_success()
+            return result
+        except LLMOverloadedError:
+            # Отказ регулятора — не вина провайдера: не трогаем breaker и не повторяем
+            breaker.release_trial()
+            raise
+        except LLMError as e:
+            last_error = e
+            if not e.retryable:
+                # 4xx на кривой запрос или модель говорит о запросе, а не о доступности провайдера:
+                # несколько таких запросов не должны отключать провайдер для всех пользователей
+                breaker.release_trial()
+                break
+            breaker.record_failure()
+            if attempt == LLM_MAX_RETRIES:
+                break
+            if e.retry_after is not None and e.retry_after > LLM_BACKOFF_MAX:
+                print(f"{provider} просит подождать {e.retry_after:.0f} с — это дольше лимита, прекращаю повторы.")
+                break
+            delay = _backoff_delay(attempt, e.retry_after)
+            print(f"Ошибка {provider} (попытка {attempt + 1}/{LLM_MAX_RETRIES + 1}): {e}. Повтор через {delay:.1f} с...")
+            time.sleep(delay)
+
+    raise last_error
+
+
+def warm_up() -> None:
+    """Прогревает локальную модель в фоне, чтобы первый запрос не ждал её загрузки."""
+    if not OLLAMA_PRELOAD or "ollama" not in (LLM_PROVIDER, LLM_FALLBACK_PROVIDER):
+        return
+    threading.Thread(target=ollama_service.preload, name="ollama-preload", daemon=True).start()
+
+
+def generate_text(prompt: str, model: str | None = None, system: str | None = None) -> str:
+    """
+    Генерирует текст через основной провайдер с повторами и хеджированием.
+    system — общий системный промпт (см. services/prompt_service.py).
+    При исчерпании попыток или открытом circuit breaker переключается на резервный провайдер.
+    """
+    try:
+        return _call_with_retries(LLM_PROVIDER, prompt, model, system)
+    except LLMOverloadedError:
+        raise
+    except LLMError as primary_error:
+        if not LLM_FALLBACK_PROVIDER or LLM_FALLBACK_PROVIDER == LLM_PROVIDER:
+            raise
+        print(f"Основной провайдер {LLM_PROVIDER} недоступен ({primary_error}). Переключаюсь на {LLM_FALLBACK_PROVIDER}...")
+        try:
+            # Модель основного провайдера резервному не подходит — используем модель по умолчанию
+            return _call_with_retries(LLM_FALLBACK_PROVIDER, prompt, None, system)
+        except LLMError as fallback_error:
+            raise LLMError(
+                f"Основной провайдер: {primary_error}; резервный провайдер: {fallback_error}"
+            ) from fallback_error
@@ -0,0 +1,142 @@
+# services/markdown_tree.py
+# Разбор Markdown-ответа модели в дерево блоков за один проход по строкам. Дерево — обычные
+# кортежи и списки: оно дёшево передаётся в процессы пула, и по нему DOCX, PDF и HTML
+# рендерятся одинаково, без повторного разбора текста в каждом формате.
+#
+# Блоки:
+#   ("heading", уровень, spans)      ("paragraph", spans)          ("quote", spans)
+#   ("bullet", уровень, spans)       ("numbered", уровень, номер, spans)
+#   ("table", [[spans, ...], ...])   — первая строка таблицы считается заголовком
+#   ("code", текст)
+# spans — список (стиль, текст), где стиль: "" | "b" | "i" | "code".
+# Модуль не зависит от остальных сервисов, чтобы его можно было выполнять в пуле процессов.
+import re
+
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_BULLET_RE = re.compile(r"^(\s*)[-*+]\s+(.*)$")
+_NUMBERED_RE = re.compile(r"^(\s*)(\d+[.)])\s+(.*)$")
+_TABLE_SEPARATOR_RE = re.compile(r"^\s*\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$")
+_RULE_RE = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+_INLINE_RE = re.compile(r"(\*\*[^*]+\*\*|__[^_]+__|`[^`]+`|\*[^*\s][^*]*\*)")
+
+MAX_LIST_LEVEL = 2
+
+
+def parse_inline(text: str) -> list[tuple[str, str]]:
+    """Разбивает строку на куски с разметкой **жирный**, *курсив* и `код`."""
+    if "*" not in text and "`" not in text and "__" not in text:
+        return [("", text)]
+    spans = []
+    for token in _INLINE_RE.split(text):
+        if not token:
+            continue
+        if token.startswith(("**", "__")) and len(token) > 4:
+            spans.append(("b", token[2:-2]))
+        elif token.startswith("`") and len(token) > 2:
+            spans.append(("code", token[1:-1]))
+        elif token.startswith("*") and len(token) > 2:
+            spans.append(("i", token[1:-1]))
+        else:
+            spans.append(("", token))
+    return spans
+
+
+def plain_text(spans: list[tuple[str, str]]) -> str:
+    return "".join(text for _, text in spans)
+
+
+def with_prefix(prefix: str, spans: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    """Спаны с текстом в начале (номер пункта списка): обычный текст склеивается в один кусок."""
+    if spans and spans[0][0] == "":
+        return [("", prefix + spans[0][1])] + spans[1:]
+    return [("", prefix)] + spans
+
+
+def _split_row(line: str) -> list[str]:
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|") and not line.endswith("\\|"):
+        line = line[:-1]
+    return [cell.strip().replace("\\|", "|") for cell in re.split(r"(?<!\\)\|", line)]
+
+
+def parse(content: str) -> list[tuple]:
+    """Разбирает Markdown в список блоков (см. описание модуля)."""
+    blocks: list[tuple] = []
+    paragraph_lines: list[str] = []
+
+    def flush_paragraph() -> None:
+        if paragraph_lines:
+            blocks.append(("paragraph", parse_inline(" ".join(paragraph_lines))))
+            paragraph_lines.clear()
+
+    lines = content.splitlines()
+    i, count = 0, len(lines)
+    while i < count:
+        line = lines[i]
+        stripped = line.strip()
+
+        if stripped.startswith("```"):
+            flush_paragraph()
+            code_lines = []
+            i += 1
+            while i < count and not lines[i].strip().startswith("```"):
+                code_lines.append(lines[i])
+                i += 1
+            blocks.append(("code", "\n".join(code_lines)))
+            i += 1
+            continue
+
+        if not stripped:
+            flush_paragraph()
+            i += 1
+            continue
+
+        if stripped.startswith("|") and i + 1 < count and _TABLE_SEPARATOR_RE.match(lines[i + 1]):
+            flush_paragraph()
+            rows = [_split_row(line)]
+            i += 2
+            while i < count and lines[i].strip().startswith("|"):
+                rows.append(_split_row(lines[i]))
+                i += 1
+            # Заголовок таблицы и так выделяется жирным, лишние ** в нём не нужны
+            header = [[("", cell.strip("*"))] for cell in rows[0]]
+            blocks.append(("table", [header] + [[parse_inline(cell) for cell in row] for row in rows[1:]]))
+            continue
+
+        heading = _HEADING_RE.match(stripped)
+        if heading:
+            flush_paragraph()
+            blocks.append(("heading", len(heading.group(1)), parse_inline(heading.group(2).replace("**", ""))))
+            i += 1
+            continue
+
+        if _RULE_RE.match(stripped):
+            flush_paragraph()
+            i += 1
+            continue
+
+        bullet = _BULLET_RE.match(line)
+        numbered = None if bullet else _NUMBERED_RE.match(line)
+        if bullet or numbered:
+            flush_paragraph()
+            indent = len((bullet or numbered).group(1).expandtabs(4))
+            level = min(indent // 2, MAX_LIST_LEVEL)
+            if bullet:
+                blocks.append(("bullet", level, parse_inline(bullet.group(2))))
+            else:
+                blocks.append(("numbered", level, numbered.group(2), parse_inline(numbered.group(3))))
+            i += 1
+            continue
+
+        if stripped.startswith(">"):
+            flush_paragraph()
+            blocks.append(("quote", parse_inline(stripped.lstrip("> ").strip())))
+            i += 1
+            continue
+
+        paragraph_lines.append(stripped)
+        i += 1
+    flush_paragraph()
+    return blocks
@@ -0,0 +1,146 @@
+# services/metrics_service.py
+# Метрики Prometheus для /metrics: длительность этапов конвейера (эмбеддинг, запрос к Chroma,
+# каждый вызов LLM, сборка DOCX, весь /process), размер контекста, запросы в работе и попадания в кэши.
+# Метки request_type берутся из usage_context, поэтому сервисам не нужно передавать их явно.
+# Бакеты подобраны под целевые показатели tech_req.md §4.1: поиск ≤2 с, API ≤1 с, генерация ≤3 мин.
+import time
+from contextlib import contextmanager
+
+from services.usage_service import current_context
+from services.profiling_service import span
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    print("ОШИБКА: Библиотека 'prometheus-client' не найдена. Выполните 'pip install prometheus-client'. Метрики отключены.")
+    PROMETHEUS_AVAILABLE = False
+
+STAGE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+LLM_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 90, 120, 180, 300)
+PROCESS_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 180, 300, 600, 1200)
+CONTEXT_BUCKETS = (0, 1_000, 5_000, 10_000, 25_000, 50_000, 100_000, 200_000, 400_000)
+
+if PROMETHEUS_AVAILABLE:
+    STAGE_SECONDS = Histogram(
+        "smartwriter_stage_seconds", "Длительность этапа конвейера (embedding, chroma_query, docx)",
+        ["stage", "request_type"], buckets=STAGE_BUCKETS,
+    )
+    LLM_CALL_SECONDS = Histogram(
+        "smartwriter_llm_call_seconds", "Длительность одного вызова LLM (каждой попытки)",
+        ["request_type", "provider", "status"], buckets=LLM_BUCKETS,
+    )
+    LLM_TTFT_SECONDS = Histogram(
+        "smartwriter_llm_ttft_seconds", "Время до первого токена ответа LLM",
+        ["request_type", "provider"], buckets=LLM_BUCKETS,
+    )
+    CONTEXT_CHARS = Histogram(
+        "smartwriter_context_chars", "Размер найденного контекста (символов) на один поиск",
+        ["request_type"], buckets=CONTEXT_BUCKETS,
+    )
+    PROCESS_SECONDS = Histogram(
+        "smartwriter_process_seconds", "Полное время обработки /process",
+        ["request_type", "status"], buckets=PROCESS_BUCKETS,
+    )
+    PROCESS_IN_FLIGHT = Gauge(
+        "smartwriter_process_in_flight", "Запросы /process в работе", ["request_type"],
+    )
+    LLM_IN_FLIGHT = Gauge(
+        "smartwriter_llm_in_flight", "Вызовы LLM в работе", ["provider"],
+    )
+    ADMISSION_ACTIVE = Gauge(
+        "smartwriter_admission_active", "Запросы пользователя в работе", ["user"],
+    )
+    ADMISSION_QUEUED = Gauge(
+        "smartwriter_admission_queued", "Запросы пользователя в очереди допуска", ["user"],
+    )
+    ADMISSION_REJECTED = Counter(
+        "smartwriter_admission_rejected_total", "Запросы, отклонённые контролем допуска", ["user", "reason"],
+    )
+    CACHE_REQUESTS = Counter(
+        "smartwriter_cache_requests_total", "Обращения к кэшам (объединение запросов, готовые разделы и т.п.)",
+        ["cache", "result"],
+    )
+
+
+def _request_type() -> str:
+    return current_context().get("request_type") or "-"
+
+
+@contextmanager
+def time_stage(stage: str, request_type: str | None = None):
+    """Замеряет длительность этапа (и пишет его в профиль запроса); request_type — из usage_context."""
+    started = time.monotonic()
+    try:
+        with span(stage):
+            yield
+    finally:
+        if PROMETHEUS_AVAILABLE:
+            STAGE_SECONDS.labels(stage, request_type or _request_type()).observe(time.monotonic() - started)
+
+
+@contextmanager
+def track_llm_call(provider: str):
+    """Держит gauge вызовов LLM в работе на время вызова."""
+    if PROMETHEUS_AVAILABLE:
+        LLM_IN_FLIGHT.labels(provider).inc()
+    try:
+        yield
+    finally:
+        if PROMETHEUS_AVAILABLE:
+            LLM_IN_FLIGHT.labels(provider).dec()
+
+
+def observe_llm_call(provider: str, latency: float, ttft: float | None = None, status: str = "ok") -> None:
+    if not PROMETHEUS_AVAILABLE:
+        return
+    request_type = _request_type()
+    LLM_CALL_SECONDS.labels(request_type, provider, status).observe(latency)
+    if ttft is not None:
+        LLM_TTFT_SECONDS.labels(request_type, provider).observe(ttft)
+
+
+def observe_context(chars: int) -> None:
+    if PROMETHEUS_AVAILABLE:
+        CONTEXT_CHARS.labels(_request_type()).observe(chars)
+
+
+@contextmanager
+def track_process(request_type: str):
+    """Gauge запросов в работе и гистограмма полного времени /process. Блок получает dict для статуса."""
+    outcome = {"status": "ok"}
+    started = time.monotonic()
+    if PROMETHEUS_AVAILABLE:
+        PROCESS_IN_FLIGHT.labels(request_type).inc()
+    try:
+        yield outcome
+    except Exception:
+        outcome["status"] = "exception"
+        raise
+    finally:
+        if PROMETHEUS_AVAILABLE:
+            PROCESS_IN_FLIGHT.labels(request_type).dec()
+            PROCESS_SECONDS.labels(request_type, outcome["status"]).observe(time.monotonic() - started)
+
+
+def count_cache(cache: str, hit: bool) -> None:
+    if PROMETHEUS_AVAILABLE:
+        CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def set_admission_user(user: str, active: int, queued: int) -> None:
+    if PROMETHEUS_AVAILABLE:
+        ADMISSION_ACTIVE.labels(user).set(active)
+        ADMISSION_QUEUED.labels(user).set(queued)
+
+
+def count_admission_rejection(user: str, reason: str) -> None:
+    if PROMETHEUS_AVAILABLE:
+        ADMISSION_REJECTED.labels(user, reason).inc()
+
+
+def render_latest() -> tuple[bytes, str]:
+    """Текст метрик в формате Prometheus и его content-type."""
+    if not PROMETHEUS_AVAILABLE:
+        return b"# prometheus-client is not installed\n", "text/plain; charset=utf-8"
+    return generate_latest(), CONTENT_TYPE_LATEST
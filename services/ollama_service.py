@@ -1,27 +1,189 @@
 # services/ollama_service.py
+# Локальный провайдер LLM на Ollama (для закрытого контура, tech_req.md §4.3).
+# Модель предзагружается и закрепляется в памяти при старте (keep_alive) с тем же размером контекста,
+# что и у запросов, ответ читается потоком, а число одновременных запросов ограничено пулом
+# под OLLAMA_NUM_PARALLEL сервера.
+import os
+import time
+import threading
 import requests
 import json
+from dotenv import load_dotenv
 
-OLLAMA_API_URL = "http://localhost:11434/api/generate"
+from services.openai_service import LLMError, RETRYABLE_STATUS_CODES
+
+load_dotenv()
+
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", f"{OLLAMA_BASE_URL}/api/generate")
+DEFAULT_MODEL = os.getenv("OLLAMA_MODEL", "llama3.2:3b")
+# -1 — держать модель в памяти бессрочно
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "-1")
+# Должно совпадать с OLLAMA_NUM_PARALLEL сервера: больше запросов он всё равно не обработает параллельно
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "1"))
+OLLAMA_NUM_THREAD = int(os.getenv("OLLAMA_NUM_THREAD", "0"))  # 0 — на усмотрение Ollama
+# Ollama перезагружает модель при каждой смене num_ctx, теряя KV-кэш и общий префикс промптов, поэтому
+# контекст фиксирован на модель: им же модель предзагружается. OLLAMA_LARGE_CTX (0 — выключено) —
+# единственный запасной размер для промптов, которые в OLLAMA_NUM_CTX не помещаются
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "16384"))
+OLLAMA_LARGE_CTX = int(os.getenv("OLLAMA_LARGE_CTX", "0"))
+OLLAMA_NUM_PREDICT = int(os.getenv("OLLAMA_NUM_PREDICT", "4000"))
+OLLAMA_CHARS_PER_TOKEN = float(os.getenv("OLLAMA_CHARS_PER_TOKEN", "3"))
+
+_pool = threading.BoundedSemaphore(OLLAMA_NUM_PARALLEL)
+_stats_lock = threading.Lock()
+_stats = {
+    "calls": 0,
+    "eval_tokens": 0,
+    "eval_seconds": 0.0,
+    "prompt_tokens": 0,
+    "prompt_seconds": 0.0,
+    "last_tokens_per_sec": None,
+}
+
+
+def _keep_alive():
+    # Ollama принимает и число секунд, и строку длительности ("30m")
+    value = OLLAMA_KEEP_ALIVE
+    return int(value) if value.lstrip("-").isdigit() else value
+
+
+def context_size_for(prompt_chars: int, num_predict: int = OLLAMA_NUM_PREDICT) -> int:
+    """
+    num_ctx для запроса: всегда OLLAMA_NUM_CTX, и лишь промпт, который в него не помещается, получает
+    OLLAMA_LARGE_CTX (если он задан). Других размеров нет, чтобы модель не перезагружалась от запроса к запросу.
+    """
+    needed = int(prompt_chars / OLLAMA_CHARS_PER_TOKEN) + num_predict
+    if needed <= OLLAMA_NUM_CTX:
+        return OLLAMA_NUM_CTX
+    if OLLAMA_LARGE_CTX > OLLAMA_NUM_CTX:
+        return OLLAMA_LARGE_CTX
+    print(f"Промпт (~{needed} токенов с ответом) больше OLLAMA_NUM_CTX={OLLAMA_NUM_CTX}: Ollama обрежет его начало.")
+    return OLLAMA_NUM_CTX
+
+
+def _options(num_ctx: int) -> dict:
+    options = {"temperature": 0.3, "num_ctx": num_ctx, "num_predict": OLLAMA_NUM_PREDICT}
+    if OLLAMA_NUM_THREAD > 0:
+        options["num_thread"] = OLLAMA_NUM_THREAD
+    return options
+
+
+def preload(model: str = DEFAULT_MODEL, timeout: float | None = 600) -> bool:
+    """Загружает модель в память и закрепляет её (запрос без промпта с keep_alive)."""
+    print(f"Предзагрузка модели Ollama: {model} (keep_alive={OLLAMA_KEEP_ALIVE})...")
+    payload = {"model": model, "keep_alive": _keep_alive(), "options": _options(OLLAMA_NUM_CTX)}
+    try:
+        started = time.monotonic()
+        response = requests.post(OLLAMA_API_URL, json=payload, timeout=timeout)
+        response.raise_for_status()
+        print(f"Модель {model} загружена за {time.monotonic() - started:.1f} с.")
+        return True
+    except requests.exceptions.RequestException as e:
+        print(f"Не удалось предзагрузить модель Ollama {model}: {e}")
+        return False
+
+
+def complete(prompt: str, model: str = DEFAULT_MODEL, timeout: float | None = None,
+             system: str | None = None) -> dict:
+    """Отправляет промпт в Ollama (потоком) и возвращает текст, счётчики токенов, ttft и токены/с."""
+    num_ctx = context_size_for(len(prompt) + len(system or ""))
+    print(f"Отправляю запрос в Ollama (модель: {model}, num_ctx: {num_ctx})...")
 
-def generate_text(prompt: str, model: str = "llama3.2:3b") -> str:
-    """Отправляет промпт в Ollama и возвращает сгенерированный текст."""
-    print(f"Отправляю запрос в Ollama (модель: {model})...")
-    
     payload = {
         "model": model,
         "prompt": prompt,
-        "stream": False,
-        "options": {"temperature": 0.3}
+        "stream": True,
+        "keep_alive": _keep_alive(),
+        "options": _options(num_ctx),
     }
-    
+    if system:
+        payload["system"] = system
+
+    # Ждём свободный слот пула не дольше таймаута вызова
+    if not _pool.acquire(timeout=timeout):
+        raise LLMError("Все слоты Ollama заняты, таймаут ожидания истёк.", retryable=True)
+    response = None
     try:
-        response = requests.post(OLLAMA_API_URL, json=payload)
-        response.raise_for_status()
-        result = response.json()
-        generated_text = result.get("response", "")
-        print("Ответ от Ollama получен.")
-        return generated_text
+        started = time.monotonic()
+        # timeout у requests ограничивает только паузу между байтами, поэтому весь ответ ограничен отдельно
+        deadline = started + timeout if timeout is not None else None
+        response = requests.post(OLLAMA_API_URL, json=payload, timeout=timeout, stream=True)
+        if response.status_code >= 400:
+            # 4xx (например, 404 — модель не скачана) повтором не исправить
+            raise LLMError(
+                f"Ошибка Ollama: HTTP {response.status_code}: {response.text[:200]}",
+                status_code=response.status_code,
+                retryable=response.status_code in RETRYABLE_STATUS_CODES,
+            )
+
+        parts = []
+        ttft = None
+        final = None
+        for line in response.iter_lines():
+            if deadline is not None and time.monotonic() > deadline:
+                raise LLMError(f"Таймаут потокового ответа Ollama: ответ не завершён за {timeout:g} с", retryable=True)
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if chunk.get("error"):
+                raise LLMError(f"Ошибка Ollama: {chunk['error']}", retryable=True)
+            if chunk.get("response"):
+                if ttft is None:
+                    ttft = time.monotonic() - started
+                parts.append(chunk["response"])
+            if chunk.get("done"):
+                final = chunk
+                break
+        if final is None:
+            raise LLMError("Поток ответа Ollama оборвался до завершения.", retryable=True)
+
+        eval_count = final.get("eval_count") or 0
+        eval_seconds = (final.get("eval_duration") or 0) / 1e9
+        tokens_per_sec = round(eval_count / eval_seconds, 2) if eval_seconds else None
+        with _stats_lock:
+            _stats["calls"] += 1
+            _stats["eval_tokens"] += eval_count
+            _stats["eval_seconds"] += eval_seconds
+            _stats["prompt_tokens"] += final.get("prompt_eval_count") or 0
+            _stats["prompt_seconds"] += (final.get("prompt_eval_duration") or 0) / 1e9
+            _stats["last_tokens_per_sec"] = tokens_per_sec
+        print(f"Ответ от Ollama получен: {eval_count} токенов, {tokens_per_sec or '-'} ток/с.")
+
+        return {
+            "text": "".join(parts),
+            "model": model,
+            "prompt_tokens": final.get("prompt_eval_count"),
+            "completion_tokens": final.get("eval_count"),
+            "cost": 0.0,
+            "ttft": ttft,
+            "tokens_per_sec": tokens_per_sec,
+        }
     except requests.exceptions.RequestException as e:
         print(f"Ошибка при запросе к Ollama: {e}")
-        return f"Произошла ошибка при обращении к модели Ollama: {e}"
\ No newline at end of file
+        # Пробрасываем ошибку, чтобы слой диспетчеризации не принял текст ошибки за ответ модели
+        raise LLMError(f"Ошибка при обращении к модели Ollama: {e}", retryable=True)
+    except ValueError as e:
+        raise LLMError(f"Некорректный ответ Ollama: {e}", retryable=True)
+    finally:
+        if response is not None:
+            response.close()
+        _pool.release()
+
+
+def generate_text(prompt: str, model: str = DEFAULT_MODEL, timeout: float | None = None,
+                  system: str | None = None) -> str:
+    """Отправляет промпт в Ollama и возвращает сгенерированный текст."""
+    return complete(prompt, model=model, timeout=timeout, system=system)["text"]
+
+
+def get_stats() -> dict:
+    """Накопленная производительность локальной модели: скорость декодирования и prefill."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["model"] = DEFAULT_MODEL
+    stats["num_parallel"] = OLLAMA_NUM_PARALLEL
+    stats["num_ctx"] = OLLAMA_NUM_CTX
+    stats["avg_tokens_per_sec"] = round(stats["eval_tokens"] / stats["eval_seconds"], 2) if stats["eval_seconds"] else None
+    stats["avg_prompt_tokens_per_sec"] = round(stats["prompt_tokens"] / stats["prompt_seconds"], 2) if stats["prompt_seconds"] else None
+    return stats
@@ -2,6 +2,9 @@
 import requests
 import json
 import os
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
 from dotenv import load_dotenv, find_dotenv
 
 # --- НАЧАЛО БЛОКА ДИАГНОСТИКИ ---
@@ -32,35 +35,146 @@ print("--- КОНЕЦ БЛОКА ДИАГНОСТИКИ ---")
 
 # Используем переменную, которую мы проверили
 OPENROUTER_API_KEY = api_key
-OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
+# URL можно переопределить, например, для прогона против локального stub-сервера
+OPENROUTER_API_URL = os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
+DEFAULT_MODEL = "kwaipilot/kat-coder-pro:free"
+# Потоковый режим нужен, чтобы измерять время до первого токена
+OPENROUTER_STREAM = os.getenv("OPENROUTER_STREAM", "1") == "1"
+
+# Коды ответа, при которых имеет смысл повторить запрос
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504}
 
 class LLMError(Exception):
-    """Кастомный класс для ошибок LLM."""
-    pass
+    """Кастомный класс для ошибок LLM.
+
+    status_code и retry_after заполняются для HTTP-ошибок провайдера,
+    retryable подсказывает слою диспетчеризации, стоит ли повторять запрос.
+    """
+    def __init__(self, message: str, status_code: int | None = None,
+                 retry_after: float | None = None, retryable: bool = False):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.retryable = retryable
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Разбирает заголовок Retry-After (секунды или HTTP-дата) в секунды ожидания."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+def _read_stream(response, started: float, deadline: float | None) -> tuple[str, dict, float | None]:
+    """Читает SSE-поток OpenRouter: собирает текст, блок usage и время до первого токена.
 
-def generate_text(prompt: str, model: str = "kwaipilot/kat-coder-pro:free") -> str:
+    Таймаут requests в потоке ограничивает только ожидание каждого чтения, поэтому общий срок
+    вызова (deadline по time.monotonic()) проверяется здесь, на каждой строке потока.
+    """
+    parts = []
+    usage = {}
+    ttft = None
+    finished = False
+    response.encoding = "utf-8"
+    for line in response.iter_lines(decode_unicode=True):
+        if deadline is not None and time.monotonic() > deadline:
+            raise LLMError(f"Таймаут потокового ответа API: ответ не завершён за {deadline - started:g} с", retryable=True)
+        # Строки-комментарии (": OPENROUTER PROCESSING") и пустые строки пропускаем
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            finished = True
+            break
+        try:
+            chunk = json.loads(data)
+        except json.JSONDecodeError:
+            raise LLMError(f"Повреждённый фрагмент потока API: {data[:200]}", retryable=True)
+        if "error" in chunk:
+            raise LLMError(f"Ошибка API в потоке: {chunk['error']}", retryable=True)
+        if chunk.get("usage"):
+            usage = chunk["usage"]
+        for choice in chunk.get("choices") or []:
+            delta = (choice.get("delta") or {}).get("content")
+            if delta:
+                if ttft is None:
+                    ttft = time.monotonic() - started
+                parts.append(delta)
+    if not finished:
+        # Соединение закрылось до "[DONE]": ответ обрезан
+        raise LLMError("Поток ответа API оборвался до завершения.", retryable=True)
+    return "".join(parts), usage, ttft
+
+def complete(prompt: str, model: str = DEFAULT_MODEL, timeout: float | None = None,
+             stream: bool = OPENROUTER_STREAM, system: str | None = None) -> dict:
+    """
+    Одна попытка запроса к OpenRouter. Повторы и failover — в services/llm_service.py.
+    Возвращает словарь с текстом, расходом токенов и временем до первого токена (ttft, только в потоке).
+    """
     print(f"Отправляю запрос в OpenRouter (модель: {model})...")
     
     # Проверяем ключ еще раз перед отправкой
     if not OPENROUTER_API_KEY:
         raise LLMError("API ключ не загружен. Проверьте вывод диагностики при старте.")
 
+    messages = [{"role": "user", "content": prompt}]
+    if system:
+        # Системное сообщение идёт первым: общий префикс для кэша промптов провайдера
+        messages.insert(0, {"role": "system", "content": system})
+
     payload = {
         "model": model,
-        "messages": [{"role": "user", "content": prompt}],
+        "messages": messages,
         "temperature": 0.3,
         # Разрешаем модели генерировать длинные развёрнутые ответы (подробные ТЗ/руководства)
         "max_tokens": 4000,
+        # Просим OpenRouter вернуть usage (в т.ч. стоимость) — он пишется в журнал расхода
+        "usage": {"include": True},
     }
+    if stream:
+        payload["stream"] = True
+        payload["stream_options"] = {"include_usage": True}
     
     headers = {
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
         "Content-Type": "application/json",
     }
     
+    response = None
     try:
-        response = requests.post(OPENROUTER_API_URL, headers=headers, json=payload)
-        response.raise_for_status()
+        started = time.monotonic()
+        deadline = started + timeout if timeout is not None else None
+        response = requests.post(OPENROUTER_API_URL, headers=headers, json=payload, timeout=timeout, stream=stream)
+        if response.status_code >= 400:
+            raise LLMError(
+                f"Ошибка API: HTTP {response.status_code}: {response.text[:200]}",
+                status_code=response.status_code,
+                retry_after=parse_retry_after(response.headers.get("Retry-After")),
+                retryable=response.status_code in RETRYABLE_STATUS_CODES,
+            )
+
+        if stream:
+            generated_text, usage, ttft = _read_stream(response, started, deadline)
+            if not generated_text:
+                raise LLMError("Пустой ответ в потоке от API.", retryable=True)
+            print("Потоковый ответ от OpenRouter получен.")
+            return {
+                "text": generated_text,
+                "model": model,
+                "prompt_tokens": usage.get("prompt_tokens"),
+                "completion_tokens": usage.get("completion_tokens"),
+                "cost": usage.get("cost"),
+                "ttft": ttft,
+            }
         
         response_text = response.text
         try:
@@ -74,16 +188,37 @@ def generate_text(prompt: str, model: str = "kwaipilot/kat-coder-pro:free") -> s
                 response_json = json.loads(cleaned_json)
                 print("JSON успешно исправлен.")
             else:
-                raise LLMError("Не удалось найти валидный JSON в ответе сервера.")
+                raise LLMError("Не удалось найти валидный JSON в ответе сервера.", retryable=True)
         
         if 'choices' in response_json and len(response_json['choices']) > 0 and 'message' in response_json['choices'][0]:
             generated_text = response_json['choices'][0]['message']['content']
+            usage = response_json.get('usage') or {}
             print("Ответ от OpenRouter получен и успешно разобран.")
-            return generated_text
+            return {
+                "text": generated_text,
+                "model": model,
+                "prompt_tokens": usage.get("prompt_tokens"),
+                "completion_tokens": usage.get("completion_tokens"),
+                "cost": usage.get("cost"),
+                "ttft": None,
+            }
         else:
-            raise LLMError("Неверная структура ответа от API.")
+            raise LLMError("Неверная структура ответа от API.", retryable=True)
 
+    except LLMError:
+        raise
+    except requests.exceptions.Timeout as e:
+        raise LLMError(f"Таймаут запроса к API: {e}", retryable=True)
     except requests.exceptions.RequestException as e:
-        raise LLMError(f"Ошибка API: {e}")
+        raise LLMError(f"Ошибка API: {e}", retryable=True)
     except Exception as e:
-        raise LLMError(f"Непредвиденная ошибка: {e}")
\ No newline at end of file
+        raise LLMError(f"Непредвиденная ошибка: {e}")
+    finally:
+        # В потоковом режиме соединение иначе остаётся открытым при ошибке разбора или таймауте
+        if response is not None:
+            response.close()
+
+def generate_text(prompt: str, model: str = DEFAULT_MODEL, timeout: float | None = None,
+                  system: str | None = None) -> str:
+    """Одна попытка запроса к OpenRouter, возвращает только текст ответа."""
+    return complete(prompt, model=model, timeout=timeout, system=system)["text"]
@@ -1,91 +1,206 @@
 # services/pdf_service.py (версия с поддержкой кириллицы)
-from reportlab.lib.pagesizes import letter, A4
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+# Рендер дерева блоков Markdown (services/markdown_tree.py) в PDF по тем же правилам ГОСТ, что и DOCX:
+# А4, поля 30/15/20/20 мм, шрифт с засечками 14 пт, полуторный интервал, абзацный отступ 1,25 см.
+# TTF-шрифты с кириллицей регистрируются и стили собираются один раз на процесс (в пуле экспорта —
+# при старте процесса), а не при каждом вызове.
+# Кроме разбора Markdown модуль не зависит от остальных сервисов, чтобы его можно было выполнять в пуле процессов.
+import io
+import os
+import threading
+from functools import lru_cache
+from xml.sax.saxutils import escape
+
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY, TA_LEFT
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.lib.units import cm, mm
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.lib.enums import TA_JUSTIFY
-import markdown
-import os
+from reportlab.platypus.doctemplate import LayoutError
+from reportlab.platypus import Paragraph, Preformatted, SimpleDocTemplate, Table, TableStyle
 
-# --- РЕГИСТРАЦИЯ ШРИФТОВ С ПОДДЕРЖКОЙ КИРИЛЛИЦЫ ---
-# Регистрируем шрифт Arial, который есть на всех Windows
-try:
-    pdfmetrics.registerFont(TTFont('Arial', 'arial.ttf'))
-    pdfmetrics.registerFontFamily('Arial', TTFont('Arial', 'arial.ttf'))
-except Exception as e:
-    print(f"Не удалось зарегистрировать шрифт Arial: {e}")
-    print("Пожалуйста, убедитесь, что файл arial.ttf доступен в системе.")
-    # Если Arial не найден, можно попробовать DejaVu Sans, но это требует его установки
-    # from reportlab.pdfbase.ttfonts import TTFont
-    # from reportlab.lib.fonts import addMapping
-    # addMapping('DejaVu Sans', 'DejaVuSans', 'DejaVuSans-Bold', 'DejaVuSans-Oblique', 'DejaVuSans-BoldOblique')
-    # pdfmetrics.registerFont(TTFont('DejaVu Sans', 'DejaVuSans.ttf'))
-    # pdfmetrics.registerFontFamily('DejaVu Sans', TTFont('DejaVu Sans', 'DejaVuSans.ttf'))
-
-
-def create_pdf(content: str, title: str) -> str:
-    """
-    Конвертирует Markdown-текст в PDF-файл с поддержкой кириллицы.
-    """
-    print(f"Создаю PDF файл (с поддержкой кириллицы): {title}.pdf")
-    
-    # 1. Конвертируем Markdown в HTML
-    html_content = markdown.markdown(content, extensions=['tables', 'fenced_code'])
-    
-    # 2. Создаем PDF документ
-    doc = SimpleDocTemplate(f"output/{title.replace(' ', '_')}.pdf", pagesize=A4)
-    
-    # 3. Получаем стили и создаем свой стиль для кириллического текста
-    styles = getSampleStyleSheet()
-    
-    # Создаем стиль для обычного текста с поддержкой кириллицы
-    body_style = ParagraphStyle(
-        'BodyText',
-        parent=styles['Normal'],
-        fontName='Arial',  # <-- УКАЗЫВАЕМ НАШ ШРИФТ
-        fontSize=12,
-        spaceAfter=12,
-        leading=14,
-        alignment=TA_JUSTIFY,
-    )
-    
-    # Создаем стиль для заголовков
-    heading_style = ParagraphStyle(
-        'Heading1',
-        parent=styles['Heading1'],
-        fontName='Arial', # <-- И ЗДЕСЬ ТОЖЕ
-        fontSize=18,
-        spaceAfter=20,
-        textColor='#2c3e50',
+from services import markdown_tree
+
+# Каталог с TTF-шрифтами, который просматривается первым (например, с Times New Roman)
+PDF_FONT_DIR = os.getenv("PDF_FONT_DIR", "")
+
+_FONT_DIRS = [
+    PDF_FONT_DIR,
+    "fonts",
+    "/usr/share/fonts/truetype/liberation",
+    "/usr/share/fonts/truetype/liberation2",
+    "/usr/share/fonts/truetype/dejavu",
+    "/usr/share/fonts/TTF",
+    "C:\\Windows\\Fonts",
+]
+# Семейства по порядку предпочтения: (обычный, жирный, курсив, жирный курсив)
+_SERIF_FAMILIES = [
+    ("times.ttf", "timesbd.ttf", "timesi.ttf", "timesbi.ttf"),
+    ("LiberationSerif-Regular.ttf", "LiberationSerif-Bold.ttf", "LiberationSerif-Italic.ttf", "LiberationSerif-BoldItalic.ttf"),
+    ("DejaVuSerif.ttf", "DejaVuSerif-Bold.ttf", "DejaVuSerif-Italic.ttf", "DejaVuSerif-BoldItalic.ttf"),
+    ("arial.ttf", "arialbd.ttf", "ariali.ttf", "arialbi.ttf"),
+    ("DejaVuSans.ttf", "DejaVuSans-Bold.ttf", "DejaVuSans-Oblique.ttf", "DejaVuSans-BoldOblique.ttf"),
+]
+_MONO_FONTS = ["cour.ttf", "LiberationMono-Regular.ttf", "DejaVuSansMono.ttf"]
+
+BASE_FONT = "GostSerif"
+CODE_FONT = "GostMono"
+BULLET_INDENT = 0.75 * cm
+
+_fonts_lock = threading.Lock()
+
+
+def _find_font(filename: str) -> str | None:
+    for directory in _FONT_DIRS:
+        if directory:
+            path = os.path.join(directory, filename)
+            if os.path.isfile(path):
+                return path
+    return None
+
+
+@lru_cache(maxsize=1)
+def _fonts() -> tuple[str, str]:
+    """Регистрирует шрифты с кириллицей и возвращает имена (основной, моноширинный)."""
+    with _fonts_lock:
+        base, mono = "Times-Roman", "Courier"
+        for family in _SERIF_FAMILIES:
+            paths = [_find_font(name) for name in family]
+            if not paths[0]:
+                continue
+            # Недостающие начертания заменяем обычным: текст важнее точного начертания
+            names = [BASE_FONT, f"{BASE_FONT}-Bold", f"{BASE_FONT}-Italic", f"{BASE_FONT}-BoldItalic"]
+            for name, path in zip(names, paths):
+                pdfmetrics.registerFont(TTFont(name, path or paths[0]))
+            pdfmetrics.registerFontFamily(BASE_FONT, normal=names[0], bold=names[1], italic=names[2], boldItalic=names[3])
+            base = BASE_FONT
+            break
+        else:
+            print("ВНИМАНИЕ: TTF-шрифт с кириллицей не найден (задайте PDF_FONT_DIR), кириллица в PDF не отобразится.")
+        mono_path = next(filter(None, (_find_font(name) for name in _MONO_FONTS)), None)
+        if mono_path:
+            pdfmetrics.registerFont(TTFont(CODE_FONT, mono_path))
+            mono = CODE_FONT
+        return base, mono
+
+
+@lru_cache(maxsize=1)
+def _styles() -> dict[str, ParagraphStyle]:
+    base, mono = _fonts()
+    normal = ParagraphStyle(
+        "Normal", fontName=base, fontSize=14, leading=21,
+        firstLineIndent=1.25 * cm, alignment=TA_JUSTIFY,
     )
+    styles = {
+        "Normal": normal,
+        "Title": ParagraphStyle("Title", parent=normal, fontSize=16, leading=24, firstLineIndent=0,
+                                alignment=TA_CENTER, spaceAfter=12),
+        "Quote": ParagraphStyle("Quote", parent=normal, leftIndent=1.25 * cm, firstLineIndent=0),
+        "Code": ParagraphStyle("Code", fontName=mono, fontSize=10, leading=12, spaceBefore=6, spaceAfter=6),
+        "Table Text": ParagraphStyle("Table Text", parent=normal, fontSize=12, leading=14,
+                                     firstLineIndent=0, alignment=TA_LEFT),
+    }
+    for level in range(1, 7):
+        size = 16 if level == 1 else 14
+        styles[f"Heading {level}"] = ParagraphStyle(
+            f"Heading {level}", parent=normal, fontSize=size, leading=size * 1.5,
+            alignment=TA_LEFT, spaceBefore=12, spaceAfter=6, keepWithNext=1,
+        )
+    for level in range(markdown_tree.MAX_LIST_LEVEL + 1):
+        styles[f"List {level}"] = ParagraphStyle(
+            f"List {level}", parent=normal, firstLineIndent=0, alignment=TA_LEFT,
+            leftIndent=1.25 * cm + (level + 1) * BULLET_INDENT, bulletIndent=1.25 * cm + level * BULLET_INDENT,
+            bulletFontName=base,
+        )
+    return styles
 
+
+def warm_up() -> None:
+    """Регистрирует шрифты и собирает стили заранее (вызывается при старте процесса пула)."""
+    _styles()
+
+
+def _markup(spans: list[tuple[str, str]], bold: bool = False) -> str:
+    """Спаны -> разметка Paragraph (<b>, <i>, <font>) с экранированием текста."""
+    mono = _fonts()[1]
+    parts = []
+    for style, text in spans:
+        text = escape(text)
+        if style == "b":
+            text = f"<b>{text}</b>"
+        elif style == "i":
+            text = f"<i>{text}</i>"
+        elif style == "code":
+            text = f'<font face="{mono}">{text}</font>'
+        parts.append(text)
+    markup = "".join(parts)
+    return f"<b>{markup}</b>" if bold else markup
+
+
+def _table(rows: list[list[list[tuple[str, str]]]], width: float) -> Table:
+    styles = _styles()
+    columns = max(len(row) for row in rows)
+    data = [
+        [Paragraph(_markup(spans, bold=row_index == 0), styles["Table Text"]) for spans in row]
+        + [""] * (columns - len(row))
+        for row_index, row in enumerate(rows)
+    ]
+    # splitInRow: строка выше страницы (длинная ячейка) переносится по частям, а не роняет рендер
+    table = Table(data, colWidths=[width / columns] * columns, repeatRows=1, splitInRow=1)
+    table.setStyle(TableStyle([
+        ("GRID", (0, 0), (-1, -1), 0.5, colors.black),
+        ("VALIGN", (0, 0), (-1, -1), "TOP"),
+    ]))
+    return table
+
+
+def _table_as_paragraphs(rows: list[list[list[tuple[str, str]]]]) -> list[Paragraph]:
+    """Таблица строками "ячейка | ячейка": запасной вариант, когда таблица не укладывается на страницы."""
+    styles = _styles()
+    return [
+        Paragraph(" | ".join(_markup(spans, bold=row_index == 0) for spans in row), styles["Normal"])
+        for row_index, row in enumerate(rows)
+    ]
+
+
+def _build(blocks: list[tuple], title: str | None, tables_as_text: bool) -> bytes:
+    styles = _styles()
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(
+        buffer, pagesize=A4, title=title or "",
+        leftMargin=30 * mm, rightMargin=15 * mm, topMargin=20 * mm, bottomMargin=20 * mm,
+    )
     story = []
-    
-    # 4. Добавляем заголовок
-    story.append(Paragraph(title, heading_style))
-    story.append(Spacer(1, 12))
-
-    # 5. Добавляем основной контент, используя наш новый стиль
-    lines = html_content.split('\n')
-    for line in lines:
-        if line.strip():
-            if line.startswith('###'):
-                p = Paragraph(line[3:].strip(), styles['Heading3'])
-            elif line.startswith('##'):
-                p = Paragraph(line[2:].strip(), styles['Heading2'])
-            elif line.startswith('#'):
-                p = Paragraph(line[1:].strip(), styles['Heading1'])
+    if title:
+        story.append(Paragraph(escape(title), styles["Title"]))
+    for block in blocks:
+        kind = block[0]
+        if kind == "paragraph":
+            story.append(Paragraph(_markup(block[1]), styles["Normal"]))
+        elif kind == "heading":
+            story.append(Paragraph(_markup(block[2]), styles[f"Heading {block[1]}"]))
+        elif kind == "bullet":
+            story.append(Paragraph(_markup(block[2]), styles[f"List {block[1]}"], bulletText="•"))
+        elif kind == "numbered":
+            story.append(Paragraph(_markup(block[3]), styles[f"List {block[1]}"], bulletText=block[2]))
+        elif kind == "quote":
+            story.append(Paragraph(f"<i>{_markup(block[1])}</i>", styles["Quote"]))
+        elif kind == "code":
+            story.append(Preformatted(block[1], styles["Code"]))
+        elif kind == "table":
+            if tables_as_text:
+                story.extend(_table_as_paragraphs(block[1]))
             else:
-                p = Paragraph(line.strip(), body_style) # <-- ИСПОЛЬЗУЕМ НАШ СТИЛЬ
-            story.append(p)
-            story.append(Spacer(1, 6))
-        else:
-            story.append(Spacer(1, 6))
-
-    # 6. Строим документ
+                story.append(_table(block[1], doc.width))
     doc.build(story)
-    
-    file_path = os.path.join("output", f"{title.replace(' ', '_')}.pdf")
-    print(f"Файл сохранен по пути: {file_path}")
-    return file_path
\ No newline at end of file
+    return buffer.getvalue()
+
+
+def render(blocks: list[tuple], title: str | None = None) -> bytes:
+    """Рендерит дерево блоков в PDF и возвращает байты файла."""
+    try:
+        return _build(blocks, title, tables_as_text=False)
+    except LayoutError as e:
+        print(f"PDF: таблица не укладывается на страницу ({str(e)[:100]}), вывожу таблицы текстом.")
+        return _build(blocks, title, tables_as_text=True)
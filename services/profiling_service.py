@@ -0,0 +1,202 @@
+# services/profiling_service.py
+# Профилирование запросов /process: дерево этапов (span) со временем wall/CPU и пиком аллокаций.
+# Дерево времени строится для каждого запроса (это дёшево), замер памяти через tracemalloc включается
+# только для профилируемых запросов: по заголовку X-Profile или с вероятностью PROFILE_SAMPLE_RATE.
+# Профилируемые запросы и все запросы дольше PROFILE_SLOW_THRESHOLD сохраняются вместе с входными
+# данными в каталог profiles/, откуда их можно посмотреть через API.
+import os
+import json
+import time
+import random
+import threading
+import tracemalloc
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # доля запросов, 0..1
+PROFILE_SLOW_THRESHOLD = float(os.getenv("PROFILE_SLOW_THRESHOLD", "180"))  # с, цель генерации из tech_req.md §4.1
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+
+_current_span = contextvars.ContextVar("profile_span", default=None)
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+
+class ProfileNotFoundError(Exception):
+    """Профиль с указанным id отсутствует."""
+    pass
+
+
+class Span:
+    def __init__(self, name: str, parent: "Span | None" = None, track_memory: bool = False, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.parent = parent
+        self.track_memory = track_memory
+        self.children: list[Span] = []
+        self._lock = threading.Lock()
+        self.thread = threading.current_thread().name
+        self.wall = None
+        self.cpu = None
+        self.mem_peak = None
+        self._child_peak = 0
+        self._started = time.perf_counter()
+        self._cpu_started = time.thread_time()
+        self._mem_started = 0
+        if track_memory and tracemalloc.is_tracing():
+            self._mem_started = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        if parent is not None:
+            with parent._lock:
+                parent.children.append(self)
+
+    def finish(self) -> None:
+        self.wall = time.perf_counter() - self._started
+        # CPU считается для потока, в котором выполнялся этап (дочерние этапы в пулах — отдельно)
+        self.cpu = time.thread_time() - self._cpu_started
+        if self.track_memory and tracemalloc.is_tracing():
+            # Пик tracemalloc общий на процесс: при параллельных этапах значение приблизительное
+            peak = max(tracemalloc.get_traced_memory()[1] - self._mem_started, self._child_peak, 0)
+            self.mem_peak = peak
+            if self.parent is not None:
+                with self.parent._lock:
+                    self.parent._child_peak = max(self.parent._child_peak, peak)
+
+    def to_dict(self) -> dict:
+        data = {
+            "name": self.name,
+            "thread": self.thread,
+            "wall_s": round(self.wall, 4) if self.wall is not None else None,
+            "cpu_s": round(self.cpu, 4) if self.cpu is not None else None,
+        }
+        if self.mem_peak is not None:
+            data["mem_peak_kb"] = round(self.mem_peak / 1024, 1)
+        if self.attrs:
+            data["attrs"] = self.attrs
+        if self.children:
+            data["children"] = [c.to_dict() for c in self.children]
+        return data
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Этап внутри профилируемого запроса. Вне запроса ничего не делает."""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    current = Span(name, parent=parent, track_memory=parent.track_memory, **attrs)
+    token = _current_span.set(current)
+    try:
+        yield current
+    finally:
+        _current_span.reset(token)
+        current.finish()
+
+
+def _start_tracemalloc() -> None:
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc() -> None:
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0 and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+@contextmanager
+def profile_request(request_id: str, inputs: dict, requested: bool = False):
+    """
+    Корневой span запроса. Замер памяти включается по запросу клиента или по сэмплированию;
+    профиль сохраняется, если он был запрошен/сэмплирован или запрос оказался медленным.
+    """
+    sampled = not requested and PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+    detailed = requested or sampled
+    if detailed:
+        _start_tracemalloc()
+    root = Span("process", track_memory=detailed)
+    token = _current_span.set(root)
+    try:
+        yield root
+    finally:
+        _current_span.reset(token)
+        root.finish()
+        if detailed:
+            _stop_tracemalloc()
+        slow = root.wall >= PROFILE_SLOW_THRESHOLD
+        if detailed or slow:
+            reason = "slow" if slow else ("requested" if requested else "sampled")
+            _save_profile(request_id, inputs, root, reason)
+
+
+def _save_profile(request_id: str, inputs: dict, root: Span, reason: str) -> None:
+    started_at = datetime.now()
+    profile_id = f"{started_at.strftime('%Y%m%dT%H%M%S')}_{request_id}"
+    record = {
+        "profile_id": profile_id,
+        "created_at": started_at.isoformat(timespec="seconds"),
+        "reason": reason,
+        "wall_s": round(root.wall, 3),
+        "inputs": inputs,
+        "spans": root.to_dict(),
+    }
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, f"{profile_id}.json"), "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False, indent=2)
+        print(f"Профиль запроса сохранён ({reason}, {root.wall:.1f} с): {profile_id}")
+        _prune_profiles()
+    except OSError as e:
+        # Профилирование не должно ломать обработку запроса
+        print(f"Не удалось сохранить профиль запроса: {e}")
+
+
+def _prune_profiles() -> None:
+    files = sorted(f for f in os.listdir(PROFILE_DIR) if f.endswith(".json"))
+    for name in files[:-PROFILE_MAX_FILES] if len(files) > PROFILE_MAX_FILES else []:
+        os.remove(os.path.join(PROFILE_DIR, name))
+
+
+def list_profiles() -> list[dict]:
+    """Краткий список сохранённых профилей, новые первыми."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(PROFILE_DIR, name), "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        profiles.append({
+            "profile_id": record["profile_id"],
+            "created_at": record["created_at"],
+            "reason": record["reason"],
+            "wall_s": record["wall_s"],
+            "request_type": record["inputs"].get("request_type"),
+            "query": record["inputs"].get("query"),
+        })
+    return profiles
+
+
+def profile_path(profile_id: str) -> str:
+    """Путь к файлу профиля; id проверяется, чтобы нельзя было выйти за пределы каталога."""
+    if not profile_id or not all(c.isalnum() or c in "_-" for c in profile_id):
+        raise ProfileNotFoundError(f"Некорректный id профиля: {profile_id}")
+    path = os.path.join(PROFILE_DIR, f"{profile_id}.json")
+    if not os.path.exists(path):
+        raise ProfileNotFoundError(f"Профиль {profile_id} не найден.")
+    return path
@@ -0,0 +1,294 @@
+# services/prompt_service.py
+# Шаблоны промптов для генерации. Шаблоны компилируются один раз при импорте и
+# упорядочены от статичного к динамичному: общий системный промпт -> неизменные инструкции ->
+# запрос пользователя -> раздел -> найденный контекст. Благодаря этому все вызовы одного типа
+# (и все разделы одного документа) начинаются с одинакового префикса, и провайдер
+# (OpenRouter) или локальная Ollama могут переиспользовать KV-кэш этого префикса.
+import string
+import textwrap
+import threading
+
+from services.llm_governor import LLM_CHARS_PER_TOKEN
+from services.profiling_service import span
+
+# Общий системный промпт для всех вызовов: одинаковый префикс у всех разделов и типов запросов
+SYSTEM_MESSAGE = textwrap.dedent("""
+    Ты — старший технический писатель и системный аналитик. Ты готовишь техническую документацию
+    и ответы по системе, опираясь только на предоставленную БАЗУ ЗНАНИЙ.
+
+    ОБЩИЕ ПРАВИЛА:
+    1. НЕ ПРИДУМЫВАЙ ФАКТЫ ВНЕ БАЗЫ ЗНАНИЙ. Если информации не хватает, явно укажи, какие данные нужно уточнить.
+    2. НЕ СМЕШИВАЙ ОПИСАНИЯ РАЗНЫХ СИСТЕМ. Если в БАЗЕ ЗНАНИЙ есть описания разных систем (АСУ ПГР, цифровой двойник, другие), выбери ту, которая прямо следует из запроса, и описывай только её.
+    3. БАЗА ЗНАНИЙ может содержать HTML-разметку — в ответе HTML-тегов быть не должно.
+    4. Соблюдай официально-деловой стиль, понятный аналитику, архитектору и разработчику.
+""").strip()
+
+
+class PromptTemplate:
+    """Шаблон промпта, разобранный один раз: при рендере только склеиваются готовые сегменты."""
+
+    def __init__(self, name: str, text: str):
+        self.name = name
+        self.text = textwrap.dedent(text).strip()
+        self._segments = list(string.Formatter().parse(self.text))
+        self.fields = [field for _, field, _, _ in self._segments if field]
+        # Неизменная часть шаблона до первой подстановки — общий префикс всех вызовов
+        self.static_prefix = self._segments[0][0] if self._segments else ""
+
+    def render(self, **values) -> str:
+        parts = []
+        for literal, field, spec, _ in self._segments:
+            parts.append(literal)
+            if field is not None:
+                parts.append(format(values[field], spec or ""))
+        return "".join(parts)
+
+
+TEMPLATES = {
+    "term": PromptTemplate("term", """
+        ЗАДАЧА: извлечь чистое, понятное определение ТЕРМИНА из ИСХОДНОГО ТЕКСТА.
+
+        ИНСТРУКЦИИ:
+        1. Внимательно прочитай ИСХОДНЫЙ ТЕКСТ.
+        2. Найди в нем определение для ТЕРМИНА.
+        3. Сформулируй ответ, но **ОБЯЗАТЕЛЬНО УБЕРИ ВСЕ HTML-ТЕГИ**.
+        4. Ответ должен быть коротким, четким и содержать только определение.
+        5. Если в тексте нет четкого определения, напиши "Определение не найдено в предоставленном тексте."
+
+        ТЕРМИН:
+        "{user_query}"
+
+        ИСХОДНЫЙ ТЕКСТ (МОЖЕТ СОДЕРЖАТЬ HTML-РАЗМЕТКУ):
+        ---
+        {context}
+        ---
+    """),
+    "qa": PromptTemplate("qa", """
+        ЗАДАЧА: ответить на ВОПРОС пользователя по существу, используя только предоставленную БАЗУ ЗНАНИЙ.
+
+        ИНСТРУКЦИИ:
+        1. Ответь ТОЛЬКО на этот вопрос. Не нужно составлять отдельный документ, ТЗ или Руководство пользователя.
+        2. НЕ добавляй заголовки вида "Руководство пользователя", "Техническое задание", "Документ" и т.п.
+        3. Используй БАЗУ ЗНАНИЙ, не придумывай факты. Если информации явно не хватает, аккуратно укажи, какие данные нужно уточнить.
+        4. Если вопрос про действия пользователя ("как сделать ..."), опиши шаги по порядку с точки зрения пользователя системы.
+        5. Объём ответа: от 1 до 5 абзацев, можно использовать маркированные списки для шагов или перечней.
+        6. Не смешивай описания разных систем: если в БАЗЕ ЗНАНИЙ несколько систем, ориентируйся на ту, которая прямо следует из вопроса.
+
+        ВОПРОС ПОЛЬЗОВАТЕЛЯ:
+        "{user_query}"
+
+        БАЗА ЗНАНИЙ:
+        ---
+        {context}
+        ---
+    """),
+    "tz_section": PromptTemplate("tz_section", """
+        ЗАДАЧА: на основе ЗАПРОСА, БАЗЫ ЗНАНИЙ и описания раздела подготовить ПОЛНЫЙ текст указанного РАЗДЕЛА Технического задания.
+
+        ПРАВИЛА:
+        1. СГЕНЕРИРУЙ ТОЛЬКО ТЕКСТ УКАЗАННОГО РАЗДЕЛА, со всеми его подпунктами, но без других разделов.
+        2. НЕ ДЕЛАЙ КРАТКОЕ РЕЗЮМЕ. Пиши развернуто, максимально подробно, опираясь на БАЗУ ЗНАНИЙ.
+        3. НЕ ПРИДУМЫВАЙ ФАКТЫ ВНЕ БАЗЫ ЗНАНИЙ. Если информации не хватает, явно пиши, какие данные нужно уточнить.
+        4. НЕ СМЕШИВАЙ ОПИСАНИЯ РАЗНЫХ СИСТЕМ. Если в БАЗЕ ЗНАНИЙ есть разные системы, выбирай только ту, которая соответствует запросу.
+        5. СОХРАНЯЙ ОФИЦИАЛЬНО-ДЕЛОВОЙ СТИЛЬ И СТРУКТУРУ ГОСТОВОГО ТЗ.
+
+        ЗАПРОС ПОЛЬЗОВАТЕЛЯ:
+        "{user_query}"
+
+        РАЗДЕЛ ТЗ:
+        "{section_title}"
+
+        ЧТО НУЖНО ОСВЕТИТЬ В ЭТОМ РАЗДЕЛЕ:
+        {section_hint}
+
+        БАЗА ЗНАНИЙ:
+        ---
+        {context}
+        ---
+    """),
+    "manual_section": PromptTemplate("manual_section", """
+        ЗАДАЧА: на основе ЗАПРОСА, БАЗЫ ЗНАНИЙ и описания раздела подготовить ПОЛНЫЙ текст указанного РАЗДЕЛА подробного Руководства пользователя по системе.
+
+        ПРАВИЛА:
+        1. СГЕНЕРИРУЙ ТОЛЬКО ТЕКСТ УКАЗАННОГО РАЗДЕЛА, со всеми его подпунктами, но без других разделов.
+        2. ПИШИ С ТОЧКИ ЗРЕНИЯ КОНЕЧНОГО ПОЛЬЗОВАТЕЛЯ/ОПЕРАТОРА: что он видит в интерфейсе и какие шаги выполняет.
+        3. НЕ ПЕРЕПИСЫВАЙ ТЕХНИЧЕСКОЕ ЗАДАНИЕ. Описывай именно практическое использование системы, а не цели проекта и бизнес-контекст.
+        4. МАКСИМАЛЬНО ИСПОЛЬЗУЙ БАЗУ ЗНАНИЙ. Если в ней мало данных по интерфейсу, переходи на аккуратные обобщения и явно помечай, что описываешь типовой сценарий.
+        5. НЕ ПРИДУМЫВАЙ НОВЫЕ СУЩЕСТВА, ПОДСИСТЕМЫ И ТЕРМИНЫ, КОТОРЫХ НЕТ В БАЗЕ ЗНАНИЙ.
+        6. ИЗБЕГАЙ ПУСТОЙ ОБЩЕЙ ТЕОРИИ. Каждый подраздел должен помогать пользователю реально работать с системой.
+
+        ЗАПРОС ПОЛЬЗОВАТЕЛЯ:
+        "{user_query}"
+
+        РАЗДЕЛ РУКОВОДСТВА:
+        "{section_title}"
+
+        ЧТО НУЖНО ОСВЕТИТЬ В ЭТОМ РАЗДЕЛЕ:
+        {section_hint}
+
+        БАЗА ЗНАНИЙ:
+        ---
+        {context}
+        ---
+    """),
+    "template_section": PromptTemplate("template_section", """
+        ЗАДАЧА: на основе ЗАПРОСА, БАЗЫ ЗНАНИЙ и описания раздела из шаблона ГОСТ 34 подготовить ПОЛНЫЙ текст указанного РАЗДЕЛА документа.
+
+        ПРАВИЛА:
+        1. СГЕНЕРИРУЙ ТОЛЬКО ТЕКСТ УКАЗАННОГО РАЗДЕЛА, со всеми его подпунктами, но без других разделов.
+        2. СЛЕДУЙ ПОЯСНЕНИЯМ ШАБЛОНА: они описывают, что по ГОСТ должно быть в разделе. Сами пояснения в текст не переписывай.
+        3. НЕ ДЕЛАЙ КРАТКОЕ РЕЗЮМЕ. Пиши развернуто, опираясь на БАЗУ ЗНАНИЙ.
+        4. НЕ ПРИДУМЫВАЙ ФАКТЫ ВНЕ БАЗЫ ЗНАНИЙ. Если информации не хватает, явно пиши, какие данные нужно уточнить.
+        5. СОХРАНЯЙ ОФИЦИАЛЬНО-ДЕЛОВОЙ СТИЛЬ И СТРУКТУРУ ДОКУМЕНТА ПО ГОСТ 34.
+
+        ВИД ДОКУМЕНТА:
+        "{document_kind}"
+
+        ЗАПРОС ПОЛЬЗОВАТЕЛЯ:
+        "{user_query}"
+
+        РАЗДЕЛ:
+        "{section_title}"
+
+        ЧТО НУЖНО ОСВЕТИТЬ В ЭТОМ РАЗДЕЛЕ (по шаблону):
+        {section_hint}
+
+        БАЗА ЗНАНИЙ:
+        ---
+        {context}
+        ---
+    """),
+    "general": PromptTemplate("general", """
+        ЗАДАЧА: на основе ЗАПРОСА и БАЗЫ ЗНАНИЙ подготовить МАКСИМАЛЬНО ПОДРОБНЫЙ, полноформатный документ (например, Техническое задание по ГОСТ, подробное Руководство пользователя или аналогичный по глубине документ), а не краткую выжимку.
+
+        ОБЩИЕ ПРАВИЛА:
+        1.  НЕ ДЕЛАЙ КРАТКОЕ РЕЗЮМЕ. Это должен быть развернутый документ уровня аналитика/проектировщика, а не конспект.
+        2.  ИСПОЛЬЗУЙ МАКСИМУМ РЕЛЕВАНТНОЙ ИНФОРМАЦИИ из БАЗЫ ЗНАНИЙ, не выбрасывай важные детали, если они относятся к теме.
+        3.  НЕ ПРИДУМЫВАЙ ФАКТЫ. Используй только то, что есть в БАЗЕ ЗНАНИЙ. Если данных для какого‑то аспекта нет — прямо укажи, что информация отсутствует.
+        4.  НЕЛЬЗЯ СМЕШИВАТЬ РАЗНЫЕ СИСТЕМЫ. Выбери ОДНУ целевую систему/объект, который следует из ЗАПРОСА, и описывай только её. Не объединяй описания разных систем в один документ.
+        5.  СТРУКТУРА ДОЛЖНА БЫТЬ ЛОГИЧЕСКИ ПОЛНОЙ: введение, область применения, термины и сокращения (если есть), общие сведения о системе, требования (функциональные, нефункциональные, к интерфейсам, интеграциям, надёжности и т.п.), архитектура/состав, пользовательские роли и сценарии, порядок ввода в действие, сопровождение и т.д. Адаптируй структуру под тип документа, но делай её максимально полной.
+
+        ИНСТРУКЦИИ ПО РАБОТЕ:
+        1.  Определи тип документа по ЗАПРОСУ (Техническое задание, Руководство пользователя, описание подсистемы и т.п.).
+        2.  Определи целевую систему/объект (например, цифровой двойник, АСУ ПГР и т.п.) и строго придерживайся именно её.
+        3.  Внимательно изучи БАЗУ ЗНАНИЙ и выбери все фрагменты, относящиеся к выбранному типу документа и целевой системе.
+        4.  Построй подробный документ с чёткими разделами и подпунктами. Каждый раздел заполняй максимально полно, используя релевантные фрагменты из БАЗЫ ЗНАНИЙ.
+        5.  Если для какого‑то раздела данных мало или нет, явно укажи это текстом (например: "Информация по данному аспекту в базе знаний отсутствует"), но не опускай раздел полностью.
+
+        СФОРМИРУЙ ИТОГОВЫЙ ДОКУМЕНТ:
+        - Полноформатный, детализированный.
+        - В официально‑деловом стиле, понятный аналитику, архитектору и разработчику.
+        - Без искусственного сокращения объёма: не пытайся уместить всё в несколько абзацев, раскрывай тему настолько подробно, насколько позволяет БАЗА ЗНАНИЙ.
+
+        ЗАПРОС:
+        "{user_query}"
+
+        БАЗА ЗНАНИЙ:
+        ---
+        {context}
+        ---
+    """),
+    # Шаг map в режиме map-reduce: сжатие группы чанков в заметки по запросу
+    "map_notes": PromptTemplate("map_notes", """
+        ЗАДАЧА: из ФРАГМЕНТОВ БАЗЫ ЗНАНИЙ выписать все сведения, относящиеся к ЗАПРОСУ, в виде сжатых заметок. По этим заметкам потом будет составлен итоговый документ, поэтому важные детали терять нельзя.
+
+        ИНСТРУКЦИИ:
+        1. Выписывай только сведения, относящиеся к ЗАПРОСУ и целевой системе: назначение, требования, функции, параметры, роли, сценарии, интеграции, термины.
+        2. Сохраняй конкретику: названия, числа, перечни, формулировки требований. Не обобщай и не добавляй ничего от себя.
+        3. Формат — маркированный список коротких пунктов, без вступлений и выводов.
+        4. Если во фрагментах нет сведений, относящихся к ЗАПРОСУ, ответь одной строкой: НЕТ РЕЛЕВАНТНЫХ СВЕДЕНИЙ
+
+        ЗАПРОС:
+        "{user_query}"
+
+        ФРАГМЕНТЫ БАЗЫ ЗНАНИЙ:
+        ---
+        {context}
+        ---
+    """),
+    # Первая фаза outline-first генерации: короткий вызов, который строит план документа
+    "outline": PromptTemplate("outline", """
+        ЗАДАЧА: составить ПЛАН полноформатного документа по ЗАПРОСУ. Текст документа писать НЕ нужно — по каждому пункту плана он будет написан отдельно.
+
+        ИНСТРУКЦИИ:
+        1. Определи тип документа по ЗАПРОСУ и целевую систему, опираясь на БАЗУ ЗНАНИЙ.
+        2. Составь логически полный список разделов верхнего уровня (введение, общие сведения, требования, архитектура, роли и сценарии и т.д. — по типу документа), не более {max_sections}.
+        3. Каждый раздел — ОДНА строка в формате:
+           N. Название раздела | что нужно раскрыть в разделе (одно предложение)
+        4. Никакого другого текста: без вступления, пояснений, подпунктов и пустых строк между пунктами.
+
+        ЗАПРОС:
+        "{user_query}"
+
+        БАЗА ЗНАНИЙ (ВЫБОРКА):
+        ---
+        {context}
+        ---
+    """),
+    # Вторая фаза: раскрытие одного пункта плана. План идёт до раздела, чтобы у всех
+    # разделов одного документа был общий префикс
+    "outline_section": PromptTemplate("outline_section", """
+        ЗАДАЧА: написать ПОЛНЫЙ текст одного РАЗДЕЛА документа по ЗАПРОСУ. Остальные разделы плана пишутся отдельно, их содержимое не повторяй.
+
+        ПРАВИЛА:
+        1. Начни с заголовка раздела с его номером из ПЛАНА, далее — подпункты с нумерацией внутри раздела.
+        2. НЕ ДЕЛАЙ КРАТКОЕ РЕЗЮМЕ. Пиши развернуто, максимально подробно, опираясь на БАЗУ ЗНАНИЙ.
+        3. Если данных по разделу мало или нет, явно укажи это текстом, но не пропускай раздел.
+
+        ЗАПРОС:
+        "{user_query}"
+
+        ПЛАН ДОКУМЕНТА:
+        {outline}
+
+        РАЗДЕЛ:
+        "{section_title}"
+
+        ЧТО НУЖНО ОСВЕТИТЬ В ЭТОМ РАЗДЕЛЕ:
+        {section_hint}
+
+        БАЗА ЗНАНИЙ:
+        ---
+        {context}
+        ---
+    """),
+}
+
+_stats_lock = threading.Lock()
+_stats = {name: {"renders": 0, "prompt_chars": 0} for name in TEMPLATES}
+
+
+def render(name: str, **values) -> str:
+    """Рендерит пользовательскую часть промпта. Системная часть — SYSTEM_MESSAGE, общая для всех."""
+    with span("prompt", template=name):
+        prompt = TEMPLATES[name].render(**values)
+    with _stats_lock:
+        _stats[name]["renders"] += 1
+        _stats[name]["prompt_chars"] += len(SYSTEM_MESSAGE) + len(prompt)
+    return prompt
+
+
+def shared_prefix_length(name: str) -> int:
+    """Длина (в символах) общего префикса всех вызовов шаблона: системный промпт + статичная часть."""
+    return len(SYSTEM_MESSAGE) + len(TEMPLATES[name].static_prefix)
+
+
+def prefix_report() -> list[dict]:
+    """Оценка экономии prefill: сколько символов/токенов каждого вызова приходится на общий префикс."""
+    report = []
+    for name in TEMPLATES:
+        with _stats_lock:
+            renders = _stats[name]["renders"]
+            prompt_chars = _stats[name]["prompt_chars"]
+        prefix_chars = shared_prefix_length(name)
+        avg_chars = prompt_chars / renders if renders else None
+        report.append({
+            "template": name,
+            "shared_prefix_chars": prefix_chars,
+            "shared_prefix_tokens_est": int(prefix_chars / LLM_CHARS_PER_TOKEN),
+            "renders": renders,
+            "avg_prompt_chars": round(avg_chars) if avg_chars else None,
+            # Доля промпта, которую провайдер может взять из кэша префикса
+            "shared_ratio": round(prefix_chars / avg_chars, 3) if avg_chars else None,
+        })
+    return report
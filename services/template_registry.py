@@ -0,0 +1,359 @@
+# services/template_registry.py
+# Реестр шаблонов документов из templates/. Каждый шаблон (.doc/.dot Word 97–2003 или .docx) один раз
+# разбирается в скелет разделов: заголовки верхнего уровня и подсказки к ним из подзаголовков и
+# пояснительного текста шаблона. Скелеты кешируются в памяти и в TEMPLATE_CACHE_PATH и пересобираются,
+# только если у файла изменились mtime/размер и хеш содержимого — на запрос разбор шаблона не тратится.
+#
+# Собрать кеш заранее (например, при сборке образа): python -m services.template_registry
+import os
+import re
+import json
+import struct
+import hashlib
+import threading
+from dotenv import load_dotenv
+
+try:
+    import olefile
+except ImportError:
+    olefile = None
+    print("ВНИМАНИЕ: библиотека 'olefile' не найдена, шаблоны .doc читаться не будут. Выполните 'pip install olefile'")
+
+load_dotenv()
+
+TEMPLATES_DIR = os.getenv("TEMPLATES_DIR", "templates")
+TEMPLATE_CACHE_PATH = os.getenv("TEMPLATE_CACHE_PATH", os.path.join(TEMPLATES_DIR, ".skeletons.json"))
+# Сколько символов пояснений шаблона попадает в подсказку к разделу
+TEMPLATE_HINT_CHARS = int(os.getenv("TEMPLATE_HINT_CHARS", "1500"))
+
+SUPPORTED_EXTENSIONS = (".doc", ".dot", ".docx")
+# Меняется вместе с логикой разбора: старый кеш тогда пересобирается целиком
+_PARSER_VERSION = 1
+
+# Строка оглавления после удаления кодов полей: "1.2<TAB>Назначение системы<TAB>5"
+_TOC_LINE_RE = re.compile(r"^(\d+(?:\.\d+)*)\.?\t(.+?)\t\s*\d+\s*$")
+_TOC_APPENDIX_RE = re.compile(r"^(Приложение\s+\S+)\s*(.*?)\t\s*\d+\s*$")
+_NUMBERED_HEADING_RE = re.compile(r"^(\d+(?:\.\d+)*)\.?\s+([А-ЯЁA-Z].{2,150})$")
+_KIND_PREFIX_RE = re.compile(r"^(ГОСТ\s?34_)?((РД|ТП)_)?")
+# Служебные листы в конце ГОСТ-шаблонов: дальше пояснений к разделам нет
+_END_MARKERS = {"лист регистрации изменений"}
+_HEADING_LOOKAHEAD = 5
+
+
+class TemplateNotFoundError(Exception):
+    """Шаблон отсутствует в templates/ или из него не удалось выделить разделы."""
+    pass
+
+
+def _word97_text(path: str) -> str:
+    """Текст основного потока документа Word 97–2003 по таблице фрагментов (piece table)."""
+    with olefile.OleFileIO(path) as ole:
+        word = ole.openstream("WordDocument").read()
+        flags = struct.unpack_from("<H", word, 0x0A)[0]
+        table = ole.openstream("1Table" if flags & 0x0200 else "0Table").read()
+    text_length = struct.unpack_from("<i", word, 0x4C)[0]
+    fc_clx, lcb_clx = struct.unpack_from("<II", word, 0x01A2)
+    clx = table[fc_clx:fc_clx + lcb_clx]
+
+    # Пропускаем Prc (форматирование) и читаем Pcdt — список фрагментов текста
+    pos = 0
+    while clx[pos] == 0x01:
+        pos += 3 + struct.unpack_from("<H", clx, pos + 1)[0]
+    if clx[pos] != 0x02:
+        raise ValueError("таблица фрагментов не найдена")
+    lcb = struct.unpack_from("<I", clx, pos + 1)[0]
+    plc = clx[pos + 5:pos + 5 + lcb]
+    count = (lcb - 4) // 12
+    cps = struct.unpack_from(f"<{count + 1}I", plc, 0)
+
+    parts = []
+    for k in range(count):
+        start, end = cps[k], min(cps[k + 1], text_length)
+        if start >= text_length:
+            break
+        fc = struct.unpack_from("<I", plc, 4 * (count + 1) + 8 * k + 2)[0]
+        if fc & 0x40000000:
+            offset = (fc & ~0x40000000) // 2
+            parts.append(word[offset:offset + end - start].decode("cp1252", errors="replace"))
+        else:
+            parts.append(word[fc:fc + 2 * (end - start)].decode("utf-16-le", errors="replace"))
+    return "".join(parts)
+
+
+def _strip_fields(text: str) -> str:
+    """Убирает коды полей Word (0x13 код 0x14 результат 0x15), оставляя результаты."""
+    out, stack = [], []
+    for ch in text:
+        if ch == "\x13":
+            stack.append(True)
+        elif ch == "\x14":
+            if stack:
+                stack[-1] = False
+        elif ch == "\x15":
+            if stack:
+                stack.pop()
+        elif not any(stack):
+            out.append(ch)
+    return "".join(out)
+
+
+def _paragraphs(text: str) -> list[str]:
+    text = _strip_fields(text).replace("\x0b", " ").replace("\x07", "\r").replace("\x0c", "\r")
+    text = re.sub(r"[\x00-\x08\x0e-\x1f]", "", text)
+    return [p.strip(" ") for p in text.split("\r")]
+
+
+def _normalize(title: str) -> str:
+    return re.sub(r"\s+", " ", title).strip().lower()
+
+
+def _outline_from_paragraphs(paragraphs: list[str]) -> list[dict]:
+    """
+    Заголовки с уровнями и пояснительным текстом. Номера заголовков в теле ГОСТ-шаблонов
+    автоматические и в тексте отсутствуют, поэтому структура берётся из оглавления, а текст
+    раздела — из абзацев между найденными в теле заголовками. Без оглавления — по нумерованным строкам.
+    """
+    entries, toc_end = [], 0
+    for index, paragraph in enumerate(paragraphs):
+        match = _TOC_LINE_RE.match(paragraph)
+        appendix = None if match else _TOC_APPENDIX_RE.match(paragraph)
+        if match:
+            entries.append({"number": match.group(1), "level": match.group(1).count(".") + 1,
+                            "title": match.group(2).strip(), "text": []})
+            toc_end = index + 1
+        elif appendix:
+            title = f"{appendix.group(1)} {appendix.group(2)}".strip()
+            entries.append({"number": "", "level": 1, "title": title, "text": []})
+            toc_end = index + 1
+
+    if not entries:
+        current = None
+        for paragraph in paragraphs:
+            match = _NUMBERED_HEADING_RE.match(paragraph)
+            if match:
+                current = {"number": match.group(1), "level": match.group(1).count(".") + 1,
+                           "title": match.group(2).strip(), "text": []}
+                entries.append(current)
+            elif _normalize(paragraph) in _END_MARKERS:
+                break
+            elif current is not None and paragraph:
+                current["text"].append(paragraph)
+        return entries
+
+    # Находим заголовки в теле по порядку и собираем текст между ними. Заголовок в теле может быть
+    # короче строки оглавления или отсутствовать, поэтому сверяем с несколькими следующими пунктами
+    current, next_entry = None, 0
+    titles = [_normalize(e["title"]) for e in entries]
+    for paragraph in paragraphs[toc_end:]:
+        normalized = _normalize(paragraph)
+        if normalized in _END_MARKERS:
+            break
+        matched = None
+        if normalized and len(paragraph) < 300:
+            for j in range(next_entry, min(len(entries), next_entry + _HEADING_LOOKAHEAD)):
+                if titles[j] == normalized or (len(normalized) >= 20 and titles[j].startswith(normalized)):
+                    matched = j
+                    break
+        if matched is not None:
+            current = entries[matched]
+            next_entry = matched + 1
+        elif current is not None and paragraph:
+            current["text"].append(paragraph)
+    return entries
+
+
+def _outline_from_docx(path: str) -> list[dict]:
+    from docx import Document
+    entries, current = [], None
+    for paragraph in Document(path).paragraphs:
+        style = paragraph.style.name if paragraph.style is not None else ""
+        text = paragraph.text.strip()
+        level = re.search(r"(\d+)$", style) if style.startswith(("Heading", "Заголовок")) else None
+        if level and text:
+            match = _NUMBERED_HEADING_RE.match(text)
+            current = {"number": match.group(1) if match else "", "level": int(level.group(1)),
+                       "title": match.group(2) if match else text, "text": []}
+            entries.append(current)
+        elif current is not None and text:
+            current["text"].append(text)
+    return entries
+
+
+def _clip(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit].rsplit(" ", 1)[0] + "…"
+
+
+def build_skeleton(entries: list[dict]) -> list[tuple[str, str]]:
+    """Разделы верхнего уровня с подсказками: пояснения шаблона и перечень подразделов."""
+    sections, top = [], 0
+    for i, entry in enumerate(entries):
+        if entry["level"] != 1:
+            continue
+        top += 1
+        number = entry["number"] or (str(top) if not entry["title"].startswith("Приложение") else "")
+        title = f"{number}. {entry['title']}" if number else entry["title"]
+
+        hint_parts = []
+        if entry["text"]:
+            hint_parts.append(" ".join(entry["text"]))
+        for sub in entries[i + 1:]:
+            if sub["level"] == 1:
+                break
+            line = f"{sub['number']} {sub['title']}".strip()
+            if sub["text"]:
+                line += f": {' '.join(sub['text'])}"
+            hint_parts.append(line)
+        hint = _clip("\n".join(hint_parts), TEMPLATE_HINT_CHARS) if hint_parts else \
+            "описать содержание раздела в соответствии с ГОСТ 34"
+        sections.append((title, hint))
+    return sections
+
+
+def document_kind(filename: str) -> str:
+    """Вид документа по имени файла: "ГОСТ34_ТП_Пояснительная записка.doc" -> "Пояснительная записка"."""
+    stem = os.path.splitext(filename)[0]
+    return _KIND_PREFIX_RE.sub("", stem).replace("_", " ").strip() or stem
+
+
+def parse_template(path: str) -> list[tuple[str, str]]:
+    if path.lower().endswith(".docx"):
+        entries = _outline_from_docx(path)
+    else:
+        if olefile is None:
+            raise RuntimeError("для чтения .doc нужна библиотека olefile")
+        entries = _outline_from_paragraphs(_paragraphs(_word97_text(path)))
+    return build_skeleton(entries)
+
+
+def _file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class TemplateRegistry:
+    def __init__(self, directory: str, cache_path: str):
+        self.directory = directory
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._entries: dict[str, dict] = {}
+        self._loaded = False
+
+    def _load_cache(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+            if cache.get("parser_version") == _PARSER_VERSION:
+                self._entries = cache.get("templates", {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Кеш шаблонов {self.cache_path} не прочитан ({e}), шаблоны будут разобраны заново.")
+
+    def _save_cache(self) -> None:
+        try:
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"parser_version": _PARSER_VERSION, "templates": self._entries}, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            # Каталог шаблонов может быть только для чтения: тогда кеш живёт в памяти процесса
+            print(f"Не удалось сохранить кеш шаблонов: {e}")
+
+    def _refresh_file(self, filename: str) -> bool:
+        """Пересобирает скелет файла, если он изменился. Возвращает True, если запись обновлена."""
+        path = os.path.join(self.directory, filename)
+        stat = os.stat(path)
+        entry = self._entries.get(filename)
+        if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            return False
+        sha256 = _file_hash(path)
+        if entry and entry["sha256"] == sha256:
+            entry.update(mtime=stat.st_mtime, size=stat.st_size)
+            return True
+
+        entry = {"mtime": stat.st_mtime, "size": stat.st_size, "sha256": sha256,
+                 "kind": document_kind(filename), "sections": [], "error": None}
+        try:
+            entry["sections"] = [list(s) for s in parse_template(path)]
+            print(f"Шаблон '{filename}' разобран: {len(entry['sections'])} разделов.")
+        except Exception as e:
+            entry["error"] = str(e)
+            print(f"ОШИБКА при разборе шаблона '{filename}': {e}")
+        self._entries[filename] = entry
+        return True
+
+    def _files(self) -> list[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            name for name in os.listdir(self.directory)
+            if name.lower().endswith(SUPPORTED_EXTENSIONS) and not name.startswith("~$")
+        )
+
+    def refresh(self) -> dict:
+        """Сверяет кеш с каталогом шаблонов: разбирает новые и изменённые файлы, забывает удалённые."""
+        with self._lock:
+            self._load_cache()
+            files = self._files()
+            changed = [name for name in files if self._refresh_file(name)]
+            removed = [name for name in self._entries if name not in files]
+            for name in removed:
+                del self._entries[name]
+            if changed or removed:
+                self._save_cache()
+            return {"templates": len(files), "reparsed": len(changed), "removed": len(removed)}
+
+    def resolve(self, name: str) -> str:
+        """Имя файла шаблона по имени из запроса: точное, без расширения или по уникальной подстроке."""
+        files = self._files()
+        wanted = name.strip().strip('"«»').strip()
+        lowered = {f.lower(): f for f in files}
+        for candidate in (wanted, *(wanted + ext for ext in SUPPORTED_EXTENSIONS)):
+            if candidate.lower() in lowered:
+                return lowered[candidate.lower()]
+        matches = [f for f in files if _normalize(wanted) in _normalize(os.path.splitext(f)[0].replace("_", " "))]
+        if len(matches) == 1:
+            return matches[0]
+        available = ", ".join(os.path.splitext(f)[0] for f in files)
+        raise TemplateNotFoundError(f"Шаблон '{name}' не найден. Доступные шаблоны: {available}.")
+
+    def get(self, name: str) -> dict:
+        """Скелет шаблона: {"template_name", "kind", "sections": [(заголовок, подсказка), ...]}."""
+        filename = self.resolve(name)
+        with self._lock:
+            self._load_cache()
+            if self._refresh_file(filename):
+                self._save_cache()
+            entry = self._entries[filename]
+        if not entry["sections"]:
+            reason = entry["error"] or "разделы не найдены"
+            raise TemplateNotFoundError(f"Из шаблона '{filename}' не удалось выделить разделы: {reason}.")
+        return {
+            "template_name": filename,
+            "kind": entry["kind"],
+            "sections": [tuple(section) for section in entry["sections"]],
+        }
+
+    def list(self) -> list[dict]:
+        with self._lock:
+            self._load_cache()
+            return [
+                {"template_name": name, "kind": entry["kind"], "sections": len(entry["sections"]), "error": entry["error"]}
+                for name, entry in sorted(self._entries.items())
+            ]
+
+
+registry = TemplateRegistry(TEMPLATES_DIR, TEMPLATE_CACHE_PATH)
+
+
+if __name__ == "__main__":
+    summary = registry.refresh()
+    print(f"Кеш шаблонов собран: {summary}")
+    for item in registry.list():
+        print(f"  {item['template_name']}: {item['sections']} разделов" + (f" (ошибка: {item['error']})" if item["error"] else ""))
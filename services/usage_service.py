@@ -0,0 +1,150 @@
+# services/usage_service.py
+# Журнал расхода LLM: каждая попытка вызова модели дописывается одной JSON-строкой
+# в локальный append-only файл. По нему строятся отчёты по токенам, стоимости и задержкам.
+import os
+import json
+import argparse
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+USAGE_LOG_PATH = os.getenv("USAGE_LOG_PATH", os.path.join("usage", "llm_usage.jsonl"))
+# Цена за 1 млн токенов (USD), если провайдер сам не вернул стоимость
+LLM_PRICE_PROMPT_PER_1M = float(os.getenv("LLM_PRICE_PROMPT_PER_1M", "0"))
+LLM_PRICE_COMPLETION_PER_1M = float(os.getenv("LLM_PRICE_COMPLETION_PER_1M", "0"))
+
+DIMENSIONS = ("request_type", "user", "model", "provider", "section", "request_id")
+
+_context = contextvars.ContextVar("llm_usage_context", default={})
+_write_lock = threading.Lock()
+
+
+@contextmanager
+def usage_context(**fields):
+    """
+    Задаёт атрибуты (request_id, user, request_type, section) для всех вызовов LLM внутри блока.
+    Вложенные блоки дополняют и переопределяют поля внешних.
+    """
+    merged = {**_context.get(), **{k: v for k, v in fields.items() if v is not None}}
+    token = _context.set(merged)
+    try:
+        yield merged
+    finally:
+        _context.reset(token)
+
+
+def current_context() -> dict:
+    """Атрибуты текущего usage_context (для меток метрик и т.п.)."""
+    return _context.get()
+
+
+def record_call(provider: str, model: str | None, latency: float, ttft: float | None = None,
+                prompt_tokens: int | None = None, completion_tokens: int | None = None,
+                cost: float | None = None, status: str = "ok") -> None:
+    """Дописывает запись об одном вызове LLM в журнал."""
+    if cost is None and (prompt_tokens or completion_tokens):
+        cost = ((prompt_tokens or 0) * LLM_PRICE_PROMPT_PER_1M
+                + (completion_tokens or 0) * LLM_PRICE_COMPLETION_PER_1M) / 1_000_000
+
+    record = {
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        **_context.get(),
+        "provider": provider,
+        "model": model,
+        "status": status,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "ttft": round(ttft, 3) if ttft is not None else None,
+        "latency": round(latency, 3),
+        "cost": cost,
+    }
+    line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+
+    try:
+        with _write_lock:
+            os.makedirs(os.path.dirname(USAGE_LOG_PATH) or ".", exist_ok=True)
+            with open(USAGE_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+    except OSError as e:
+        # Журнал не должен ломать генерацию документа
+        print(f"Не удалось записать расход LLM в журнал: {e}")
+
+
+def load_records(since: str | None = None) -> list[dict]:
+    """Читает журнал. since — ISO-дата/время, более ранние записи пропускаются."""
+    if not os.path.exists(USAGE_LOG_PATH):
+        return []
+    records = []
+    with open(USAGE_LOG_PATH, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if since and record.get("ts", "") < since:
+                continue
+            records.append(record)
+    return records
+
+
+def _percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def aggregate(group_by: str = "request_type", since: str | None = None) -> list[dict]:
+    """Сводка по измерению: вызовы, ошибки, токены, токены/с, стоимость, p50/p95 задержки и ttft."""
+    if group_by not in DIMENSIONS:
+        raise ValueError(f"Неизвестное измерение '{group_by}'. Допустимо: {', '.join(DIMENSIONS)}")
+
+    groups = {}
+    for record in load_records(since):
+        key = record.get(group_by) or "-"
+        groups.setdefault(key, []).append(record)
+
+    report = []
+    for key, records in groups.items():
+        ok = [r for r in records if r.get("status") == "ok"]
+        completion_tokens = sum(r.get("completion_tokens") or 0 for r in ok)
+        decode_time = sum(r["latency"] for r in ok if r.get("completion_tokens"))
+        latencies = [r["latency"] for r in ok]
+        ttfts = [r["ttft"] for r in ok if r.get("ttft") is not None]
+        report.append({
+            group_by: key,
+            "calls": len(records),
+            "errors": len(records) - len(ok),
+            "prompt_tokens": sum(r.get("prompt_tokens") or 0 for r in ok),
+            "completion_tokens": completion_tokens,
+            "tokens_per_sec": round(completion_tokens / decode_time, 2) if decode_time else None,
+            "cost": round(sum(r.get("cost") or 0 for r in records), 6),
+            "latency_p50": _percentile(latencies, 0.5),
+            "latency_p95": _percentile(latencies, 0.95),
+            "ttft_p95": _percentile(ttfts, 0.95),
+        })
+    report.sort(key=lambda row: row["cost"], reverse=True)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Отчёт по расходу LLM из журнала вызовов.")
+    parser.add_argument("--group-by", default="request_type", choices=DIMENSIONS)
+    parser.add_argument("--since", default=None, help="ISO-дата, например 2025-01-31")
+    args = parser.parse_args()
+
+    rows = aggregate(group_by=args.group_by, since=args.since)
+    if not rows:
+        print(f"Журнал пуст: {USAGE_LOG_PATH}")
+    else:
+        columns = list(rows[0].keys())
+        print("\t".join(columns))
+        for row in rows:
+            print("\t".join("-" if row[c] is None else str(row[c]) for c in columns))